@@ -1,10 +1,21 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 from fastapi.responses import JSONResponse
-from sqlmodel import SQLModel, Session, select
-
-from auth.api.services import get_code, send_code
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from auth.api import schema
+from auth.api.services import get_code, get_token_pair_for_user, refresh_token_pair, send_code
 from config.db import get_session
 from core.api import responses
+from core.api.exceptions import NotFoundError
+from core.ratelimit import (
+    client_ip, code_check_phone_limiter, path_param, rate_limit, sms_ip_limiter, sms_phone_limiter
+)
+from models import User
+from user.tokens import UserAccessToken, UserRefreshToken
 
 router = APIRouter()
 
@@ -15,12 +26,12 @@ router = APIRouter()
 )
 async def check_no_user_with_email(
     email: str,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
 ):
     """
     Check if user with this email already exists
     """
-    email_exists = bool(session.exec(select(User).filter(User.email == email)).one_or_none())
+    email_exists = bool((await session.exec(select(User).filter(User.email == email))).one_or_none())
 
     if email_exists:
         return JSONResponse(status_code=409, content=None)
@@ -28,18 +39,22 @@ async def check_no_user_with_email(
 
 @router.get(
     "/signup/{phone_number}/",
-    responses=responses.CONFLICT, 
+    responses=responses.CONFLICT | responses.TOO_MANY_REQUESTS,
+    dependencies=[
+        rate_limit(sms_phone_limiter, path_param("phone_number")),
+        rate_limit(sms_ip_limiter, client_ip),
+    ],
     status_code=200,
 )
 async def get_signup_code(
     phone_number: str,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
 ):
     """
     Check if user with this phone already exists and if not, send verification code
     """
     phone_exists = bool(
-        session.exec(select(User).filter(User.phone_number == phone_number)).one_or_none()
+        (await session.exec(select(User).filter(User.phone_number == phone_number))).one_or_none()
     )
 
     if phone_exists:
@@ -50,14 +65,15 @@ async def get_signup_code(
 
 @router.post(
     "/signup/{phone_number}/",
-    responses=responses.INVALID_CODE,
+    responses=responses.INVALID_CODE | responses.TOO_MANY_REQUESTS,
+    dependencies=[rate_limit(code_check_phone_limiter, path_param("phone_number"))],
     response_model=schema.TokenPairSchema,
     status_code=201,
 )
 async def check_signup_code(
     phone_number: str,
     data: schema.GetSignupCodeSchema,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
 ):
     """
     Check if code is valid and if it is, create user and reply with his token
@@ -69,16 +85,17 @@ async def check_signup_code(
     user = User(phone_number=phone_number, **data.dict())
     session.add(user)
     try:
-        session.commit()
+        await session.commit()
     except IntegrityError:
-        session.rollback()
+        await session.rollback()
         return JSONResponse(
             status_code=409,
             content={"detail": "User with this email or phone number already exists"}
         )
 
+    # New user has no customer yet, nothing to load for the token claims
+    set_committed_value(user, "customer", None)
     access, refresh = get_token_pair_for_user(
-        session,
         user,
         access_token_class=UserAccessToken,
         refresh_token_class=UserRefreshToken
@@ -92,16 +109,21 @@ async def check_signup_code(
 
 @router.get(
     "/signin/{phone_number}/",
+    responses=responses.NOT_FOUND | responses.TOO_MANY_REQUESTS,
+    dependencies=[
+        rate_limit(sms_phone_limiter, path_param("phone_number")),
+        rate_limit(sms_ip_limiter, client_ip),
+    ],
     status_code=200,
 )
 async def get_signin_code(
     phone_number: str,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
 ):
     """
     Find user in db and send verification code
     """
-    user = session.exec(select(User).filter(User.phone_number == phone_number)).one_or_none()
+    user = (await session.exec(select(User).filter(User.phone_number == phone_number))).one_or_none()
     if not user:
         raise NotFoundError
 
@@ -110,14 +132,15 @@ async def get_signin_code(
 
 @router.post(
     "/signin/{phone_number}/",
-    responses=responses.INVALID_CODE | responses.NOT_FOUND,
+    responses=responses.INVALID_CODE | responses.NOT_FOUND | responses.TOO_MANY_REQUESTS,
+    dependencies=[rate_limit(code_check_phone_limiter, path_param("phone_number"))],
     response_model=schema.TokenPairSchema,
     status_code=200,
 )
 async def check_signin_code(
     phone_number: str,
     data: schema.GetSigninCodeSchema,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
 ):
     """
     Check if code is valid and if it is, get user from db and reply with his token
@@ -126,12 +149,14 @@ async def check_signin_code(
     if sent_code is None or sent_code != data.code:
         return JSONResponse(status_code=400, content={"detail": "Code is invalid or expired"})
 
-    user = session.exec(select(User).filter(User.phone_number == phone_number)).one_or_none()
+    # Customer is loaded, so its id gets into the access token claims
+    user = (await session.exec(
+        select(User).options(joinedload(User.customer)).filter(User.phone_number == phone_number)
+    )).one_or_none()
     if not user:
         raise NotFoundError
 
     access, refresh = get_token_pair_for_user(
-        session,
         user,
         access_token_class=UserAccessToken,
         refresh_token_class=UserRefreshToken
@@ -150,14 +175,14 @@ async def check_signin_code(
     status_code=200,
 )
 async def refresh_token(
-    data: schema.k,
-    session: Session = Depends(get_session),
+    data: schema.RefreshTokenSchema,
+    session: AsyncSession = Depends(get_session),
 ):
     """
     Get new token pair using refresh token
     """
     try:
-        access, refresh = refresh_token_pair(
+        access, refresh = await refresh_token_pair(
             session,
             token=data.token,
             access_token_class=UserAccessToken,
@@ -1,67 +1,28 @@
-import boto3
-import contextlib
-import logging
+import secrets
 
 from config.db import redis_manager
-from botocore.exceptions import ClientError
 from random import randint
-from typing import AsyncIterator
 
-from aiobotocore.session import get_session
-from types_aiobotocore_s3.client import S3Client
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from config.settings import settings
-
-pinpoint_settings = settings.PINPOINT_SETTINGS
-
-logger = logging.getLogger("sendgrid")
-
-@contextlib.asynccontextmanager
-async def create_client() -> AsyncIterator[S3Client]:
-    session = get_session()
-
-    async with session.create_client(
-        "pinpoint",
-        region_name=settings.AWS_S3_REGION_NAME,
-        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-    ) as client:
-        yield client
+from auth.revocation import FIRST_USE, IN_GRACE, refresh_token_revocations
+from core.sms import sms_queue
+from core.token import Token, TokenError
+from models import User
 
 
 async def send_code(phone_number: str, code_len: int = 6, send_message=True) -> str:
+    """
+    Generate and store a code, the message with it is sent in background by core.sms
+    """
     code = ''.join(
         ["{}".format(randint(0, 9)) for num in range(0, code_len)]
     )
     
     await redis_manager.set_cache_value(phone_number, code)
     
-    if not send_message:
-        return code
-
-    message = f'Your verification code is {code}'
-
-    async with create_client() as client:
-        try:
-            response = await client.send_messages(
-                ApplicationId=pinpoint_settings["project_id"],
-                MessageRequest={
-                    'Addresses': {phone_number: {'ChannelType': 'SMS'}},
-                    'MessageConfiguration': {
-                        'SMSMessage': {
-                            'Body': message,
-                            'MessageType': pinpoint_settings["message_type"],
-                            'OriginationNumber': pinpoint_settings["origination_number"]
-                        }
-                    }
-                }
-            )
-        except ClientError as e:
-            logger.exception(f"Couldn't send message: {str(e)}")
-        else:
-            logger.info(
-                f"Code to {phone_number} sending stating: {response['MessageResponse']['Result'][phone_number]['DeliveryStatus']}"
-            )
+    if send_message:
+        await sms_queue.enqueue(phone_number, f'Your verification code is {code}')
     return code
 
 
@@ -71,3 +32,48 @@ async def get_code(phone_number: str) -> str | None:
         code = code.decode('utf-8')
 
     return code
+
+
+def get_token_pair_for_user(
+    user: User,
+    access_token_class: type[Token],
+    refresh_token_class: type[Token],
+    family: str | None = None,
+    jti: str | None = None,
+) -> tuple[Token, Token]:
+    """
+    Issue access and refresh tokens, refresh token starts a new family unless
+    it replaces a token of an existing one, then it gets the `jti` reserved for it
+    """
+    access = access_token_class.for_user(user)
+    extra_claims = {"family": family or secrets.token_hex()}
+    if jti is not None:
+        extra_claims["jti"] = jti
+    refresh = refresh_token_class.for_user(user, extra_claims=extra_claims)
+    return access, refresh
+
+
+async def refresh_token_pair(
+    session: AsyncSession,
+    token: str,
+    access_token_class: type[Token],
+    refresh_token_class: type[Token],
+) -> tuple[Token, Token]:
+    """
+    Exchange refresh token for a new pair, every refresh token can be exchanged once.
+    Reuse of a token revokes all tokens of its family, unless it comes within the grace
+    period of the first exchange, then the new refresh token has the same jti as the
+    one issued first
+    """
+    refresh = await refresh_token_class.from_string(token, session)
+    result, successor = await refresh_token_revocations.use(refresh.claims)
+    if result not in (FIRST_USE, IN_GRACE):
+        raise TokenError(refresh.error_message)
+
+    return get_token_pair_for_user(
+        refresh.user,
+        access_token_class=access_token_class,
+        refresh_token_class=refresh_token_class,
+        family=refresh_token_revocations.family(refresh.claims),
+        jti=successor,
+    )
@@ -0,0 +1,161 @@
+import hashlib
+import logging
+import secrets
+import time
+
+from datetime import timedelta
+
+from config.db import redis_manager
+from config.settings import settings
+from core.token import ClaimsDict
+
+logger = logging.getLogger("auth")
+
+# KEYS: current bloom generation, previous bloom generation, family revocation flag,
+# used flag of the jti
+# ARGV: family revocation ttl in ms, used flag ttl in ms, reuse grace period in ms, jti
+# reserved for the successor, bit offsets of the jti
+# Returns the result and jti of the token's successor. 0 if the token is used for the
+# first time, 1 if it was already used (its family is revoked now), 2 if its family was
+# revoked earlier, 3 if it was used within the grace period. Bloom filter answers for
+# tokens never used, its positives are confirmed by the exact used flag
+USE_TOKEN_SCRIPT = """
+local function contains(key)
+    for i = 5, #ARGV do
+        if redis.call('GETBIT', key, ARGV[i]) == 0 then
+            return false
+        end
+    end
+    return true
+end
+
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    return {2, ''}
+end
+if contains(KEYS[1]) or contains(KEYS[2]) then
+    local used = redis.call('GET', KEYS[4])
+    if used then
+        local successor, used_at = string.match(used, '^(%S+) (%d+)$')
+        if now - tonumber(used_at) <= tonumber(ARGV[3]) then
+            return {3, successor}
+        end
+        redis.call('SET', KEYS[3], 1, 'PX', ARGV[1])
+        return {1, ''}
+    end
+    -- False positive of the filter, the token was never used
+end
+for i = 5, #ARGV do
+    redis.call('SETBIT', KEYS[1], ARGV[i], 1)
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[1] * 2)
+redis.call('SET', KEYS[4], ARGV[4] .. ' ' .. now, 'PX', ARGV[2])
+return {0, ARGV[4]}
+"""
+
+FIRST_USE = 0
+USED = 1
+FAMILY_REVOKED = 2
+IN_GRACE = 3
+
+
+class RefreshTokenRevocations:
+    """
+    Single use refresh tokens with reuse detection
+
+    Every refresh token belongs to a family started at sign in. Used `jti`s are kept
+    in a Redis Bloom filter and as exact flags living until the token expires, a token
+    presented again means it leaked, so its whole family is revoked. The filter answers
+    for tokens never used, its positives are confirmed by the flag, so they cost one more
+    lookup and never revoke an innocent family. Checking and marking a token is one atomic
+    script call, no database queries are made. Filters are rotated every `lifetime`,
+    a token can't outlive the previous generation, so two of them are checked.
+
+    The flag keeps the jti reserved for the token's successor. Concurrent refreshes with
+    the same token, e.g. from two tabs or a retry after a lost response, get a pair with
+    the same successor if they come within `grace`, so only one of them can be exchanged
+    """
+
+    def __init__(
+        self,
+        size: int | None = None,
+        hashes: int | None = None,
+        lifetime: timedelta | None = None,
+        grace: timedelta | None = None,
+    ):
+        self.size = size or settings.REFRESH_TOKEN_BLOOM_BITS
+        self.hashes = hashes or settings.REFRESH_TOKEN_BLOOM_HASHES
+        self.lifetime = lifetime or settings.USER_REFRESH_TOKEN_LIFETIME
+        self.grace = grace or settings.REFRESH_TOKEN_REUSE_GRACE
+
+        self.used = 0
+        self.reused = 0
+        self.rejected = 0
+        self.in_grace = 0
+
+    def stats(self) -> dict[str, int]:
+        return {"used": self.used, "reused": self.reused, "rejected": self.rejected, "in_grace": self.in_grace}
+
+    def _offsets(self, jti: str) -> list[int]:
+        # Double hashing, k offsets from two halves of one digest
+        digest = hashlib.sha256(jti.encode("utf-8")).digest()
+        first = int.from_bytes(digest[:8], "big")
+        second = int.from_bytes(digest[8:16], "big") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def _bloom_keys(self) -> tuple[str, str]:
+        generation = int(time.time() // self.lifetime.total_seconds())
+        return f"refresh_jti_bloom_{generation}", f"refresh_jti_bloom_{generation - 1}"
+
+    @staticmethod
+    def _family_key(family: str) -> str:
+        return f"refresh_family_revoked_{family}"
+
+    @staticmethod
+    def _used_key(jti: str) -> str:
+        return f"refresh_used_{jti}"
+
+    @staticmethod
+    def family(claims: ClaimsDict) -> str:
+        # Tokens issued before families were introduced are a family of their own
+        return claims.get("family") or claims["jti"]
+
+    async def use(self, claims: ClaimsDict) -> tuple[int, str | None]:
+        """
+        Mark the token as used, return the result and jti its successor has to be issued
+        with. FIRST_USE and IN_GRACE tokens can be exchanged, USED and FAMILY_REVOKED can't
+        """
+        family = self.family(claims)
+        result, successor = await redis_manager.run_script(
+            USE_TOKEN_SCRIPT,
+            keys=[*self._bloom_keys(), self._family_key(family), self._used_key(claims["jti"])],
+            args=[
+                int(self.lifetime.total_seconds() * 1000),
+                max(int((claims["exp"] - time.time()) * 1000), 1),
+                int(self.grace.total_seconds() * 1000),
+                secrets.token_hex(),
+                *self._offsets(claims["jti"]),
+            ],
+        )
+
+        if result == USED:
+            self.reused += 1
+            logger.warning(f"Refresh token {claims['jti']} is reused, family {family} is revoked")
+        elif result == FAMILY_REVOKED:
+            self.rejected += 1
+        elif result == IN_GRACE:
+            self.in_grace += 1
+        else:
+            self.used += 1
+        return result, successor.decode("utf-8") if successor else None
+
+    async def revoke_family(self, family: str):
+        """
+        Revoke all refresh tokens of the family, e.g. on sign out
+        """
+        await redis_manager.set_cache_value(self._family_key(family), 1, ttl=self.lifetime)
+
+
+refresh_token_revocations = RefreshTokenRevocations()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+S3 upload throughput with a client per call vs. the long-lived client of core.aws
+
+Every upload either creates its own client, as core.s3 did before, or goes through
+the shared client opened once like on app startup. Uploads run `concurrency` at a time,
+latency is measured per upload.
+
+Requires a local S3 stand-in, e.g. moto server or MinIO:
+
+    moto_server -p 5000
+    AWS_ENDPOINT_URL=http://127.0.0.1:5000 python benchmarks/aws_clients.py --uploads 500
+"""
+import asyncio
+import statistics
+import sys
+import time
+
+import typer
+
+sys.path.insert(0, ".")
+
+import core.s3  # noqa: E402
+from core.aws import AWSClients  # noqa: E402
+
+cli = typer.Typer()
+
+BUCKET = "bench-aws-clients"
+DATA = b"x" * 50 * 1024
+
+
+async def _measure(uploads: int, concurrency: int) -> tuple[float, list[float]]:
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def upload(i: int):
+        async with semaphore:
+            started = time.perf_counter()
+            await core.s3.upload_image_binary(bucket=BUCKET, key=f"bench/{i}.jpg", data=DATA)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(upload(i) for i in range(uploads)))
+    return uploads / (time.perf_counter() - started), latencies
+
+
+def _report(name: str, throughput: float, latencies: list[float]) -> None:
+    latencies = sorted(latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    typer.echo(
+        f"{name:<10} {throughput:10.0f} uploads/s  median {statistics.median(latencies):8.2f} ms"
+        f"  p99 {p99:8.2f} ms"
+    )
+
+
+async def _run(uploads: int, concurrency: int) -> None:
+    clients = AWSClients(services=("s3",))
+    async with clients.client("s3") as client:
+        try:
+            await client.create_bucket(Bucket=BUCKET)
+        except client.exceptions.BucketAlreadyOwnedByYou:
+            pass
+
+    # Not opened, so every upload creates and closes its own client
+    core.s3.aws_clients = clients
+    _report("per call", *await _measure(uploads, concurrency))
+
+    await clients.open()
+    try:
+        _report("shared", *await _measure(uploads, concurrency))
+    finally:
+        await clients.close()
+
+
+@cli.command()
+def main(
+    uploads: int = typer.Option(200),
+    concurrency: int = typer.Option(20),
+) -> None:
+    asyncio.run(_run(uploads, concurrency))
+
+
+if __name__ == "__main__":
+    cli()
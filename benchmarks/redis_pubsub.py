@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Redis pub/sub listener throughput and latency
+
+Compares RedisManager's event-driven listener with the previous polling loop
+(1 s `get_message` timeout plus a 10 ms sleep after every message). Each message
+carries its publish time, latency is measured when the subscriber callback runs.
+
+Requires running redis:
+
+    python benchmarks/redis_pubsub.py --messages 5000
+"""
+import asyncio
+import json
+import statistics
+import sys
+import time
+
+import async_timeout
+import typer
+
+sys.path.insert(0, ".")
+
+from config.db import RedisManager  # noqa: E402
+
+cli = typer.Typer()
+
+CHANNEL = "bench_pubsub"
+
+
+class PollingRedisManager(RedisManager):
+    """
+    Listener as it was before switching to blocking reads
+    """
+
+    async def _start_listening(self):
+        while True:
+            try:
+                async with async_timeout.timeout(1):
+                    message = await self._pubsub.get_message(ignore_subscribe_messages=True)
+                    if message is not None:
+                        channel = message["channel"].decode("utf-8")
+                        cb = self._callbacks.get(channel)
+                        if cb is not None:
+                            await cb(message["data"].decode("utf-8"))
+                    await asyncio.sleep(0.01)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def _measure(manager: RedisManager, messages: int, rate: int) -> tuple[float, list[float]]:
+    manager.connect()
+    latencies = []
+    done = asyncio.Event()
+
+    async def callback(message_str):
+        latencies.append((time.perf_counter() - json.loads(message_str)["sent"]) * 1000)
+        if len(latencies) == messages:
+            done.set()
+
+    await manager.subscribe(CHANNEL, callback)
+
+    started = time.perf_counter()
+    for _ in range(messages):
+        await manager.publish(CHANNEL, json.dumps({"sent": time.perf_counter()}))
+        if rate:
+            await asyncio.sleep(1 / rate)
+    await done.wait()
+    elapsed = time.perf_counter() - started
+
+    await manager.unsubscribe(CHANNEL)
+    await manager.disconnect()
+    return messages / elapsed, latencies
+
+
+def _report(name: str, throughput: float, latencies: list[float]) -> None:
+    latencies = sorted(latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    typer.echo(
+        f"{name:<10} {throughput:10.0f} msg/s  median {statistics.median(latencies):8.2f} ms"
+        f"  p99 {p99:8.2f} ms"
+    )
+
+
+async def _run(messages: int, rate: int) -> None:
+    # RedisManager is a singleton, so each run gets its own instance explicitly
+    for name, manager_class in (("polling", PollingRedisManager), ("push", RedisManager)):
+        manager = object.__new__(manager_class)
+        manager.__init__()
+        _report(name, *await _measure(manager, messages, rate))
+
+
+@cli.command()
+def main(
+    messages: int = typer.Option(2000),
+    rate: int = typer.Option(0, help="Publish rate per second, 0 publishes as fast as possible"),
+) -> None:
+    asyncio.run(_run(messages, rate))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+WebSocket delivery latency while a slow query runs on the same worker
+
+Starts the app with uvicorn inside this process, connects two customers to the chat
+websocket and measures how long a message takes to reach the recipient. The same
+measurement is then repeated while `pg_sleep` queries run on the worker's event loop,
+first through the async engine and then through a blocking sync engine for comparison.
+
+Requires running postgres and redis and two existing users:
+
+    python benchmarks/ws_latency.py sender@example.com recipient@example.com
+"""
+import asyncio
+import json
+import statistics
+import sys
+import time
+
+import typer
+import uvicorn
+import websockets
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import joinedload
+from sqlmodel import select
+
+sys.path.insert(0, ".")
+
+from config.asgi import app  # noqa: E402
+from config.db import create_session, engine  # noqa: E402
+from config.settings import settings  # noqa: E402
+from models import User  # noqa: E402
+from user.tokens import UserAccessToken  # noqa: E402
+
+cli = typer.Typer()
+
+
+async def _get_tokens(*emails: str) -> list[tuple[int, str]]:
+    async with create_session() as session:
+        users = (
+            await session.exec(
+                select(User).options(joinedload(User.customer)).where(User.email.in_(emails))
+            )
+        ).all()
+    users_by_email = {user.email: user for user in users}
+    return [
+        (users_by_email[email].customer.id, str(UserAccessToken.for_user(users_by_email[email])))
+        for email in emails
+    ]
+
+
+async def _measure(url: str, sender: tuple, recipient: tuple, messages: int) -> list[float]:
+    _, sender_token = sender
+    recipient_id, recipient_token = recipient
+
+    latencies = []
+    async with websockets.connect(url, extra_headers={"Authorization": f"Bearer {sender_token}"}) as sender_ws, \
+            websockets.connect(url, extra_headers={"Authorization": f"Bearer {recipient_token}"}) as recipient_ws:
+        for i in range(messages):
+            started = time.perf_counter()
+            await sender_ws.send(json.dumps(json.dumps({"to_customer_id": recipient_id, "message": f"bench {i}"})))
+            await sender_ws.recv()
+            await recipient_ws.recv()
+            latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+async def _slow_async_queries(seconds: float, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        async with engine.connect() as connection:
+            await connection.execute(text("SELECT pg_sleep(:seconds)"), {"seconds": seconds})
+
+
+async def _slow_sync_queries(seconds: float, stop: asyncio.Event) -> None:
+    sync_engine = create_engine(settings.SQLALCHEMY_DATABASE_URI)
+    while not stop.is_set():
+        with sync_engine.connect() as connection:
+            connection.execute(text("SELECT pg_sleep(:seconds)"), {"seconds": seconds})
+        await asyncio.sleep(0)
+
+
+def _report(name: str, latencies: list[float]) -> None:
+    latencies = sorted(latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    typer.echo(
+        f"{name:<24} median {statistics.median(latencies):8.2f} ms"
+        f"  p99 {p99:8.2f} ms  max {latencies[-1]:8.2f} ms"
+    )
+
+
+async def _run(sender_email: str, recipient_email: str, messages: int, query_seconds: float, port: int) -> None:
+    server = uvicorn.Server(uvicorn.Config(app, port=port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    url = f"ws://127.0.0.1:{port}/chat/"
+    sender, recipient = await _get_tokens(sender_email, recipient_email)
+
+    _report("idle", await _measure(url, sender, recipient, messages))
+
+    for name, slow_queries in (("slow async query", _slow_async_queries), ("slow sync query", _slow_sync_queries)):
+        stop = asyncio.Event()
+        slow_task = asyncio.create_task(slow_queries(query_seconds, stop))
+        _report(name, await _measure(url, sender, recipient, messages))
+        stop.set()
+        await slow_task
+
+    server.should_exit = True
+    await server_task
+
+
+@cli.command()
+def main(
+    sender_email: str,
+    recipient_email: str,
+    messages: int = typer.Option(200),
+    query_seconds: float = typer.Option(0.5),
+    port: int = typer.Option(8765),
+) -> None:
+    asyncio.run(_run(sender_email, recipient_email, messages, query_seconds, port))
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,79 +1,274 @@
-import crud
-import datetime
+import re
 
-from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect
+from fastapi import APIRouter, Depends, Query, WebSocket, WebSocketDisconnect
 from starlette.websockets import WebSocketDisconnect as s_WebSocketDisconnect
-from fastapi_pagination import Page, paginate
-from sqlalchemy import or_
-from sqlalchemy.orm import joinedload
-from sqlmodel import Session, select, col
+from fastapi_pagination import Page, Params, create_page
+from sqlalchemy import and_, case, func, nullsfirst, nullslast, or_, tuple_
+from sqlalchemy.orm import aliased, joinedload
+from sqlmodel import select, col
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from config.db import get_session, engine
+from config.db import get_session
 from core.api.exceptions import NotFoundError
-from core.api.deps import get_user, get_customer, get_customer_photo, get_chat
+from core.api.deps import (
+    CustomerIdentity, get_user, get_customer_identity, get_customer_identity_ws, get_customer_photo, get_chat
+)
 from core.api import responses
+from core.api.pagination import (
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, CursorPage, decode_cursor, encode_cursor
+)
+from chat import summaries
 from chat.api.services import WSManager, ChatWorker, ws_error
-from chat.schema import ChatMessageSchema, SendMessageSchema, ChatSchema
-from models import CustomerRelation, Chat, Customer, ChatMessage
+from chat.schema import ChatMessageSchema, ChatSchema, MessageCursor, SyncCursor, SyncSchema
+from config.settings import settings
+from models import Chat, ChatMessage, ChatSummary
 
 
 router = APIRouter()
 
+DELIVERY_ID_RE = re.compile(r"^\d+-\d+$")
+
 
 @router.websocket("/")
 async def chat(
     websocket: WebSocket,
-    session: Session = Depends(get_session),
-    customer: Customer = Depends(get_customer_ws),
+    last_seen_id: str | None = None,
+    session: AsyncSession = Depends(get_session),
+    customer: CustomerIdentity = Depends(get_customer_identity_ws),
 ):
     """
     Connect client to chat websocket
+
+    Pass `delivery_id` of the last received message as `last_seen_id` to get messages
+    missed while disconnected before live ones. If some of them are no longer logged,
+    `{"type": "resync"}` is sent first and the client should catch up with `/chat/sync/`
     """
 
     if not customer:
         await websocket.accept()
         return await ws_error(websocket, "Invalid credentials")
 
-    await WSManager.run(ChatWorker, session, websocket, customer)
+    if last_seen_id and not DELIVERY_ID_RE.match(last_seen_id):
+        await websocket.accept()
+        return await ws_error(websocket, "Invalid last_seen_id")
+
+    await WSManager.run(ChatWorker, session, websocket, customer, last_seen_id)
+
+
+@router.get(
+    "/sync/",
+    responses=responses.UNAUTHORIZED | responses.BAD_REQUEST,
+    response_model=SyncSchema,
+    status_code=200,
+)
+async def sync(
+    since: str | None = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    session: AsyncSession = Depends(get_session),
+    customer: CustomerIdentity = Depends(get_customer_identity),
+):
+    """
+    Get everything that changed in customer's chats since `since` cursor: new messages,
+    new or updated chats and read watermarks of chat partners
+
+    Without `since` only the current cursor is returned. Keep requesting with the returned
+    cursor while `has_more` is true. Changes made shortly before the previous sync are
+    sent again, so late commits are not missed, clients should dedupe them by id
+    """
+
+    # Cursors follow the database clock, like `changed_at` of inbox rows
+    now = (await session.exec(select(func.timezone("utc", func.now())))).one()
+    if since is None:
+        cursor = SyncCursor(updated_at=now - settings.CHAT_SYNC_OVERLAP)
+        return {
+            "messages": [], "chats": [], "read_states": [], "cursor": encode_cursor(cursor), "has_more": False
+        }
+
+    position = decode_cursor(since, SyncCursor)
+
+    # Every new message updates inbox rows of its chat, so changed rows of the customer
+    # are joined with messages of their chats created since the cursor
+    changed_at = ChatSummary.changed_at
+    row_key = tuple_(
+        changed_at, ChatSummary.chat_id, ChatSummary.customer_id, func.coalesce(ChatMessage.id, 0)
+    )
+    recipient_id = case(
+        (ChatMessage.is_from_from_customer, Chat.to_customer_id), else_=Chat.from_customer_id
+    )
+    recipient_summary = aliased(ChatSummary)
+    query = (
+        select(
+            ChatSummary,
+            changed_at,
+            ChatMessage,
+            Chat.from_customer_id,
+            Chat.to_customer_id,
+            ChatMessage.id <= func.coalesce(recipient_summary.last_read_message_id, 0),
+        )
+        .outerjoin(
+            ChatMessage,
+            and_(
+                ChatMessage.chat_id == ChatSummary.chat_id,
+                ChatSummary.customer_id == customer.id,
+                ChatMessage.created_at > position.updated_at,
+            ),
+        )
+        .outerjoin(Chat, Chat.id == ChatMessage.chat_id)
+        .outerjoin(
+            recipient_summary,
+            and_(
+                recipient_summary.chat_id == ChatMessage.chat_id,
+                recipient_summary.customer_id == recipient_id,
+            ),
+        )
+        .where(
+            # Rows of partners in customer's chats carry their read watermarks
+            or_(ChatSummary.customer_id == customer.id, ChatSummary.with_customer_id == customer.id),
+            changed_at > position.updated_at,
+        )
+        .order_by(*row_key.clauses)
+        .limit(limit + 1)
+    )
+    if position.changed_at is not None:
+        query = query.where(
+            row_key > tuple_(position.changed_at, position.chat_id, position.customer_id, position.message_id)
+        )
+    rows = (await session.exec(query)).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    messages, chats, read_states = list(), list(), list()
+    sent_summaries = set()
+    for summary, _, message, from_customer_id, to_customer_id, is_viewed in rows:
+        if (summary.chat_id, summary.customer_id) not in sent_summaries:
+            sent_summaries.add((summary.chat_id, summary.customer_id))
+            if summary.customer_id == customer.id:
+                chats.append(_chat_summary_data(summary))
+            else:
+                read_states.append({
+                    "chat_id": summary.chat_id,
+                    "customer_id": summary.customer_id,
+                    "last_read_message_id": summary.last_read_message_id,
+                })
+
+        if message is not None:
+            messages.append({
+                "id": message.id,
+                "seq": message.seq,
+                "message": message.message,
+                "created_at": message.created_at,
+                "from_customer_id": from_customer_id if message.is_from_from_customer else to_customer_id,
+                "to_customer_id": to_customer_id if message.is_from_from_customer else from_customer_id,
+                "is_viewed": is_viewed,
+            })
+
+    if has_more:
+        # Resume right after the last returned row, ties are broken by ids
+        summary, last_changed_at, message, *_ = rows[-1]
+        cursor = SyncCursor(
+            updated_at=position.updated_at,
+            changed_at=last_changed_at,
+            chat_id=summary.chat_id,
+            customer_id=summary.customer_id,
+            message_id=message.id if message is not None else 0,
+        )
+    else:
+        cursor = SyncCursor(updated_at=max(now - settings.CHAT_SYNC_OVERLAP, position.updated_at))
+
+    return {
+        "messages": messages,
+        "chats": chats,
+        "read_states": read_states,
+        "cursor": encode_cursor(cursor),
+        "has_more": has_more,
+    }
 
 
 @router.get(
     "/{with_customer_id}/",
-    responses=responses.CRUD_RESPONSES,
-    response_model=Page[ChatMessageSchema],
+    responses=responses.CRUD_RESPONSES | responses.BAD_REQUEST,
+    response_model=CursorPage[ChatMessageSchema],
     status_code=200,
 )
 async def get_chat(
     with_customer_id: int,
-    session: Session = Depends(get_session),
-    customer: Customer = Depends(get_customer),
+    cursor: str | None = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    session: AsyncSession = Depends(get_session),
+    customer: CustomerIdentity = Depends(get_customer_identity),
     chat: Chat = Depends(get_chat),
 ):
     """
-    Check if chat exists and if it does - return all its messages
+    Check if chat exists and if it does - return a page of its messages, newest first
+
+    Pass `next_cursor` to get older messages and `prev_cursor` to get newer ones
     """
 
-    customer_ids = (customer.id, with_customer_id)
-
-    messages = list()
-    for message in chat.messages:
-        from_customer_id, to_customer_id = customer_ids
-        if (
-            (message.is_from_from_customer and chat.from_customer_id != from_customer_id) or
-            (not message.is_from_from_customer and chat.to_customer_id != from_customer_id)
-        ):
-            from_customer_id, to_customer_id = to_customer_id, from_customer_id
-        
-        messages.append({
+    position = decode_cursor(cursor, MessageCursor) if cursor else None
+    if position is not None and position.created_at is not None:
+        position.seq = (await session.exec(
+            select(ChatMessage.seq).where(ChatMessage.chat_id == chat.id, ChatMessage.id == position.id)
+        )).first()
+
+    # Messages written before seq was introduced have none until backfill_message_seq runs,
+    # they are older than numbered ones and ordered by id
+    query = select(ChatMessage).where(ChatMessage.chat_id == chat.id)
+    if position is None or position.direction == "before":
+        if position and position.seq is None:
+            query = query.where(col(ChatMessage.seq).is_(None), ChatMessage.id < position.id)
+        elif position:
+            query = query.where(or_(ChatMessage.seq < position.seq, col(ChatMessage.seq).is_(None)))
+        query = query.order_by(nullslast(col(ChatMessage.seq).desc()), col(ChatMessage.id).desc())
+    else:
+        if position.seq is None:
+            query = query.where(or_(col(ChatMessage.seq).is_not(None), ChatMessage.id > position.id))
+        else:
+            query = query.where(ChatMessage.seq > position.seq)
+        query = query.order_by(nullsfirst(col(ChatMessage.seq)), ChatMessage.id)
+
+    messages = (await session.exec(query.limit(limit + 1))).all()
+    watermarks = await summaries.get_read_watermarks(session, chat.id)
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if position and position.direction == "after":
+        messages.reverse()
+
+    items = [
+        {
             "id": message.id,
+            "seq": message.seq,
             "message": message.message,
             "created_at": message.created_at,
-            "from_customer_id": from_customer_id,
-            "to_customer_id": to_customer_id,
-            "is_viewed": message.is_viewed,
-        })
+            "from_customer_id": (
+                chat.from_customer_id if message.is_from_from_customer else chat.to_customer_id
+            ),
+            "to_customer_id": (
+                chat.to_customer_id if message.is_from_from_customer else chat.from_customer_id
+            ),
+            "is_viewed": message.id <= (
+                watermarks.get(
+                    chat.to_customer_id if message.is_from_from_customer else chat.from_customer_id
+                ) or 0
+            ),
+        }
+        for message in messages
+    ]
 
-    return paginate(sorted(messages, key = lambda item: item["created_at"], reverse=True))
+    has_older = has_more if position is None or position.direction == "before" else True
+    has_newer = position is not None and (position.direction == "before" or has_more)
+
+    next_cursor, prev_cursor = None, None
+    if messages and has_older:
+        next_cursor = encode_cursor(
+            MessageCursor(seq=messages[-1].seq, id=messages[-1].id, direction="before")
+        )
+    if messages and has_newer:
+        prev_cursor = encode_cursor(
+            MessageCursor(seq=messages[0].seq, id=messages[0].id, direction="after")
+        )
+
+    return {"items": items, "next_cursor": next_cursor, "prev_cursor": prev_cursor}
 
 
 @router.put(
@@ -83,24 +278,16 @@ async def get_chat(
 )
 async def view_chat_messages(
     with_customer_id: int,
-    session: Session = Depends(get_session),
-    customer: Customer = Depends(get_customer),
+    session: AsyncSession = Depends(get_session),
+    customer: CustomerIdentity = Depends(get_customer_identity),
     chat: Chat = Depends(get_chat),
 ):
     """
-    Mark all messages in a chat created after now as viewed
+    Mark all messages customer received in a chat as viewed
     """
 
-    now = datetime.datetime.now()
-    for message in chat.messages:
-        to_customer = (
-            (message.is_from_from_customer and chat.from_customer_id != customer.id) or
-            (not message.is_from_from_customer and chat.from_customer_id == customer.id)
-        )
-        if to_customer and not message.is_viewed and message.created_at < now:
-            crud.chat_message.update(session, message, data={"is_viewed": True}, commit=False)
-
-    session.commit()
+    await summaries.mark_viewed(session, chat.id, customer.id)
+    await session.commit()
 
 
 @router.get(
@@ -110,64 +297,46 @@ async def view_chat_messages(
     status_code=200,
 )
 async def get_chats(
-    session: Session = Depends(get_session),
-    customer: Customer = Depends(get_customer),
+    params: Params = Depends(),
+    session: AsyncSession = Depends(get_session),
+    customer: CustomerIdentity = Depends(get_customer_identity),
 ):
     """
-    Get all customer's chats
+    Get all customer's chats, most recently active first
     """
 
-    chats = session.exec(
-        select(Chat)
-        .filter(
-            or_(
-                Chat.from_customer_id == customer.id,
-                Chat.to_customer_id == customer.id
-            ),
+    rows = (await session.exec(
+        select(ChatSummary, func.count().over())
+        .where(ChatSummary.customer_id == customer.id)
+        .order_by(
+            nullslast(col(ChatSummary.last_message_created_at).desc()),
+            col(ChatSummary.chat_id).desc(),
         )
-    ).unique().all()
-
-    res_chats = list()
-    for chat in chats:
-        with_customer, is_from_customer = chat.from_customer, True
-        if chat.from_customer_id == customer.id:
-            with_customer, is_from_customer = chat.to_customer, False
-
-        messages_sorted = sorted(chat.messages, key = lambda item: item.created_at, reverse=True)
-        last_message_text, last_message_sender_id, viewed_all_messages, last_message_created_at = None, None, None, None
-        last_message_data = dict()
-        if messages_sorted:
-            last_message = messages_sorted[0]
-            last_message_text = last_message.message
-            last_message_sender_id = last_message.is_from_from_customer and chat.from_customer_id or chat.to_customer_id
-            last_message_created_at = last_message.created_at
-            last_message_data = {
-                "last_message": last_message_text,
-                "last_message_sender_id": last_message_sender_id,
-                "last_message_created_at": last_message_created_at,
-            }
-
-            customer_messages = list(
-                filter(
-                    lambda x: (is_from_customer and x.is_from_from_customer) or
-                    (not is_from_customer and not x.is_from_from_customer),
-                    messages_sorted
-                )
-            )
-            if customer_messages:
-                viewed_all_messages = customer_messages[0].is_viewed
-
-        res_chats.append({
-            "id": chat.id,
-            "name": with_customer.name,
-            "with_customer_id": with_customer.id,
-            "viewed_all_messages": viewed_all_messages,
-            **last_message_data,
-        })
-
-    list_to_sort = [chat for chat in res_chats if chat.get("last_message_created_at")]
-    list_not_to_sort = [chat for chat in res_chats if not chat.get("last_message_created_at")]
-    sorted_list = sorted(list_to_sort, key = lambda item: item.get("last_message_created_at"), reverse=True)
-    return paginate(sorted_list + list_not_to_sort)
-
-    return paginate(sorted(res_chats, key = lambda item: item.get("last_message_created_at"), reverse=True))
+        .offset((params.page - 1) * params.size)
+        .limit(params.size)
+    )).all()
+
+    if rows:
+        total = rows[0][1]
+    else:
+        total = (await session.exec(
+            select(func.count()).select_from(ChatSummary).where(ChatSummary.customer_id == customer.id)
+        )).one()
+
+    items = [_chat_summary_data(summary) for summary, _ in rows]
+
+    return create_page(items, total, params)
+
+
+def _chat_summary_data(summary: ChatSummary) -> dict:
+    return {
+        "id": summary.chat_id,
+        "name": summary.with_customer_name,
+        "with_customer_id": summary.with_customer_id,
+        "last_message": summary.last_message,
+        "last_message_sender_id": summary.last_message_sender_id,
+        "last_message_created_at": summary.last_message_created_at,
+        "last_message_seq": summary.last_message_seq,
+        "viewed_all_messages": summary.viewed_all_messages,
+        "unread_count": summary.unread_count,
+    }
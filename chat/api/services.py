@@ -1,34 +1,89 @@
 import asyncio
 import async_timeout
-import crud
+import contextlib
 import json
+import logging
 import redis
 import os
+import uuid
 
+from enum import Enum
 from fastapi import WebSocket, WebSocketDisconnect
+from starlette import status
 from starlette.websockets import WebSocketDisconnect as s_WebSocketDisconnect
 from starlette.concurrency import run_until_first_complete
 from sqlalchemy import or_, and_
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload, load_only, contains_eager
-from sqlmodel import Session, select
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from typing import List, TYPE_CHECKING
 
+from chat import sequences, summaries
+from chat.cache import chat_lookup_cache
+from chat.writer import message_writer
 from config.db import redis_manager
 from config.settings import settings
-from core.api.deps import get_chat
-from models import Customer, ChatMessage
+from core.api.deps import CustomerIdentity, get_chat
+from core.ratelimit import ws_message_limiter
+from models import Chat, ChatMessage, Customer
+
+logger = logging.getLogger("ws")
+
+# Tags messages published by this process, so its own subscriptions can skip them
+WORKER_ID = uuid.uuid4().hex
+
+REPLAY_SEND_TIMEOUT = 10
+# Tells the client that missed messages were trimmed from the delivery log
+RESYNC_FRAME = json.dumps({"type": "resync"})
+
+CLIENT_MSG_ID_MAX_LENGTH = 64
+# Stored under a dedupe key while the first send of a client_msg_id is in progress
+SEND_PENDING = "pending"
+
+# KEYS: presence set of the recipient
+# ARGV: publishing worker id, channel, payload, heartbeat key prefix
+# Publishes only if another live worker holds a connection of the recipient, workers
+# whose heartbeat expired are dropped from the set. Returns number of subscribers
+# reached or -1 if nothing is published
+PUBLISH_TO_OTHER_WORKERS_SCRIPT = """
+local published = -1
+for _, worker_id in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    if worker_id ~= ARGV[1] then
+        if redis.call('EXISTS', ARGV[4] .. worker_id) == 0 then
+            redis.call('SREM', KEYS[1], worker_id)
+        elseif published == -1 then
+            published = redis.call('PUBLISH', ARGV[2], ARGV[3])
+        end
+    end
+end
+return published
+"""
+
+# KEYS: heartbeat key of the worker
+# ARGV: heartbeat ttl ms
+# Returns 1 if the previous heartbeat was still alive
+HEARTBEAT_SCRIPT = """
+local alive = redis.call('EXISTS', KEYS[1])
+redis.call('SET', KEYS[1], 1, 'PX', ARGV[1])
+return alive
+"""
+HEARTBEAT_KEY_PREFIX = "ws_worker_alive_"
 
 
 class WSWorker():
     channel_type = None
 
     @staticmethod
-    async def validate_message(session: Session, websocket: WebSocket, customer: Customer, message_str: str):
+    async def validate_message(session: AsyncSession, websocket: WebSocket, customer: CustomerIdentity, message_str: str):
         raise NotImplementedError("Override process_data method")
 
     @staticmethod
-    async def process_and_enhance_message(session: Session, websocket: WebSocket, customer: Customer, message_str: str):
+    async def process_and_enhance_message(session: AsyncSession, customer: CustomerIdentity, data: dict) -> tuple[dict, bool]:
+        """
+        Store the message and return its ack together with a flag telling if it is new,
+        retried messages are acked again but not delivered
+        """
         raise NotImplementedError("Override process_and_enhance_message method")
 
 
@@ -36,7 +91,7 @@ class ChatWorker(WSWorker):
     channel_type = 'chat'
 
     @staticmethod
-    async def validate_message(session: Session, websocket: WebSocket, customer: Customer, message_str: str):
+    async def validate_message(session: AsyncSession, websocket: WebSocket, customer: CustomerIdentity, message_str: str):
         try:
             data = json.loads(message_str)
         except Exception:
@@ -45,88 +100,633 @@ class ChatWorker(WSWorker):
         to_customer_id = data.get("to_customer_id")
         if not to_customer_id:
             return None, "No to_customer_id in data"
-        
+        try:
+            to_customer_id = int(to_customer_id)
+        except (TypeError, ValueError):
+            return None, "Invalid to_customer_id"
+
         message = data.get("message")
         if not message:
             return None, "No message in data"
 
-        chat = await get_chat(to_customer_id, session, customer)
-        if not chat:
-            chat = crud.chat.create(
-                session, {"from_customer_id": customer.id, "to_customer_id": to_customer_id}
-            )
+        client_msg_id = data.get("client_msg_id")
+        if client_msg_id is not None and (
+            not isinstance(client_msg_id, str) or not 0 < len(client_msg_id) <= CLIENT_MSG_ID_MAX_LENGTH
+        ):
+            return None, "Invalid client_msg_id"
+
+        cached_chat = await chat_lookup_cache.get(customer.id, to_customer_id)
+        if cached_chat:
+            chat_id, from_customer_id = cached_chat
+        else:
+            chat = await get_chat(to_customer_id, session, customer)
+            if not chat:
+                # Chat is started by the first message, only with another existing customer
+                recipient_exists = to_customer_id != customer.id and (await session.exec(
+                    select(Customer.id).where(Customer.id == to_customer_id)
+                )).first() is not None
+                if not recipient_exists:
+                    return None, "No chat found"
+                try:
+                    # Committed with the first message, cached by the next lookup after that
+                    chat = await summaries.create_chat(session, customer.id, to_customer_id)
+                except IntegrityError:
+                    # Recipient is deleted meanwhile
+                    await session.rollback()
+                    return None, "No chat found"
+            else:
+                await chat_lookup_cache.set(chat.id, chat.from_customer_id, chat.to_customer_id)
+            chat_id, from_customer_id = chat.id, chat.from_customer_id
 
         return {
-            "to_customer_id": int(to_customer_id),
+            "to_customer_id": to_customer_id,
             "message": message,
-            "is_from_from_customer": chat.from_customer_id == customer.id,
-            "chat_id": chat.id,
-
+            "is_from_from_customer": from_customer_id == customer.id,
+            "chat_id": chat_id,
+            "client_msg_id": client_msg_id,
         }, None
 
     @staticmethod
-    async def process_and_enhance_message(session: Session, customer: Customer, data: dict):
+    async def process_and_enhance_message(session: AsyncSession, customer: CustomerIdentity, data: dict) -> tuple[dict, bool]:
+        customer_id = customer.id
+        client_msg_id = data["client_msg_id"]
+
+        dedupe_key = None
+        if client_msg_id is not None:
+            dedupe_key = f"ws_sent_{data['chat_id']}_{customer_id}_{client_msg_id}"
+            if not await redis_manager.set_cache_value(
+                dedupe_key, SEND_PENDING, ttl=settings.WS_SEND_DEDUPE_TTL, nx=True
+            ):
+                ack_str = await redis_manager.get_cache_value(dedupe_key)
+                if ack_str is not None and ack_str.decode("utf-8") != SEND_PENDING:
+                    return json.loads(ack_str), False
+                # First send is still in progress or its worker died before storing the ack,
+                # the unique constraint decides
+
+        if settings.WS_WRITE_BATCHING:
+            # Read-only transaction of validation must not stay open while the batch is written
+            await session.commit()
+            chat_message, created = await message_writer.write(customer_id, data)
+        else:
+            chat_message, created = await ChatWorker._store_message(session, customer_id, data)
+
+        ack = ChatWorker._message_ack(chat_message, customer_id, data["to_customer_id"])
+        if dedupe_key is not None:
+            await redis_manager.set_cache_value(dedupe_key, json.dumps(ack), ttl=settings.WS_SEND_DEDUPE_TTL)
+        return ack, created
+
+    @staticmethod
+    async def _store_message(session: AsyncSession, customer_id: int, data: dict) -> tuple[ChatMessage, bool]:
         chat_message = ChatMessage(**data)
+        if data["client_msg_id"] is None:
+            chat_message.seq = await sequences.reserve_seq(session, data["chat_id"])
+            session.add(chat_message)
+            await session.flush()
+        else:
+            try:
+                # Savepoint keeps customer and the rest of the session usable after a conflict
+                async with session.begin_nested():
+                    chat_message.seq = await sequences.reserve_seq(session, data["chat_id"])
+                    session.add(chat_message)
+            except IntegrityError:
+                chat_message = (await session.exec(
+                    select(ChatMessage).where(
+                        ChatMessage.chat_id == data["chat_id"],
+                        ChatMessage.is_from_from_customer == data["is_from_from_customer"],
+                        ChatMessage.client_msg_id == data["client_msg_id"],
+                    )
+                )).one()
+                await session.commit()
+                return chat_message, False
 
-        session.add(chat_message)
-        session.commit()
+        await summaries.apply_message(session, chat_message, customer_id, data["to_customer_id"])
+        await session.commit()
+        return chat_message, True
 
+    @staticmethod
+    def _message_ack(chat_message: ChatMessage, from_customer_id: int, to_customer_id: int) -> dict:
         return {
-            "message": data["message"],
-            "to_customer_id": data["to_customer_id"],
+            "message": chat_message.message,
+            "to_customer_id": to_customer_id,
             "created_at": chat_message.created_at.isoformat(),
-            "from_customer_id": customer.id,
-            "id": chat_message.id
+            "from_customer_id": from_customer_id,
+            "id": chat_message.id,
+            "seq": chat_message.seq,
+            "client_msg_id": chat_message.client_msg_id,
         }
 
 
+class ErrorText(str):
+    """
+    Error reply queued for the writer, sent as plain text unlike JSON messages
+    """
+
+
+class OverflowPolicy(str, Enum):
+    DROP_OLDEST = "drop_oldest"
+    CLOSE = "close"
+    SPILL = "spill"
+
+
+class WSConnection():
+    """
+    Outbound side of a websocket
+
+    Messages are put into a bounded queue and sent by the connection's own writer task,
+    so a slow client never blocks delivery to other sockets of the worker
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        customer_id: int,
+        max_size: int | None = None,
+        overflow_policy: str | None = None,
+        live_buffer_size: int | None = None,
+    ):
+        self.websocket = websocket
+        self.customer_id = customer_id
+        self.connection_id = uuid.uuid4().hex
+        self.overflow_policy = OverflowPolicy(overflow_policy or settings.WS_SEND_QUEUE_OVERFLOW_POLICY)
+
+        self._queue: asyncio.Queue[str] = asyncio.Queue(maxsize=max_size or settings.WS_SEND_QUEUE_SIZE)
+        self._writer_task: asyncio.Task | None = None
+        self._close_task: asyncio.Task | None = None
+        self._spill_pending = 0
+        self._spill_in_flight = 0
+        self._live_buffer: list[str] | None = None
+        self._live_buffer_size = live_buffer_size or settings.WS_LIVE_BUFFER_SIZE
+        self._live_buffer_overflowed = False
+        self._closed = False
+
+        self.max_queue_depth = 0
+        self.sent = 0
+        self.dropped = 0
+        self.spilled = 0
+
+    @property
+    def spill_key(self) -> str:
+        # Every device of the customer has a backlog of its own
+        return f"ws_spill_{self.customer_id}_{self.connection_id}"
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "customer_id": self.customer_id,
+            "queue_depth": self._queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "spill_pending": self._spill_pending,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+        }
+
+    def start(self):
+        self._writer_task = asyncio.create_task(self._writer())
+
+    def pause(self):
+        """
+        Hold live messages back while missed ones are being replayed
+        """
+        self._live_buffer = list()
+
+    async def resume(self, last_delivery_id: str | None):
+        """
+        Send live messages held back by `pause`, skipping ones already replayed
+        """
+        live_buffer, self._live_buffer = self._live_buffer or [], None
+        if self._live_buffer_overflowed:
+            self._live_buffer_overflowed = False
+            await self._enqueue(RESYNC_FRAME)
+
+        for message_str in live_buffer:
+            delivery_id = json.loads(message_str).get("delivery_id")
+            if (
+                last_delivery_id and delivery_id and
+                stream_id_key(delivery_id) <= stream_id_key(last_delivery_id)
+            ):
+                continue
+            await self._enqueue(message_str)
+
+    async def send(self, message_str: str):
+        """
+        Queue message for the writer task, never waits for the client
+        """
+        if self._live_buffer is not None:
+            if len(self._live_buffer) >= self._live_buffer_size:
+                # Replay takes too long, held back messages are dropped and the client
+                # is told to resync instead
+                logger.warning(f"Live buffer of customer {self.customer_id} websocket overflowed")
+                self.dropped += len(self._live_buffer)
+                self._live_buffer.clear()
+                self._live_buffer_overflowed = True
+            self._live_buffer.append(message_str)
+            return
+
+        await self._enqueue(message_str)
+
+    async def send_error(self, err: str):
+        """
+        Queue error reply, so it doesn't interleave with a send of the writer task
+        """
+        await self._enqueue(ErrorText(err))
+
+    async def send_replayed(self, message_str: str):
+        """
+        Queue message read from the delivery log, live messages stay held back
+
+        Waits for room in the queue instead of applying overflow policy, since only
+        this connection's handshake is waiting on it
+        """
+        if self._closed:
+            return
+
+        try:
+            await asyncio.wait_for(self._queue.put(message_str), timeout=REPLAY_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Closing websocket of customer {self.customer_id} stuck on replay")
+            await self.close(code=status.WS_1013_TRY_AGAIN_LATER)
+
+    async def _enqueue(self, message_str: str):
+        if self._closed:
+            return
+
+        if self._spill_pending:
+            # Keep order, everything goes to the backlog until the writer catches up
+            return await self._spill_or_drop(message_str)
+
+        if self._queue.full():
+            if self.overflow_policy == OverflowPolicy.DROP_OLDEST:
+                self._queue.get_nowait()
+                self.dropped += 1
+            elif self.overflow_policy == OverflowPolicy.CLOSE:
+                # Called from the Redis listener too, which must not wait for the client
+                logger.warning(f"Closing slow websocket of customer {self.customer_id}")
+                self._closed = True
+                self._close_task = asyncio.create_task(self._shutdown(status.WS_1013_TRY_AGAIN_LATER))
+                return
+            else:
+                return await self._spill_or_drop(message_str)
+
+        self._queue.put_nowait(message_str)
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    async def close(self, code: int = status.WS_1000_NORMAL_CLOSURE):
+        if self._closed:
+            if self._close_task is not None:
+                await self._close_task
+            return
+        self._closed = True
+        await self._shutdown(code)
+
+    async def _shutdown(self, code: int):
+        if self._writer_task is not None and self._writer_task is not asyncio.current_task():
+            self._writer_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._writer_task
+
+        with contextlib.suppress(Exception):
+            await self.websocket.close(code=code)
+
+        if self.spilled:
+            with contextlib.suppress(Exception):
+                await redis_manager.delete_cache_value(self.spill_key)
+
+    async def _spill_or_drop(self, message_str: str):
+        # The backlog keeps plain strings, errors in it would be sent as JSON
+        if isinstance(message_str, ErrorText):
+            self.dropped += 1
+            return
+        await self._spill(message_str)
+
+    async def _spill(self, message_str: str):
+        self._spill_pending += 1
+        self._spill_in_flight += 1
+        self.spilled += 1
+        try:
+            await redis_manager.push_backlog(
+                self.spill_key,
+                message_str,
+                settings.WS_SPILL_BACKLOG_LIMIT,
+                settings.WS_SPILL_BACKLOG_TTL,
+            )
+        finally:
+            self._spill_in_flight -= 1
+
+    async def _writer(self):
+        try:
+            while True:
+                if self._queue.empty() and self._spill_pending:
+                    messages = await redis_manager.pop_backlog(self.spill_key, self._queue.maxsize)
+                    if not messages and self._spill_in_flight:
+                        await asyncio.sleep(0)
+                        continue
+
+                    # Backlog could have been trimmed or expired
+                    self._spill_pending = max(self._spill_pending - len(messages), 0) if messages else 0
+                    for message_str in messages:
+                        await self.websocket.send_json(message_str)
+                        self.sent += 1
+                    continue
+
+                message_str = await self._queue.get()
+                if isinstance(message_str, ErrorText):
+                    await self.websocket.send_text(message_str)
+                else:
+                    await self.websocket.send_json(message_str)
+                self.sent += 1
+        except (WebSocketDisconnect, s_WebSocketDisconnect, RuntimeError):
+            self._closed = True
+        except Exception:
+            # E.g. Redis is down while draining the backlog, the client reconnects and resumes
+            logger.exception(f"Writer of customer {self.customer_id} websocket failed")
+            await self.close(code=status.WS_1011_INTERNAL_ERROR)
+
+
 class WSManager():
+    # Process-local registry of open connections by customer id
+    connections: dict[int, set[WSConnection]] = dict()
+    # Presence sets this worker is in, joined again if its heartbeat lapsed
+    presence: set[str] = set()
+    # Serializes subscribe and unsubscribe of a customer, with number of holders
+    _subscription_locks: dict[int, tuple[asyncio.Lock, int]] = dict()
+    _heartbeat_task: asyncio.Task | None = None
+
+    @staticmethod
+    def stats() -> list[dict[str, int]]:
+        return [
+            connection.stats()
+            for customer_connections in WSManager.connections.values()
+            for connection in customer_connections
+        ]
+
+    @staticmethod
+    def register(connection: WSConnection):
+        WSManager.connections.setdefault(connection.customer_id, set()).add(connection)
+
+    @staticmethod
+    def unregister(connection: WSConnection):
+        customer_connections = WSManager.connections.get(connection.customer_id)
+        if customer_connections is None:
+            return
+
+        customer_connections.discard(connection)
+        if not customer_connections:
+            WSManager.connections.pop(connection.customer_id, None)
+
+    @staticmethod
+    async def deliver_local(customer_id: int, message_str: str) -> bool:
+        """
+        Hand message to customer's connections on this worker, if there are any
+        """
+        customer_connections = WSManager.connections.get(customer_id)
+        if not customer_connections:
+            return False
+
+        for connection in list(customer_connections):
+            await connection.send(message_str)
+        return True
+
+    @staticmethod
+    def _channel(worker: WSWorker, customer_id: int) -> str:
+        return f"ws_{worker.channel_type}_{customer_id}"
+
+    @staticmethod
+    def _presence_key(worker: WSWorker, customer_id: int) -> str:
+        return f"ws_presence_{worker.channel_type}_{customer_id}"
+
+    @staticmethod
+    def _log_key(worker: WSWorker, customer_id: int) -> str:
+        return f"ws_log_{worker.channel_type}_{customer_id}"
+
+    @staticmethod
+    async def log_delivery(worker: WSWorker, customer_id: int, message: dict) -> str:
+        """
+        Append message to customer's delivery log and return it tagged with its log id
+        """
+        delivery_id = await redis_manager.append_to_log(
+            WSManager._log_key(worker, customer_id),
+            json.dumps(message),
+            settings.WS_DELIVERY_LOG_MAXLEN,
+            settings.WS_DELIVERY_LOG_TTL,
+        )
+        return json.dumps({**message, "delivery_id": delivery_id})
+
+    @staticmethod
+    async def replay(worker: WSWorker, connection: WSConnection, last_seen_id: str) -> str:
+        """
+        Send logged messages newer than `last_seen_id`, return id of the last one sent
+
+        The log is capped and expires, if `last_seen_id` is older than its first entry
+        messages in between may be lost, so a resync frame is sent before the rest
+        """
+        key = WSManager._log_key(worker, connection.customer_id)
+        first_id = await redis_manager.first_log_id(key)
+        if first_id is None or stream_id_key(first_id) > stream_id_key(last_seen_id):
+            await connection.send_replayed(RESYNC_FRAME)
+
+        while True:
+            entries = await redis_manager.read_log(key, last_seen_id, settings.WS_DELIVERY_LOG_REPLAY_BATCH)
+            for delivery_id, message_str in entries:
+                await connection.send_replayed(
+                    json.dumps({**json.loads(message_str), "delivery_id": delivery_id})
+                )
+                last_seen_id = delivery_id
+
+            if len(entries) < settings.WS_DELIVERY_LOG_REPLAY_BATCH:
+                return last_seen_id
+
+    @staticmethod
+    async def publish(worker: WSWorker, customer_id: int, message_str: str):
+        """
+        Publish message to customer's connections on other workers, if there are any
+        """
+        await redis_manager.run_script(
+            PUBLISH_TO_OTHER_WORKERS_SCRIPT,
+            keys=[WSManager._presence_key(worker, customer_id)],
+            args=[
+                WORKER_ID,
+                WSManager._channel(worker, customer_id),
+                f"{WORKER_ID}:{message_str}",
+                HEARTBEAT_KEY_PREFIX,
+            ],
+        )
+
+    @staticmethod
+    async def heartbeat() -> bool:
+        """
+        Keep this worker's heartbeat key alive, rejoin presence sets if it has lapsed
+
+        Publishers drop workers without a heartbeat from presence sets, so a worker
+        that dies stops receiving publishes once its key expires
+        """
+        alive = await redis_manager.run_script(
+            HEARTBEAT_SCRIPT,
+            keys=[f"{HEARTBEAT_KEY_PREFIX}{WORKER_ID}"],
+            args=[int(settings.WS_WORKER_HEARTBEAT_TTL.total_seconds() * 1000)],
+        )
+        if not alive:
+            for presence_key in list(WSManager.presence):
+                await redis_manager.add_to_set(presence_key, WORKER_ID)
+        return bool(alive)
+
     @staticmethod
-    async def run(worker: WSWorker, session: Session, websocket: WebSocket, customer: Customer):
+    async def _heartbeat_loop():
+        interval = settings.WS_WORKER_HEARTBEAT_TTL.total_seconds() / 3
+        while True:
+            try:
+                await WSManager.heartbeat()
+            except Exception:
+                logger.exception("Failed to refresh worker heartbeat")
+                await asyncio.sleep(settings.REDIS_RECONNECT_DELAY)
+                continue
+            await asyncio.sleep(interval)
+
+    @staticmethod
+    async def start():
+        WSManager._heartbeat_task = asyncio.create_task(WSManager._heartbeat_loop())
+
+    @staticmethod
+    async def stop():
+        task, WSManager._heartbeat_task = WSManager._heartbeat_task, None
+        if task is None:
+            return
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+    @staticmethod
+    @contextlib.asynccontextmanager
+    async def _subscription_lock(customer_id: int):
+        lock, holders = WSManager._subscription_locks.get(customer_id, (asyncio.Lock(), 0))
+        WSManager._subscription_locks[customer_id] = (lock, holders + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, holders = WSManager._subscription_locks[customer_id]
+            if holders == 1:
+                del WSManager._subscription_locks[customer_id]
+            else:
+                WSManager._subscription_locks[customer_id] = (lock, holders - 1)
+
+    @staticmethod
+    async def subscribe(worker: WSWorker, connection: WSConnection):
+        """
+        Register connection, Redis subscription is shared by all local connections of a customer
+
+        Workers holding connections of a customer are kept in a presence set, so messages
+        are published only when another worker needs them. Subscribe and unsubscribe of
+        a customer run one at a time, so the last connection leaving can't undo the
+        subscription of a new one
+        """
+        customer_id = connection.customer_id
+        WSManager.register(connection)
+        presence_key = WSManager._presence_key(worker, customer_id)
+
+        async def callback(payload: str):
+            origin, message_str = payload.split(":", 1)
+            # Local connections already got messages published by this worker
+            if origin != WORKER_ID:
+                await WSManager.deliver_local(customer_id, message_str)
+
+        async with WSManager._subscription_lock(customer_id):
+            if presence_key in WSManager.presence or not WSManager.connections.get(customer_id):
+                return
+            # Joins presence first, a message published meanwhile is in the delivery log
+            await redis_manager.add_to_set(presence_key, WORKER_ID)
+            await redis_manager.subscribe(WSManager._channel(worker, customer_id), callback)
+            WSManager.presence.add(presence_key)
+
+    @staticmethod
+    async def unsubscribe(worker: WSWorker, connection: WSConnection):
+        customer_id = connection.customer_id
+        WSManager.unregister(connection)
+        presence_key = WSManager._presence_key(worker, customer_id)
+
+        async with WSManager._subscription_lock(customer_id):
+            if presence_key not in WSManager.presence or WSManager.connections.get(customer_id):
+                return
+            WSManager.presence.discard(presence_key)
+            await redis_manager.unsubscribe(WSManager._channel(worker, customer_id))
+            await redis_manager.remove_from_set(presence_key, WORKER_ID)
+
+    @staticmethod
+    async def run(
+        worker: WSWorker,
+        session: AsyncSession,
+        websocket: WebSocket,
+        customer: CustomerIdentity,
+        last_seen_id: str | None = None,
+    ):
         await websocket.accept()
 
-        async def callback(message_str):
-            await websocket.send_json(message_str)
+        connection = WSConnection(websocket, customer.id)
+        connection.start()
 
-        channel = f"ws_{worker.channel_type}_{customer.id}"
-        await redis_manager.subscribe(channel, callback)
+        if last_seen_id:
+            # Subscribe before reading the log, so nothing falls between replay and live delivery
+            connection.pause()
+            await WSManager.subscribe(worker, connection)
+            await connection.resume(await WSManager.replay(worker, connection, last_seen_id))
+        else:
+            await WSManager.subscribe(worker, connection)
 
-        await WSManager.ws_receiver(worker, session, websocket, customer)
-        
-        await redis_manager.unsubscribe(channel)
+        try:
+            await WSManager.ws_receiver(worker, session, connection, customer)
+        finally:
+            await WSManager.unsubscribe(worker, connection)
+            await connection.close()
 
     @staticmethod
-    async def ws_receiver(worker: WSWorker, session: Session, websocket: WebSocket, customer: Customer):
+    async def ws_receiver(worker: WSWorker, session: AsyncSession, connection: WSConnection, customer: CustomerIdentity):
+        websocket = connection.websocket
         async for message_str in websocket.iter_json():
+            if await ws_message_limiter.acquire(str(customer.id)):
+                await ws_error(connection, "Too many messages", close_ws=False)
+                continue
+
             data, err = await worker.validate_message(session, websocket, customer, message_str)
             if err:
-                await ws_error(websocket, err, close_ws=False)
+                await ws_error(connection, err, close_ws=False)
                 continue               
 
-            res_message = await worker.process_and_enhance_message(session, customer, data)
+            try:
+                res_message, created = await worker.process_and_enhance_message(session, customer, data)
+            except Exception:
+                # Only this message is lost, the connection keeps working
+                logger.exception(f"Failed to store a message of customer {customer.id}")
+                await session.rollback()
+                await ws_error(connection, "Message is not stored", close_ws=False)
+                continue
 
-            await websocket.send_json(json.dumps(res_message))
-            
-            channel = f"ws_{worker.channel_type}_{data['to_customer_id']}"
-            await redis_manager.publish(channel, json.dumps(res_message))
+            await connection.send(json.dumps(res_message))
+            if not created:
+                continue
 
-    @staticmethod
-    async def ws_sender(worker: WSWorker, session: Session, websocket: WebSocket, customer: Customer):
-        while True:
-            try:
-                async with async_timeout.timeout(1):
-                    message = await redis_manager.get_message()
-                    if message is not None:
-                        message_str = message["data"].decode("utf-8")
-                        if message_str == STOPWORD:
-                            break
-                        await websocket.send_json(message_str)
-                    await asyncio.sleep(0.01)
-            except asyncio.TimeoutError:
-                pass
-
-
-async def ws_error(websocket: WebSocket, err: str, close_ws: bool=True):
-    await websocket.send_text(err)
+            delivery_str = await WSManager.log_delivery(worker, data["to_customer_id"], res_message)
+
+            # Local devices get the message right away, it is published only if other
+            # devices of the recipient are connected to other workers
+            await WSManager.deliver_local(data["to_customer_id"], delivery_str)
+            await WSManager.publish(worker, data["to_customer_id"], delivery_str)
+
+
+def stream_id_key(stream_id: str) -> tuple[int, int]:
+    milliseconds, sequence = stream_id.split("-")
+    return int(milliseconds), int(sequence)
+
+
+async def ws_error(websocket: WebSocket | WSConnection, err: str, close_ws: bool=True):
+    """
+    Send error text, through the connection's queue once its writer task is running
+    """
+    if isinstance(websocket, WSConnection):
+        await websocket.send_error(err)
+    else:
+        await websocket.send_text(err)
     if close_ws:
         await websocket.close()
@@ -0,0 +1,147 @@
+import asyncio
+
+from collections import OrderedDict
+from typing import Iterable
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, object_session
+
+from config.db import redis_manager
+from config.settings import settings
+from models import Chat
+
+INVALIDATE_CHANNEL = "chat_lookup_invalidate"
+
+
+class ChatLookupCache():
+    """
+    Chat id and orientation (from_customer_id) by unordered pair of customers
+
+    Process local LRU, optionally backed by Redis shared between workers. Only existing
+    chats are cached, so creating a chat needs no invalidation, deleted chats are evicted
+    from every worker through a pub/sub broadcast. Chats deleted through the ORM are
+    evicted on commit, code deleting them with bulk or raw statements must call
+    `invalidate_on_commit`, ids of deleted chats must never be served
+    """
+
+    def __init__(self, max_size: int | None = None, use_redis: bool | None = None):
+        self.max_size = max_size or settings.CHAT_LOOKUP_CACHE_SIZE
+        self.use_redis = settings.CHAT_LOOKUP_CACHE_REDIS if use_redis is None else use_redis
+
+        self._chats: OrderedDict[tuple[int, int], tuple[int, int]] = OrderedDict()
+
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._chats),
+            "hits": self.hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+        }
+
+    @staticmethod
+    def _pair(customer_id: int, with_customer_id: int) -> tuple[int, int]:
+        return min(customer_id, with_customer_id), max(customer_id, with_customer_id)
+
+    @staticmethod
+    def _redis_key(pair: tuple[int, int]) -> str:
+        return f"chat_pair_{pair[0]}_{pair[1]}"
+
+    async def connect(self):
+        await redis_manager.subscribe(INVALIDATE_CHANNEL, self._on_invalidate)
+
+    async def get(self, customer_id: int, with_customer_id: int) -> tuple[int, int] | None:
+        """
+        Return `(chat_id, from_customer_id)` of the customers' chat if it is cached
+        """
+        pair = self._pair(customer_id, with_customer_id)
+        chat = self._chats.get(pair)
+        if chat is not None:
+            self._chats.move_to_end(pair)
+            self.hits += 1
+            return chat
+
+        if self.use_redis:
+            value = await redis_manager.get_cache_value(self._redis_key(pair))
+            if value is not None:
+                chat_id, from_customer_id = value.decode("utf-8").split(":")
+                chat = int(chat_id), int(from_customer_id)
+                self._set_local(pair, chat)
+                self.redis_hits += 1
+                return chat
+
+        self.misses += 1
+        return None
+
+    async def set(self, chat_id: int, from_customer_id: int, to_customer_id: int):
+        pair = self._pair(from_customer_id, to_customer_id)
+        self._set_local(pair, (chat_id, from_customer_id))
+        if self.use_redis:
+            await redis_manager.set_cache_value(
+                self._redis_key(pair), f"{chat_id}:{from_customer_id}", ttl=settings.CHAT_LOOKUP_CACHE_TTL
+            )
+
+    async def invalidate(self, customer_id: int, with_customer_id: int):
+        pair = self._pair(customer_id, with_customer_id)
+        self.evict_local(pair)
+        if self.use_redis:
+            await redis_manager.delete_cache_value(self._redis_key(pair))
+        await redis_manager.publish(INVALIDATE_CHANNEL, f"{pair[0]}:{pair[1]}")
+
+    def evict_local(self, pair: tuple[int, int]):
+        self._chats.pop(pair, None)
+
+    def _set_local(self, pair: tuple[int, int], chat: tuple[int, int]):
+        self._chats[pair] = chat
+        self._chats.move_to_end(pair)
+        while len(self._chats) > self.max_size:
+            self._chats.popitem(last=False)
+
+    async def _on_invalidate(self, payload: str):
+        low, high = payload.split(":")
+        self.evict_local((int(low), int(high)))
+
+
+chat_lookup_cache = ChatLookupCache()
+_invalidations: set[asyncio.Task] = set()
+
+
+def invalidate_on_commit(session: Session | AsyncSession, pairs: Iterable[tuple[int, int]]):
+    """
+    Evict chats of the `(customer_id, with_customer_id)` pairs from every worker once
+    the session commits, for chats deleted or replaced with bulk or raw statements
+    """
+    session.info.setdefault("deleted_chat_pairs", set()).update(
+        ChatLookupCache._pair(*pair) for pair in pairs
+    )
+
+
+@event.listens_for(Chat, "after_delete")
+def _chat_deleted(mapper, connection, target: Chat):
+    session = object_session(target)
+    if session is not None:
+        invalidate_on_commit(session, [(target.from_customer_id, target.to_customer_id)])
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_deleted_chats(session: Session):
+    for pair in session.info.pop("deleted_chat_pairs", ()):
+        chat_lookup_cache.evict_local(pair)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Sync session outside of the app, e.g. a script, has no other workers to notify
+            continue
+        task = loop.create_task(chat_lookup_cache.invalidate(*pair))
+        _invalidations.add(task)
+        task.add_done_callback(_invalidations.discard)
+
+
+async def wait_for_invalidations():
+    """
+    Wait until evictions scheduled by commits reach Redis, e.g. before a script exits
+    """
+    await asyncio.gather(*_invalidations, return_exceptions=True)
@@ -1,10 +1,11 @@
 from datetime import datetime
 from pydantic import BaseModel, validator, Field
-from typing import Any, Optional
+from typing import Any, Literal, Optional
 
 
 class ChatMessageSchema(BaseModel):
     id: int
+    seq: Optional[int]
     message: str
     from_customer_id: int
     to_customer_id: int
@@ -23,4 +24,45 @@ class ChatSchema(BaseModel):
     last_message: Optional[str]
     last_message_sender_id: Optional[int]
     last_message_created_at: Optional[datetime]
+    last_message_seq: Optional[int]
     viewed_all_messages: Optional[bool]
+    unread_count: int = 0
+
+
+class ReadStateSchema(BaseModel):
+    chat_id: int
+    customer_id: int
+    last_read_message_id: Optional[int]
+
+
+class SyncSchema(BaseModel):
+    messages: list[ChatMessageSchema]
+    chats: list[ChatSchema]
+    read_states: list[ReadStateSchema]
+    cursor: str
+    has_more: bool
+
+
+class MessageCursor(BaseModel):
+    """
+    Position of a message in its chat, `before` cursors point to older messages.
+    Messages not numbered yet have no `seq` and are positioned by `id`. Cursors issued
+    before seq carry `created_at` instead, their message's seq is looked up
+    """
+
+    seq: Optional[int]
+    id: int = 0
+    direction: Literal["before", "after"] = "before"
+    created_at: Optional[datetime] = None
+
+
+class SyncCursor(BaseModel):
+    """
+    Changes since `updated_at`, pages resume after the row at `changed_at` and the ids
+    """
+
+    updated_at: datetime
+    changed_at: Optional[datetime] = None
+    chat_id: int = 0
+    customer_id: int = 0
+    message_id: int = 0
@@ -0,0 +1,92 @@
+from sqlalchemy import bindparam, text, update
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from models import Chat, ChatMessage
+
+
+async def reserve_seq(session: AsyncSession, chat_id: int, count: int = 1) -> int:
+    """
+    Reserve `count` consecutive message seqs in a chat and return the first one
+
+    The chat row stays locked until the transaction ends, so messages of one chat
+    are committed in seq order and seqs have no gaps
+    """
+    last_seq = (await session.execute(
+        update(Chat)
+        .where(Chat.id == chat_id)
+        .values(last_seq=Chat.last_seq + count)
+        .returning(Chat.last_seq)
+    )).scalar_one()
+    return last_seq - count + 1
+
+
+async def backfill_message_seq(session: AsyncSession, batch_size: int = 1000) -> int:
+    """
+    Number messages written before seq was introduced, oldest first, return the number
+    of chats numbered
+
+    Safe to run while new messages are written. Chats are locked like reserve_seq does
+    and processed in batches of `batch_size`, each batch is committed separately. Legacy
+    messages of a chat that already has numbered messages get seqs right below the
+    first of them, possibly zero or negative, so they stay older and no seq a client has
+    seen changes. Chats without numbered messages are numbered from 1
+    """
+    numbered = 0
+    last_chat_id = 0
+
+    while True:
+        chat_ids = (await session.exec(
+            select(Chat.id)
+            .where(
+                Chat.id > last_chat_id,
+                col(Chat.id).in_(select(ChatMessage.chat_id).where(col(ChatMessage.seq).is_(None))),
+            )
+            .order_by(Chat.id)
+            .limit(batch_size)
+            .with_for_update()
+        )).all()
+        if not chat_ids:
+            return numbered
+
+        # Chats are locked by the statement above, so seqs read here can't change meanwhile
+        await session.execute(
+            text(
+                """
+                WITH legacy AS (
+                    SELECT
+                        m.id,
+                        m.chat_id,
+                        row_number() OVER (PARTITION BY m.chat_id ORDER BY m.created_at, m.id) AS position,
+                        count(*) OVER (PARTITION BY m.chat_id) AS legacy_count
+                    FROM chat_messages AS m
+                    WHERE m.chat_id IN :chat_ids AND m.seq IS NULL
+                ), first AS (
+                    SELECT chat_id, min(seq) AS first_seq
+                    FROM chat_messages
+                    WHERE chat_id IN :chat_ids AND seq IS NOT NULL
+                    GROUP BY chat_id
+                ), updated AS (
+                    UPDATE chat_messages AS m
+                    SET seq = CASE
+                        WHEN f.first_seq IS NULL THEN c.last_seq + l.position
+                        ELSE f.first_seq - l.legacy_count + l.position - 1
+                    END
+                    FROM legacy AS l
+                    JOIN chats AS c ON c.id = l.chat_id
+                    LEFT JOIN first AS f ON f.chat_id = l.chat_id
+                    WHERE m.id = l.id
+                    RETURNING m.chat_id, m.seq
+                )
+                UPDATE chats AS c
+                SET last_seq = u.last_seq
+                FROM (SELECT chat_id, max(seq) AS last_seq FROM updated GROUP BY chat_id) AS u
+                WHERE c.id = u.chat_id AND u.last_seq > c.last_seq
+                """
+            ).bindparams(bindparam("chat_ids", expanding=True)),
+            {"chat_ids": list(chat_ids)},
+        )
+        await session.commit()
+
+        numbered += len(chat_ids)
+        last_chat_id = chat_ids[-1]
@@ -0,0 +1,403 @@
+from datetime import datetime
+from sqlalchemy import and_, case, delete, event, func, inspect, text, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import select, col
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from chat.cache import invalidate_on_commit
+from models import Chat, ChatMessage, ChatSummary, Customer
+
+
+async def create_chat(session: AsyncSession, from_customer_id: int, to_customer_id: int) -> Chat:
+    """
+    Create a chat with its inbox rows, or return the pair's existing chat. The caller
+    commits, usually together with the chat's first message
+
+    Safe to race, a concurrent creation of the same pair waits on the unique index
+    and gets the chat created first
+    """
+    chat = (await session.exec(
+        select(Chat)
+        .from_statement(
+            insert(Chat)
+            .values(from_customer_id=from_customer_id, to_customer_id=to_customer_id, last_seq=0)
+            .on_conflict_do_update(
+                index_elements=["low_customer_id", "high_customer_id"],
+                # No-op update, so the existing row is returned
+                set_={"from_customer_id": Chat.__table__.c.from_customer_id},
+            )
+            .returning(*Chat.__table__.columns)
+        )
+        .execution_options(populate_existing=True)
+    )).one()
+    await create_chat_summaries(session, chat)
+    return chat
+
+
+async def create_chat_summaries(session: AsyncSession, chat: Chat) -> None:
+    """
+    Add inbox rows for both participants of a chat, existing rows are kept
+    """
+    customer_ids = (chat.from_customer_id, chat.to_customer_id)
+    names = dict(
+        (await session.exec(
+            select(Customer.id, Customer.name).where(col(Customer.id).in_(customer_ids))
+        )).all()
+    )
+
+    await session.execute(
+        insert(ChatSummary)
+        .values([
+            {
+                "chat_id": chat.id,
+                "customer_id": customer_id,
+                "with_customer_id": with_customer_id,
+                "with_customer_name": names[with_customer_id],
+                "unread_count": 0,
+                "created_at": datetime.utcnow(),
+            }
+            for customer_id, with_customer_id in (customer_ids, customer_ids[::-1])
+        ])
+        .on_conflict_do_nothing()
+    )
+
+
+async def apply_message(
+    session: AsyncSession, chat_message: ChatMessage, from_customer_id: int, to_customer_id: int
+) -> None:
+    """
+    Move new message into both participants' inbox rows, must be called before commit
+    """
+    await apply_messages(session, [(chat_message, from_customer_id, to_customer_id)])
+
+
+async def apply_messages(session: AsyncSession, messages: list[tuple[ChatMessage, int, int]]) -> None:
+    """
+    Same as `apply_message` for a batch of `(chat_message, from_customer_id, to_customer_id)`,
+    inbox rows of each chat are updated once, in chat id order like the chat rows are
+    locked, so concurrent batches can't deadlock
+    """
+    messages_by_chat: dict[int, list[tuple[ChatMessage, int, int]]] = dict()
+    for item in messages:
+        messages_by_chat.setdefault(item[0].chat_id, list()).append(item)
+
+    for chat_id in sorted(messages_by_chat):
+        chat_messages = messages_by_chat[chat_id]
+        last_message, last_sender_id, _ = max(chat_messages, key=lambda item: item[0].seq)
+        received: dict[int, tuple[int, int]] = dict()
+        for chat_message, _, to_customer_id in chat_messages:
+            count, last_id = received.get(to_customer_id, (0, 0))
+            received[to_customer_id] = (count + 1, max(last_id, chat_message.id))
+
+        await session.execute(
+            update(ChatSummary)
+            .where(ChatSummary.chat_id == chat_id)
+            .values(
+                last_message=last_message.message,
+                last_message_sender_id=last_sender_id,
+                last_message_created_at=last_message.created_at,
+                last_message_seq=last_message.seq,
+                last_received_message_id=case(
+                    *[
+                        (ChatSummary.customer_id == customer_id, last_id)
+                        for customer_id, (_, last_id) in received.items()
+                    ],
+                    else_=ChatSummary.last_received_message_id,
+                ),
+                unread_count=case(
+                    *[
+                        (ChatSummary.customer_id == customer_id, ChatSummary.unread_count + count)
+                        for customer_id, (count, _) in received.items()
+                    ],
+                    else_=ChatSummary.unread_count,
+                ),
+            )
+        )
+
+
+async def mark_viewed(session: AsyncSession, chat_id: int, customer_id: int) -> None:
+    """
+    Move participant's read watermark to the last message they received
+    """
+    await session.execute(
+        update(ChatSummary)
+        .where(ChatSummary.chat_id == chat_id, ChatSummary.customer_id == customer_id)
+        .values(last_read_message_id=ChatSummary.last_received_message_id, unread_count=0)
+    )
+
+
+async def get_read_watermarks(session: AsyncSession, chat_id: int) -> dict[int, int | None]:
+    """
+    Return last read message id for each participant of the chat
+    """
+    return dict(
+        (await session.exec(
+            select(ChatSummary.customer_id, ChatSummary.last_read_message_id)
+            .where(ChatSummary.chat_id == chat_id)
+        )).all()
+    )
+
+
+async def rebuild_chat_summaries(session: AsyncSession, batch_size: int = 1000) -> int:
+    """
+    Recompute inbox rows for every chat from its messages, keeping read watermarks
+
+    Chats are processed in batches of `batch_size`, each batch is committed separately
+    """
+    rebuilt = 0
+    last_chat_id = 0
+
+    while True:
+        chats = (await session.exec(
+            select(Chat).where(Chat.id > last_chat_id).order_by(Chat.id).limit(batch_size)
+        )).all()
+        if not chats:
+            break
+
+        chat_ids = [chat.id for chat in chats]
+        last_messages = {
+            message.chat_id: message
+            for message in (await session.exec(
+                select(ChatMessage)
+                .where(col(ChatMessage.chat_id).in_(chat_ids))
+                .distinct(ChatMessage.chat_id)
+                .order_by(ChatMessage.chat_id, col(ChatMessage.seq).desc().nullslast())
+            )).all()
+        }
+        recipient_id = case(
+            (ChatMessage.is_from_from_customer, Chat.to_customer_id), else_=Chat.from_customer_id
+        )
+        received = {
+            (chat_id, is_from_from_customer): (unread_count, last_id)
+            for chat_id, is_from_from_customer, unread_count, last_id in (await session.exec(
+                select(
+                    ChatMessage.chat_id,
+                    ChatMessage.is_from_from_customer,
+                    func.count().filter(
+                        ChatMessage.id > func.coalesce(ChatSummary.last_read_message_id, 0)
+                    ),
+                    func.max(ChatMessage.id),
+                )
+                .join(Chat, Chat.id == ChatMessage.chat_id)
+                .outerjoin(
+                    ChatSummary,
+                    and_(
+                        ChatSummary.chat_id == ChatMessage.chat_id,
+                        ChatSummary.customer_id == recipient_id,
+                    ),
+                )
+                .where(col(ChatMessage.chat_id).in_(chat_ids))
+                .group_by(ChatMessage.chat_id, ChatMessage.is_from_from_customer)
+            )).all()
+        }
+        watermarks = {
+            (chat_id, customer_id): last_read_message_id
+            for chat_id, customer_id, last_read_message_id in (await session.exec(
+                select(ChatSummary.chat_id, ChatSummary.customer_id, ChatSummary.last_read_message_id)
+                .where(col(ChatSummary.chat_id).in_(chat_ids))
+            )).all()
+        }
+        customer_ids = {chat.from_customer_id for chat in chats} | {chat.to_customer_id for chat in chats}
+        names = dict(
+            (await session.exec(
+                select(Customer.id, Customer.name).where(col(Customer.id).in_(customer_ids))
+            )).all()
+        )
+
+        await session.execute(delete(ChatSummary).where(col(ChatSummary.chat_id).in_(chat_ids)))
+        for chat in chats:
+            last_message = last_messages.get(chat.id)
+            last_message_data = dict()
+            if last_message:
+                last_message_data = {
+                    "last_message": last_message.message,
+                    "last_message_sender_id": (
+                        chat.from_customer_id if last_message.is_from_from_customer else chat.to_customer_id
+                    ),
+                    "last_message_created_at": last_message.created_at,
+                    "last_message_seq": last_message.seq,
+                }
+
+            # Messages received by from_customer are the ones not sent by from_customer
+            sides = (
+                (chat.from_customer_id, chat.to_customer_id, False),
+                (chat.to_customer_id, chat.from_customer_id, True),
+            )
+            for customer_id, with_customer_id, is_from_from_customer in sides:
+                unread_count, last_received_message_id = received.get(
+                    (chat.id, is_from_from_customer), (0, None)
+                )
+                session.add(
+                    ChatSummary(
+                        chat_id=chat.id,
+                        customer_id=customer_id,
+                        with_customer_id=with_customer_id,
+                        with_customer_name=names[with_customer_id],
+                        last_received_message_id=last_received_message_id,
+                        last_read_message_id=watermarks.get((chat.id, customer_id)),
+                        unread_count=unread_count,
+                        **last_message_data,
+                    )
+                )
+
+        await session.commit()
+        rebuilt += len(chats)
+        last_chat_id = chat_ids[-1]
+
+    return rebuilt
+
+
+async def backfill_read_watermarks(session: AsyncSession) -> None:
+    """
+    Derive read watermarks from legacy `chat_messages.is_viewed` flags
+
+    Has to run once after the deploy and before the column is dropped, watermarks already
+    moved further are kept. Summaries must already exist, rebuild them afterwards to
+    recount unread messages
+    """
+    await session.execute(
+        text(
+            """
+            UPDATE chat_summaries AS s
+            SET
+                last_read_message_id = GREATEST(s.last_read_message_id, v.last_viewed_id),
+                changed_at = timezone('utc', now())
+            FROM (
+                SELECT
+                    m.chat_id,
+                    CASE WHEN m.is_from_from_customer THEN c.to_customer_id ELSE c.from_customer_id END
+                        AS customer_id,
+                    max(m.id) AS last_viewed_id
+                FROM chat_messages AS m
+                JOIN chats AS c ON c.id = m.chat_id
+                WHERE m.is_viewed
+                GROUP BY 1, 2
+            ) AS v
+            WHERE s.chat_id = v.chat_id AND s.customer_id = v.customer_id
+            """
+        )
+    )
+    await session.commit()
+
+
+async def merge_duplicate_chats(session: AsyncSession) -> None:
+    """
+    Move messages of duplicate chats of a customer pair into the pair's oldest chat
+    and delete the duplicates, so the unique customer pair index can be created
+
+    Messages of a merged chat are renumbered by creation time and read watermarks are
+    remapped, so no message unread in its own chat becomes read. Rebuild summaries
+    afterwards to recount unread messages
+    """
+    pairs = """
+        SELECT
+            c.id,
+            c.from_customer_id,
+            min(c.id) OVER pair AS keep_id,
+            count(*) OVER pair AS chats
+        FROM chats AS c
+        WINDOW pair AS (
+            PARTITION BY
+                LEAST(c.from_customer_id, c.to_customer_id),
+                GREATEST(c.from_customer_id, c.to_customer_id)
+        )
+    """
+    # A merged watermark covers received messages up to the first one left unread in any
+    # of the pair's chats, so nothing unread is marked as read
+    await session.execute(
+        text(
+            f"""
+            WITH pairs AS ({pairs}), received AS (
+                SELECT
+                    p.keep_id,
+                    s.customer_id,
+                    m.id,
+                    m.id <= coalesce(s.last_read_message_id, 0) AS is_read
+                FROM chat_messages AS m
+                JOIN pairs AS p ON p.id = m.chat_id
+                JOIN chats AS c ON c.id = m.chat_id
+                JOIN chat_summaries AS s ON s.chat_id = m.chat_id AND s.customer_id = CASE
+                    WHEN m.is_from_from_customer THEN c.to_customer_id
+                    ELSE c.from_customer_id
+                END
+                WHERE p.chats > 1
+            ), first_unread AS (
+                SELECT keep_id, customer_id, min(id) FILTER (WHERE NOT is_read) AS message_id
+                FROM received
+                GROUP BY 1, 2
+            )
+            UPDATE chat_summaries AS k
+            SET last_read_message_id = (
+                SELECT max(r.id)
+                FROM received AS r
+                WHERE
+                    r.keep_id = f.keep_id
+                    AND r.customer_id = f.customer_id
+                    AND (f.message_id IS NULL OR r.id < f.message_id)
+            ),
+            changed_at = timezone('utc', now())
+            FROM first_unread AS f
+            WHERE k.chat_id = f.keep_id AND k.customer_id = f.customer_id
+            """
+        )
+    )
+    # Seqs are cleared while messages are moved, so they never collide with the ones not
+    # updated yet in the unique index, then merged chats are numbered from 1
+    await session.execute(
+        text(
+            f"""
+            WITH pairs AS ({pairs})
+            UPDATE chat_messages AS m
+            SET
+                chat_id = p.keep_id,
+                is_from_from_customer = CASE
+                    WHEN p.from_customer_id = k.from_customer_id THEN m.is_from_from_customer
+                    ELSE NOT m.is_from_from_customer
+                END,
+                seq = NULL
+            FROM pairs AS p
+            JOIN chats AS k ON k.id = p.keep_id
+            WHERE m.chat_id = p.id AND p.chats > 1
+            """
+        )
+    )
+    await session.execute(
+        text(
+            f"""
+            WITH pairs AS ({pairs}), numbered AS (
+                SELECT m.id, row_number() OVER (PARTITION BY m.chat_id ORDER BY m.created_at, m.id) AS seq
+                FROM chat_messages AS m
+                WHERE m.chat_id IN (SELECT keep_id FROM pairs WHERE chats > 1)
+            ), renumbered AS (
+                UPDATE chat_messages AS m
+                SET seq = n.seq
+                FROM numbered AS n
+                WHERE m.id = n.id
+                RETURNING m.chat_id, m.seq
+            )
+            UPDATE chats AS c
+            SET last_seq = r.last_seq
+            FROM (SELECT chat_id, max(seq) AS last_seq FROM renumbered GROUP BY chat_id) AS r
+            WHERE c.id = r.chat_id
+            """
+        )
+    )
+    duplicates = f"SELECT id FROM ({pairs}) AS p WHERE p.id <> p.keep_id"
+    await session.execute(text(f"DELETE FROM chat_summaries WHERE chat_id IN ({duplicates})"))
+    deleted = (await session.execute(
+        text(f"DELETE FROM chats WHERE id IN ({duplicates}) RETURNING from_customer_id, to_customer_id")
+    )).all()
+    invalidate_on_commit(session, deleted)
+    await session.commit()
+
+
+@event.listens_for(Customer, "after_update")
+def _customer_updated(mapper, connection, target: Customer):
+    # Inbox rows of the customer's chats show their name denormalized
+    if not inspect(target).attrs.name.history.has_changes():
+        return
+    connection.execute(
+        update(ChatSummary.__table__)
+        .where(ChatSummary.__table__.c.with_customer_id == target.id)
+        .values(with_customer_name=target.name)
+    )
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from chat import sequences, summaries
+from config.db import create_session
+from config.settings import settings
+from models import ChatMessage
+
+logger = logging.getLogger("ws")
+
+
+class MessageWriter():
+    """
+    Group commit of chat messages
+
+    Messages from all connections of the worker are collected for up to `interval` seconds
+    or until `batch_size` of them are waiting, then stored with one multi-row insert and
+    one commit. `write` returns once the message's batch is committed. A batch mixes
+    messages of unrelated connections, so a failed one is written again message by message
+    and only the messages that fail on their own get the error
+    """
+
+    def __init__(self, interval: float | None = None, batch_size: int | None = None):
+        self.interval = interval if interval is not None else settings.WS_WRITE_BATCH_INTERVAL_MS / 1000
+        self.batch_size = batch_size or settings.WS_WRITE_BATCH_SIZE
+
+        self._pending: list[tuple[int, dict, asyncio.Future]] = list()
+        self._timer: asyncio.TimerHandle | None = None
+        self._flushes: set[asyncio.Task] = set()
+
+        self.batches = 0
+        self.written = 0
+        self.max_batch = 0
+        self.split_batches = 0
+        self.failed = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "pending": len(self._pending),
+            "batches": self.batches,
+            "written": self.written,
+            "max_batch": self.max_batch,
+            "split_batches": self.split_batches,
+            "failed": self.failed,
+        }
+
+    async def write(self, from_customer_id: int, data: dict) -> tuple[ChatMessage, bool]:
+        """
+        Store a message validated by ChatWorker, return it and whether it is new.
+        Messages with an already stored client_msg_id are not stored again
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((from_customer_id, data, future))
+
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.interval, self.flush)
+
+        return await future
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, list()
+        if not batch:
+            return
+
+        task = asyncio.create_task(self._flush(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def close(self):
+        self.flush()
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    async def _flush(self, batch: list[tuple[int, dict, asyncio.Future]]):
+        try:
+            async with create_session() as session:
+                results = await self._store(session, [(customer_id, data) for customer_id, data, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                logger.exception("Failed to store a batch of %s messages, storing them one by one", len(batch))
+                self.split_batches += 1
+                for item in batch:
+                    await self._flush([item])
+                return
+
+            logger.exception("Failed to store a message")
+            self.failed += 1
+            _, _, future = batch[0]
+            if not future.done():
+                future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.written += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        for (_, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    @staticmethod
+    async def _store(session: AsyncSession, batch: list[tuple[int, dict]]) -> list[tuple[ChatMessage, bool]]:
+        results: list[tuple[ChatMessage, bool] | None] = [None] * len(batch)
+
+        # Retries of the same client_msg_id inside one batch share the first one's row
+        first_by_client_id: dict[tuple, int] = dict()
+        copies: dict[int, int] = dict()
+        to_store = list()
+        for i, (_, data) in enumerate(batch):
+            client_key = (data["chat_id"], data["is_from_from_customer"], data["client_msg_id"])
+            if data["client_msg_id"] is not None and client_key in first_by_client_id:
+                copies[i] = first_by_client_id[client_key]
+                continue
+            first_by_client_id[client_key] = i
+            to_store.append(i)
+
+        while to_store:
+            stored, conflicts = await MessageWriter._insert(session, [(i, *batch[i]) for i in to_store])
+            if not conflicts:
+                await summaries.apply_messages(
+                    session,
+                    [(message, batch[i][0], batch[i][1]["to_customer_id"]) for i, message in stored],
+                )
+                await session.commit()
+                for i, message in stored:
+                    results[i] = (message, True)
+                break
+
+            # Seqs reserved for the batch would have gaps, so it is written again without
+            # messages that were already stored by an earlier send
+            await session.rollback()
+            existing = {
+                (message.chat_id, message.is_from_from_customer, message.client_msg_id): message
+                for message in (await session.exec(
+                    select(ChatMessage).where(
+                        tuple_(
+                            ChatMessage.chat_id, ChatMessage.is_from_from_customer, ChatMessage.client_msg_id
+                        ).in_(conflicts)
+                    )
+                )).all()
+            }
+            for i in list(to_store):
+                data = batch[i][1]
+                message = existing.get((data["chat_id"], data["is_from_from_customer"], data["client_msg_id"]))
+                if message is not None:
+                    results[i] = (message, False)
+                    to_store.remove(i)
+            if not existing:
+                raise RuntimeError("Conflicting messages are not found")
+
+        for i, first in copies.items():
+            results[i] = (results[first][0], False)
+        return results
+
+    @staticmethod
+    async def _insert(
+        session: AsyncSession, batch: list[tuple[int, int, dict]]
+    ) -> tuple[list[tuple[int, ChatMessage]], list[tuple]]:
+        """
+        Insert messages with freshly reserved seqs, return stored ones with their batch
+        index and client keys of the ones that conflicted with already stored messages
+        """
+        by_chat: dict[int, list[tuple[int, ChatMessage]]] = dict()
+        for i, _, data in batch:
+            by_chat.setdefault(data["chat_id"], list()).append((i, ChatMessage(**data)))
+
+        # Chats are locked in id order, so concurrent batches can't deadlock
+        messages = list()
+        for chat_id in sorted(by_chat):
+            first_seq = await sequences.reserve_seq(session, chat_id, len(by_chat[chat_id]))
+            for offset, (i, message) in enumerate(by_chat[chat_id]):
+                message.seq = first_seq + offset
+                messages.append((i, message))
+
+        columns = [column.name for column in ChatMessage.__table__.columns if column.name != "id"]
+        rows = (await session.execute(
+            insert(ChatMessage.__table__)
+            .values([{column: getattr(message, column) for column in columns} for _, message in messages])
+            .on_conflict_do_nothing(index_elements=["chat_id", "is_from_from_customer", "client_msg_id"])
+            .returning(ChatMessage.__table__.c.id, ChatMessage.__table__.c.chat_id, ChatMessage.__table__.c.seq)
+        )).all()
+        ids = {(chat_id, seq): message_id for message_id, chat_id, seq in rows}
+
+        stored, conflicts = list(), list()
+        for i, message in messages:
+            message.id = ids.get((message.chat_id, message.seq))
+            if message.id is None:
+                conflicts.append((message.chat_id, message.is_from_from_customer, message.client_msg_id))
+            else:
+                stored.append((i, message))
+        return stored, conflicts
+
+
+message_writer = MessageWriter()
@@ -1,32 +1,49 @@
-from contextlib import contextmanager
-from typing import Generator
+import asyncio
+import contextlib
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator
 
-from sqlmodel import Session, create_engine
+from redis import exceptions as redis_exceptions
+from redis.asyncio import BlockingConnectionPool, Redis
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from config.settings import settings
 
-engine = create_engine(
-    settings.SQLALCHEMY_DATABASE_URI,
+logger = logging.getLogger("redis")
+
+
+def get_async_database_uri(uri: str) -> str:
+    return uri.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+
+engine = create_async_engine(
+    get_async_database_uri(settings.SQLALCHEMY_DATABASE_URI),
     echo=settings.SQLALCHEMY_ECHO,
-    connect_args={"options": "-c timezone=utc"},
+    pool_size=settings.SQLALCHEMY_POOL_SIZE,
+    max_overflow=settings.SQLALCHEMY_MAX_OVERFLOW,
+    pool_timeout=settings.SQLALCHEMY_POOL_TIMEOUT,
+    connect_args={"server_settings": {"timezone": "utc"}},
 )
 
 
-def get_session() -> Generator[Session, None, None]:  # pragma: no cover
+async def get_session() -> AsyncGenerator[AsyncSession, None]:  # pragma: no cover
     """
     FastAPI dependency for creating db sessions inside request
     """
-    with Session(engine, expire_on_commit=False) as _session:
+    async with AsyncSession(engine, expire_on_commit=False) as _session:
         yield _session
 
 
-@contextmanager
-def create_session() -> Generator[Session, None, None]:
+@asynccontextmanager
+async def create_session() -> AsyncGenerator[AsyncSession, None]:
     """
     Context manager for creating db sessions outside of API request context, e.g.
     in celery tasks or management commands
     """
-    return get_session()
+    async with AsyncSession(engine, expire_on_commit=False) as _session:
+        yield _session
 
 
 class RedisManager():
@@ -36,9 +53,17 @@ class RedisManager():
         return cls.instance
 
     def __init__(self):
+        self._redis = None
         self._pubsub = None
-        self._listen_future = None
+        self._listen_task = None
         self._callbacks = dict()
+        self._scripts = dict()
+
+        # Messages of the batch drained from the connection that are not dispatched yet,
+        # what is still unread on the socket can't be seen
+        self.pending = 0
+        self.max_batch = 0
+        self.delivered = 0
 
     def connect(self):
         redis_url = settings.REDIS_URL
@@ -50,31 +75,80 @@ class RedisManager():
         self._pubsub = self._redis.pubsub()
 
     async def disconnect(self):
-        active_channels = [key for key in list(self._callbacks.keys()) if self._callbacks[key] is not None]
-        if active_channels:
-            await self._redis.publish(active_channels[0], STOPWORD)
-
-        if self._listen_future is None:
-            return
-        await self._listen_future
+        await self._stop_listening()
+
+        if self._pubsub is not None:
+            await self._pubsub.close()
+        if self._redis is not None:
+            await self._redis.close()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "channels": len(self._callbacks),
+            "pending": self.pending,
+            "max_batch": self.max_batch,
+            "delivered": self.delivered,
+        }
+
+    async def _next_messages(self) -> list[dict]:
+        """
+        Block until pubsub connection has data, then drain everything already received
+        """
+        messages = []
+        while not messages:
+            message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
+            if message is not None:
+                messages.append(message)
+
+        while (message := await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=0)):
+            messages.append(message)
+        return messages
 
     async def _start_listening(self):
         while True:
             try:
-                async with async_timeout.timeout(1):
-                    message = await self._pubsub.get_message(ignore_subscribe_messages=True)
-                    if message is not None:
-                        message_str = message["data"].decode("utf-8")
-                        if message_str == STOPWORD:
-                            break
-
-                        channel = message["channel"].decode("utf-8")
-                        cb = self._callbacks.get(channel)
-                        if cb is not None:
-                            await cb(message_str)
-                    await asyncio.sleep(0.01)
-            except asyncio.TimeoutError:
-                pass
+                messages = await self._next_messages()
+            except redis_exceptions.ConnectionError:
+                logger.exception("Redis pubsub connection lost, resubscribing")
+                await asyncio.sleep(settings.REDIS_RECONNECT_DELAY)
+                await self._resubscribe()
+                continue
+
+            self.pending = len(messages)
+            self.max_batch = max(self.max_batch, self.pending)
+            if self.pending >= settings.REDIS_PUBSUB_BATCH_WARNING:
+                logger.warning(f"Redis pubsub delivered {self.pending} messages at once")
+
+            for message in messages:
+                channel = message["channel"].decode("utf-8")
+                cb = self._callbacks.get(channel)
+                if cb is not None:
+                    try:
+                        await cb(message["data"].decode("utf-8"))
+                    except Exception:
+                        logger.exception(f"Callback for {channel} failed")
+                self.pending -= 1
+                self.delivered += 1
+
+    async def _stop_listening(self):
+        if self._listen_task is None:
+            return
+
+        self._listen_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._listen_task
+        self._listen_task = None
+
+    async def _resubscribe(self):
+        # Connection pool survives lost connections, only the pubsub connection is replaced
+        if self._redis is None:
+            self.connect()
+        else:
+            with contextlib.suppress(redis_exceptions.RedisError):
+                await self._pubsub.close()
+            self._pubsub = self._redis.pubsub()
+        if self._callbacks:
+            await self._pubsub.subscribe(*self._callbacks.keys())
 
     async def publish(self, channel, message):
         await self._redis.publish(channel, message)
@@ -82,31 +156,99 @@ class RedisManager():
     async def subscribe(self, channel, callback):
         try:
             await self._pubsub.subscribe(channel)
-        except aioredis.exceptions.ConnectionError:
-            self.connect()
+        except redis_exceptions.ConnectionError:
+            await self._resubscribe()
             await self._pubsub.subscribe(channel)
 
         self._callbacks[channel] = callback
 
-        if self._listen_future is None:
-            self._listen_future = asyncio.create_task(self._start_listening())
+        if self._listen_task is None:
+            self._listen_task = asyncio.create_task(self._start_listening())
 
     async def unsubscribe(self, channel):
-        if len(self._callbacks) == 1:
-            await self._redis.publish(channel, STOPWORD)
-
-        self._callbacks.pop(channel)
+        self._callbacks.pop(channel, None)
         await self._pubsub.unsubscribe(channel)
 
         if not self._callbacks:
-            await self._listen_future
-            self._listen_future = None
+            await self._stop_listening()
 
     def get_cache_value(self, key):
         return self._redis.get(key)
 
-    def set_cache_value(self, key, value):
-        return self._redis.set(key, value)
+    def set_cache_value(self, key, value, ttl=None, nx=False):
+        return self._redis.set(key, value, ex=ttl, nx=nx)
+
+    def delete_cache_value(self, key):
+        return self._redis.delete(key)
+
+    def add_to_set(self, key, member):
+        return self._redis.sadd(key, member)
+
+    def remove_from_set(self, key, member):
+        return self._redis.srem(key, member)
+
+    async def run_script(self, script, keys, args):
+        """
+        Run Lua script atomically, it is sent once and then called by its sha
+        """
+        registered = self._scripts.get(script)
+        if registered is None:
+            registered = self._scripts[script] = self._redis.register_script(script)
+        return await registered(keys=keys, args=args, client=self._redis)
+
+    async def push_backlog(self, key, message, limit, ttl):
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.rpush(key, message)
+            pipe.ltrim(key, -limit, -1)
+            pipe.expire(key, ttl)
+            await pipe.execute()
+
+    async def append_to_log(self, key, message, maxlen, ttl) -> str:
+        """
+        Append message to a capped stream and return its entry id
+        """
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.xadd(key, {"data": message}, maxlen=maxlen, approximate=True)
+            pipe.expire(key, ttl)
+            entry_id, _ = await pipe.execute()
+        return entry_id.decode("utf-8")
+
+    async def read_log(self, key, after_id, count) -> list[tuple[str, str]]:
+        """
+        Return up to `count` stream entries newer than `after_id`
+        """
+        entries = await self._redis.xrange(key, min=f"({after_id}", count=count)
+        return [
+            (entry_id.decode("utf-8"), fields[b"data"].decode("utf-8"))
+            for entry_id, fields in entries
+        ]
+
+    async def first_log_id(self, key) -> str | None:
+        """
+        Return id of the oldest entry left in the stream
+        """
+        entries = await self._redis.xrange(key, count=1)
+        return entries[0][0].decode("utf-8") if entries else None
+
+    def push_job(self, key, job):
+        return self._redis.rpush(key, job)
+
+    async def pop_jobs(self, key, count, timeout) -> list[str]:
+        """
+        Wait up to `timeout` seconds for a job, then take up to `count` jobs already queued
+        """
+        first = await self._redis.blpop(key, timeout=timeout)
+        if first is None:
+            return []
+        rest = await self._redis.lpop(key, count - 1) if count > 1 else None
+        return [job.decode("utf-8") for job in [first[1], *(rest or [])]]
+
+    def queue_length(self, key):
+        return self._redis.llen(key)
+
+    async def pop_backlog(self, key, count):
+        messages = await self._redis.lpop(key, count)
+        return [message.decode("utf-8") for message in messages or []]
 
 
 redis_manager = RedisManager()
@@ -4,8 +4,15 @@ from fastapi import FastAPI
 
 from fastapi_pagination import add_pagination
 
+from chat.api.services import WSManager
+from chat.cache import chat_lookup_cache
+from chat.writer import message_writer
 from config import routers
+from config.db import redis_manager
 from config.settings import settings
+from core.aws import aws_clients
+from core.principals import principal_cache
+from core.sms import sms_queue
 
 
 def create_app() -> FastAPI:
@@ -17,4 +24,16 @@ def create_app() -> FastAPI:
     routers.init_app(app)
     add_pagination(app)
 
+    app.add_event_handler("startup", redis_manager.connect)
+    app.add_event_handler("startup", chat_lookup_cache.connect)
+    app.add_event_handler("startup", principal_cache.connect)
+    app.add_event_handler("startup", aws_clients.open)
+    app.add_event_handler("startup", sms_queue.start)
+    app.add_event_handler("startup", WSManager.start)
+    app.add_event_handler("shutdown", WSManager.stop)
+    app.add_event_handler("shutdown", sms_queue.stop)
+    app.add_event_handler("shutdown", aws_clients.close)
+    app.add_event_handler("shutdown", message_writer.close)
+    app.add_event_handler("shutdown", redis_manager.disconnect)
+
     return app
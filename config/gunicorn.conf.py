@@ -1,8 +1,13 @@
+import os
+
 wsgi_app = "config.asgi:app"
 worker_class = "uvicorn.workers.UvicornWorker"
 bind = "0.0.0.0:8000"
 threads = 2
 preload_app = False
 keepalive = 100
+# Addresses of the load balancer, X-Forwarded-For is taken from them only, so client
+# addresses are the real ones for per IP rate limits, see core.ratelimit.client_ip
+forwarded_allow_ips = os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1")
 
 accesslog = "-"
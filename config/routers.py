@@ -2,6 +2,7 @@ from fastapi.applications import FastAPI
 
 import auth.api.routes
 import chat.api.routes
+import media.api.routes
 
 
 def init_app(app: FastAPI) -> None:
@@ -15,3 +16,8 @@ def init_app(app: FastAPI) -> None:
         prefix="/chat",
         tags=["chat"],
     )
+    app.include_router(
+        media.api.routes.router,
+        prefix="/media",
+        tags=["media"],
+    )
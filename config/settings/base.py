@@ -4,7 +4,12 @@ from typing import Optional, Any
 from pydantic import BaseSettings, validator
 from pydantic.fields import Field
 
-DICT_SETTINGS = {'SENDGRID_SETTINGS': True, 'PINPOINT_SETTINGS': True}
+DICT_SETTINGS = {
+    'SENDGRID_SETTINGS': True,
+    'PINPOINT_SETTINGS': True,
+    'RATE_LIMITS': True,
+    'AWS_POOL_CONNECTIONS': True,
+}
 
 def parse_json_string(json_string, name):
     if isinstance(json_string, dict):
@@ -27,14 +32,60 @@ class Settings(BaseSettings):
         env=["DATABASE_URL", "SQLALCHEMY_DATABASE_URI"],
     )
     SQLALCHEMY_ECHO = False
+    SQLALCHEMY_POOL_SIZE = 10
+    SQLALCHEMY_MAX_OVERFLOW = 10
+    SQLALCHEMY_POOL_TIMEOUT = 30
 
     USER_ACCESS_TOKEN_LIFETIME: datetime.timedelta = datetime.timedelta(hours=24)
     USER_REFRESH_TOKEN_LIFETIME: datetime.timedelta = datetime.timedelta(days=180)
+    # Verified tokens kept in memory of a worker
+    TOKEN_CACHE_SIZE = 10000
+    # Authenticated users with their customers, see core.principals
+    PRINCIPAL_CACHE_SIZE = 10000
+    PRINCIPAL_CACHE_TTL: datetime.timedelta = datetime.timedelta(minutes=5)
+    PRINCIPAL_CACHE_REDIS = False
+    # Bloom filter of used refresh token jtis, see auth.revocation. 2**28 bits (32MB per
+    # generation) and 7 hashes keep false reuse detections under 1e-4 for 10M refreshes
+    REFRESH_TOKEN_BLOOM_BITS = 2 ** 28
+    REFRESH_TOKEN_BLOOM_HASHES = 7
+    # A refresh token presented again this soon after its exchange gets a pair with the same
+    # successor jti instead of revoking its family, e.g. when a client retries or refreshes
+    # concurrently
+    REFRESH_TOKEN_REUSE_GRACE: datetime.timedelta = datetime.timedelta(seconds=10)
+
+    # Token buckets shared by all workers, see core.ratelimit. Rate is in tokens per second,
+    # up to `lease` tokens are taken from Redis at once and spent by a worker locally
+    RATE_LIMITS: dict[str, dict[str, float]] = {
+        "sms_phone": {"rate": 1 / 60, "burst": 3},
+        "sms_ip": {"rate": 1 / 60, "burst": 20},
+        "code_check_phone": {"rate": 1 / 60, "burst": 5},
+        "ws_message": {"rate": 10, "burst": 30, "lease": 5},
+    }
+    RATE_LIMIT_LOCAL_SIZE = 10000
 
     AWS_ACCESS_KEY_ID = Field("test_aws_access_key_id", env=["AWS_ACCESS_KEY_ID"])
     AWS_SECRET_ACCESS_KEY = Field("test_aws_secret_access_key", env=["AWS_SECRET_ACCESS_KEY"])
     AWS_S3_REGION_NAME = Field("test_aws_s3_region_name", env=["AWS_S3_REGION_NAME"])
     AWS_S3_PHOTOS_BUCKET = Field("test_aws_s3_photos_bucket", env=["AWS_S3_PHOTOS_BUCKET"])
+    # Local stand-in such as moto server or MinIO, AWS endpoints are used if not set
+    AWS_ENDPOINT_URL: Optional[str] = Field(None, env=["AWS_ENDPOINT_URL"])
+    # Connections each long-lived client keeps, see core.aws
+    AWS_POOL_CONNECTIONS: dict[str, int] = {"s3": 50, "pinpoint": 10}
+    # Streamed uploads larger than a part are uploaded in parts, this many at once,
+    # see core.s3.upload_stream. Parts can't be smaller than 5MB
+    S3_MULTIPART_PART_SIZE = 8 * 1024 * 1024
+    S3_MULTIPART_CONCURRENCY = 4
+    # Bulk deletes run this many batches of 1000 keys at once, see core.s3.delete_objects
+    S3_DELETE_CONCURRENCY = 8
+    S3_DELETE_MAX_ATTEMPTS = 4
+    S3_RETRY_BACKOFF: datetime.timedelta = datetime.timedelta(milliseconds=200)
+    # Presigned URLs for direct uploads and downloads, GET URLs are cached per worker
+    # until `margin` before they expire
+    S3_PRESIGNED_URL_TTL: datetime.timedelta = datetime.timedelta(hours=1)
+    S3_PRESIGNED_URL_MARGIN: datetime.timedelta = datetime.timedelta(minutes=5)
+    S3_PRESIGNED_URL_CACHE_SIZE = 10000
+    MEDIA_UPLOAD_CONTENT_TYPES: tuple[str, ...] = ("image/jpeg", "image/png", "image/webp")
+    MEDIA_UPLOAD_MAX_SIZE = 10 * 1024 * 1024
 
     SENDGRID_SETTINGS: dict[str, Any] = {
         "api_key": "test_key",
@@ -49,12 +100,60 @@ class Settings(BaseSettings):
         "message_type": "test_message_type",
     }
 
+    # Text messages are sent by a pool of workers from a Redis queue, see core.sms.
+    # Transport is pinpoint or stub, the stub keeps messages in memory
+    SMS_TRANSPORT = "pinpoint"
+    SMS_WORKERS = 2
+    SMS_BATCH_SIZE = 100
+    SMS_MAX_ATTEMPTS = 4
+    SMS_RETRY_BACKOFF: datetime.timedelta = datetime.timedelta(milliseconds=500)
+    SMS_QUEUE_POLL_TIMEOUT = 5
+
     REDIS_URL = Field(
         "redis://127.0.0.1:6379",
         env=["REDIS_TLS_URL", "REDIS_URL"]
     )
 
     REDIS_CONNECTIONS_LIMIT = 17
+    REDIS_RECONNECT_DELAY = 1
+    # Batch of pubsub messages drained at once that is logged as a sign of slow consumers
+    REDIS_PUBSUB_BATCH_WARNING = 1000
+
+    # Outbound websocket queue, overflow policy is one of drop_oldest, close, spill
+    WS_SEND_QUEUE_SIZE = 100
+    WS_SEND_QUEUE_OVERFLOW_POLICY = "drop_oldest"
+    WS_SPILL_BACKLOG_LIMIT = 1000
+    WS_SPILL_BACKLOG_TTL: datetime.timedelta = datetime.timedelta(days=1)
+
+    # Workers refresh a heartbeat key at a third of its ttl, publishers drop workers
+    # whose key expired from presence sets
+    WS_WORKER_HEARTBEAT_TTL: datetime.timedelta = datetime.timedelta(seconds=30)
+
+    # Per-customer Redis stream of delivered messages, replayed on reconnect
+    WS_DELIVERY_LOG_MAXLEN = 1000
+    WS_DELIVERY_LOG_TTL: datetime.timedelta = datetime.timedelta(days=7)
+    WS_DELIVERY_LOG_REPLAY_BATCH = 200
+    # Live messages held back during replay, the client is sent a resync frame beyond it
+    WS_LIVE_BUFFER_SIZE = 1000
+
+    # Acks of messages sent with client_msg_id are kept this long to answer retries
+    # without touching the database, older retries are caught by a unique constraint
+    WS_SEND_DEDUPE_TTL: datetime.timedelta = datetime.timedelta(hours=1)
+
+    # Group commit of websocket messages, a batch is written after the interval
+    # or as soon as it reaches the size
+    WS_WRITE_BATCHING = False
+    WS_WRITE_BATCH_INTERVAL_MS = 5
+    WS_WRITE_BATCH_SIZE = 100
+
+    # Chat id by pair of customers, looked up on every websocket send
+    CHAT_LOOKUP_CACHE_SIZE = 10000
+    CHAT_LOOKUP_CACHE_REDIS = False
+    CHAT_LOOKUP_CACHE_TTL: datetime.timedelta = datetime.timedelta(days=1)
+
+    # Inbox rows and messages changed this long before a sync are sent again, covers transactions
+    # committed after the sync read and creation times of messages taken by workers
+    CHAT_SYNC_OVERLAP: datetime.timedelta = datetime.timedelta(seconds=5)
 
     @validator("SQLALCHEMY_DATABASE_URI")
     def clean_postgres_url(cls, value: str) -> str:
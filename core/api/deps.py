@@ -1,9 +1,11 @@
+from dataclasses import dataclass
 from fastapi import Depends
 
 from sqlalchemy.orm import joinedload
 from sqlalchemy.sql.operators import is_
 from sqlalchemy.sql import column
-from sqlmodel import Session, select, col
+from sqlmodel import select, col
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from config.db import get_session
 from core.api.exceptions import PermissionDeniedError, UnauthorizedError, NotFoundError
@@ -21,11 +23,11 @@ class _UserDependency:
 
     async def __call__(
         self,
-        session: Session = Depends(get_session),
+        session: AsyncSession = Depends(get_session),
         token: str = Depends(JWTBearer(scheme_name="Bearer")),
     ) -> User:
         try:
-            user = self.token_class.from_string(token, session).user
+            user = (await self.token_class.from_string(token, session)).user
         except TokenError:
             raise UnauthorizedError
         return user
@@ -37,14 +39,14 @@ class _UserDependencyWS:
 
     async def __call__(
         self,
-        session: Session = Depends(get_session),
+        session: AsyncSession = Depends(get_session),
         token: str = Depends(JWTBearerWS(scheme_name="Bearer")),
     ) -> User:
         if not token:
             return None
         
         try:
-            user = self.token_class.from_string(token, session).user
+            user = (await self.token_class.from_string(token, session)).user
         except TokenError:
             return None
         return user
@@ -70,19 +72,66 @@ async def get_customer_ws(
     return user.customer
 
 
+@dataclass(frozen=True)
+class CustomerIdentity:
+    """
+    Authenticated customer known only by ids, for routes that don't need its row
+    """
+
+    id: int
+    user_id: int
+
+
+async def _get_customer_identity(token: str, session: AsyncSession) -> CustomerIdentity:
+    claims = await UserAccessToken.verify(token)
+    if "customer_id" in claims:
+        return CustomerIdentity(id=claims["customer_id"], user_id=claims["user_id"])
+
+    # Tokens issued before ids were added to claims or before the customer was created
+    user = (await UserAccessToken.from_string(token, session)).user
+    if user.customer is None:
+        raise TokenError(UserAccessToken.error_message)
+    return CustomerIdentity(id=user.customer.id, user_id=user.id)
+
+
+async def get_customer_identity(
+    session: AsyncSession = Depends(get_session),
+    token: str = Depends(JWTBearer(scheme_name="Bearer")),
+) -> CustomerIdentity:
+    try:
+        return await _get_customer_identity(token, session)
+    except TokenError:
+        raise UnauthorizedError
+
+
+async def get_customer_identity_ws(
+    session: AsyncSession = Depends(get_session),
+    token: str = Depends(JWTBearerWS(scheme_name="Bearer")),
+) -> CustomerIdentity | None:
+    if not token:
+        return None
+
+    try:
+        return await _get_customer_identity(token, session)
+    except TokenError:
+        return None
+
+
 async def get_customer_photo(
     photo_id: int,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
 ) -> CustomerPhoto:
-    customer_photo = session.exec(select(CustomerPhoto).where(CustomerPhoto.id == photo_id)).one_or_none()
+    customer_photo = (
+        await session.exec(select(CustomerPhoto).where(CustomerPhoto.id == photo_id))
+    ).one_or_none()
     if not customer_photo:
         raise NotFoundError
     return customer_photo
 
 
-async def _get_relation_w_chat(with_customer_id: int, session: Session, customer: Customer) -> CustomerRelation:
+async def _get_relation_w_chat(with_customer_id: int, session: AsyncSession, customer: Customer) -> CustomerRelation:
     customer_ids = [customer.id, with_customer_id]
-    relation_w_chat = session.exec(
+    relation_w_chat = (await session.exec(
         select(CustomerRelation)
         .options(joinedload(CustomerRelation.chat).joinedload(Chat.messages))
         .where(
@@ -91,7 +140,7 @@ async def _get_relation_w_chat(with_customer_id: int, session: Session, customer
             CustomerRelation.chat,
             CustomerRelation.relation != 'block'
         )
-    ).unique().one_or_none()
+    )).unique().one_or_none()
     if not relation_w_chat:
         raise NotFoundError
     return relation_w_chat
@@ -99,7 +148,7 @@ async def _get_relation_w_chat(with_customer_id: int, session: Session, customer
 
 async def get_relation_w_chat(
     with_customer_id: int,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
     customer: Customer = Depends(get_customer),
 ) -> CustomerRelation:
     return await _get_relation_w_chat(with_customer_id, session, customer)
@@ -107,7 +156,7 @@ async def get_relation_w_chat(
 
 async def get_relation_w_chat_ws(
     with_customer_id: int,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
     customer: Customer = Depends(get_customer_ws),
 ) -> CustomerRelation | None:
     try :
@@ -119,22 +168,13 @@ async def get_relation_w_chat_ws(
 
 async def get_chat(
     with_customer_id: int,
-    session: Session = Depends(get_session),
-    customer: Customer = Depends(get_customer_ws),
+    session: AsyncSession = Depends(get_session),
+    customer: CustomerIdentity = Depends(get_customer_identity),
 ) -> Chat | None:
-    return session.exec(
-        select(Chat)
-        .filter(
-            or_(
-                and_(
-                    Chat.from_customer_id == customer.id,
-                    Chat.to_customer_id == with_customer_id
-                ),
-                and_(
-                    Chat.from_customer_id == with_customer_id,
-                    Chat.to_customer_id == customer.id
-                )
-            ),
+    return (await session.exec(
+        select(Chat).where(
+            Chat.low_customer_id == min(customer.id, with_customer_id),
+            Chat.high_customer_id == max(customer.id, with_customer_id),
         )
-    ).one_or_none()
+    )).one_or_none()
 
@@ -41,3 +41,8 @@ class PermissionDeniedError(_HTTPException):
     status_code = status.HTTP_403_FORBIDDEN
     detail = "Permission denied"
     headers = {"WWW-Authenticate": "Bearer"}
+
+
+class TooManyRequestsError(_HTTPException):
+    status_code = status.HTTP_429_TOO_MANY_REQUESTS
+    detail = "Too many requests"
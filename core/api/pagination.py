@@ -0,0 +1,33 @@
+import base64
+import json
+from typing import Any, Generic, Optional, Sequence, TypeVar
+
+from pydantic import BaseModel
+from pydantic.generics import GenericModel
+
+from core.api.exceptions import BadRequestError
+
+T = TypeVar("T")
+CursorT = TypeVar("CursorT", bound=BaseModel)
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+
+class CursorPage(GenericModel, Generic[T]):
+    items: Sequence[T]
+    next_cursor: Optional[str]
+    prev_cursor: Optional[str]
+
+
+def encode_cursor(cursor: BaseModel) -> str:
+    raw = json.dumps(cursor.dict(), default=str).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("utf-8")
+
+
+def decode_cursor(value: str, cursor_class: type[CursorT]) -> CursorT:
+    try:
+        data: dict[str, Any] = json.loads(base64.urlsafe_b64decode(value.encode("utf-8")))
+        return cursor_class(**data)
+    except Exception:
+        raise BadRequestError("Cursor is invalid")
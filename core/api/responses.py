@@ -42,6 +42,10 @@ CONFLICT: APIResponseType = {
     409: {"model": ExceptionMessageSchema, "description": "Conflict"},
 }
 
+TOO_MANY_REQUESTS: APIResponseType = {
+    429: {"model": ExceptionMessageSchema, "description": "Too many requests"},
+}
+
 SERVICE_UNAVAILABLE: APIResponseType = {
     503: {"model": ExceptionMessageSchema, "description": "3rd party service exception"},
 }
@@ -0,0 +1,71 @@
+import contextlib
+import logging
+from typing import Any, AsyncIterator
+
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+
+from config.settings import settings
+
+logger = logging.getLogger("aws")
+
+
+class AWSClients():
+    """
+    AWS clients shared by the whole worker
+
+    Clients are created when the app starts and closed when it stops, so credentials,
+    endpoints and pooled connections are set up once. Outside of the app, e.g. in
+    management commands, `client` creates a temporary one instead
+    """
+
+    def __init__(self, services: tuple[str, ...] = ("s3", "pinpoint")):
+        self.services = services
+        self._exit_stack: contextlib.AsyncExitStack | None = None
+        self._clients: dict[str, Any] = dict()
+
+    @staticmethod
+    def _create_client(service: str):
+        return get_session().create_client(
+            service,
+            region_name=settings.AWS_S3_REGION_NAME,
+            endpoint_url=settings.AWS_ENDPOINT_URL,
+            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+            config=AioConfig(
+                max_pool_connections=settings.AWS_POOL_CONNECTIONS.get(service, 10),
+                # Presigned S3 URLs are signed with SigV4, required in newer regions
+                signature_version="s3v4" if service == "s3" else None,
+            ),
+        )
+
+    async def open(self):
+        self._exit_stack = contextlib.AsyncExitStack()
+        for service in self.services:
+            self._clients[service] = await self._exit_stack.enter_async_context(
+                self._create_client(service)
+            )
+
+    async def close(self):
+        self._clients.clear()
+        if self._exit_stack is not None:
+            await self._exit_stack.aclose()
+            self._exit_stack = None
+
+    def get(self, service: str) -> Any:
+        try:
+            return self._clients[service]
+        except KeyError:
+            raise RuntimeError(f"AWS client for {service} is not open")
+
+    @contextlib.asynccontextmanager
+    async def client(self, service: str) -> AsyncIterator[Any]:
+        if service in self._clients:
+            yield self._clients[service]
+            return
+
+        async with self._create_client(service) as client:
+            yield client
+
+
+aws_clients = AWSClients()
@@ -0,0 +1,233 @@
+import asyncio
+import json
+import time
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from config.db import redis_manager
+from config.settings import settings
+from models.customer import Customer
+from models.user import User
+
+INVALIDATE_CHANNEL = "principal_invalidate"
+
+# KEYS: entry
+# ARGV: value, its version, ttl in ms
+# Sets the entry unless it holds a newer version, returns 1 if it is set
+SET_IF_NEWER_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+local version = current and tonumber(cjson.decode(current)['version'])
+if version and version > tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[3])
+return 1
+"""
+
+
+class PrincipalCache:
+    """
+    Authenticated users with their customers by email
+
+    Process local LRU, optionally backed by Redis shared between workers, entries live
+    for `ttl` seconds. Cached rows are attached to the request session without a query,
+    so they can be used and modified like freshly loaded ones. Changes of users and
+    customers made through the ORM evict them on every worker after commit
+
+    Entries are versioned by the last change of their rows and an eviction leaves the
+    version of the change behind, so a user read before it is never cached after it
+    """
+
+    def __init__(self, max_size: int | None = None, ttl: float | None = None, use_redis: bool | None = None):
+        self.max_size = max_size or settings.PRINCIPAL_CACHE_SIZE
+        self.ttl = ttl or settings.PRINCIPAL_CACHE_TTL.total_seconds()
+        self.use_redis = settings.PRINCIPAL_CACHE_REDIS if use_redis is None else use_redis
+
+        self._principals: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._principals),
+            "hits": self.hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+        }
+
+    @staticmethod
+    def _redis_key(email: str) -> str:
+        return f"principal_{email}"
+
+    async def connect(self):
+        await redis_manager.subscribe(INVALIDATE_CHANNEL, self._on_invalidate)
+
+    async def get(self, session: AsyncSession, email: str) -> User | None:
+        """
+        Return cached user with its customer attached to `session`
+        """
+        data = self._get_local(email)
+        if data is not None and "user" in data:
+            self.hits += 1
+            return await self._attach(session, data)
+
+        if self.use_redis:
+            value = await redis_manager.get_cache_value(self._redis_key(email))
+            data = json.loads(value) if value is not None else None
+            if data is not None and "user" in data:
+                self._set_local(email, data)
+                self.redis_hits += 1
+                return await self._attach(session, data)
+
+        self.misses += 1
+        return None
+
+    async def set(self, user: User):
+        data = {
+            "version": self.version(user, user.customer),
+            "user": json.loads(user.json()),
+            "customer": json.loads(user.customer.json()) if user.customer else None,
+        }
+        await self._store(user.email, data)
+
+    async def invalidate(self, email: str, version: float):
+        """
+        Evict the user on every worker, entries older than `version` are not cached anymore
+        """
+        await self._store(email, {"version": version})
+        await redis_manager.publish(INVALIDATE_CHANNEL, f"{version}:{email}")
+
+    def evict_local(self, email: str, version: float):
+        self._set_local(email, {"version": version})
+
+    @staticmethod
+    def version(*rows: User | Customer | None) -> float:
+        return max(
+            (row.updated_at or row.created_at).replace(tzinfo=timezone.utc).timestamp()
+            for row in rows if row is not None
+        )
+
+    async def _store(self, email: str, data: dict):
+        if not self._set_local(email, data) or not self.use_redis:
+            return
+        await redis_manager.run_script(
+            SET_IF_NEWER_SCRIPT,
+            keys=[self._redis_key(email)],
+            args=[json.dumps(data), data["version"], int(self.ttl * 1000)],
+        )
+
+    def clear(self):
+        self._principals.clear()
+
+    def _get_local(self, email: str) -> dict | None:
+        entry = self._principals.get(email)
+        if entry is None:
+            return None
+        expires_at, data = entry
+        if expires_at <= time.monotonic():
+            del self._principals[email]
+            return None
+        self._principals.move_to_end(email)
+        return data
+
+    def _set_local(self, email: str, data: dict) -> bool:
+        now = time.monotonic()
+        entry = self._principals.get(email)
+        # Entries cached before versions were introduced have none
+        if entry is not None and entry[0] > now and entry[1].get("version", 0) > data.get("version", 0):
+            return False
+
+        self._principals[email] = (now + self.ttl, data)
+        self._principals.move_to_end(email)
+        while len(self._principals) > self.max_size:
+            self._principals.popitem(last=False)
+        return True
+
+    @staticmethod
+    async def _attach(session: AsyncSession, data: dict) -> User:
+        user = User.validate(data["user"])
+        customer = Customer.validate(data["customer"]) if data["customer"] else None
+        set_committed_value(user, "customer", customer)
+        if customer is not None:
+            make_transient_to_detached(customer)
+        make_transient_to_detached(user)
+        return await session.merge(user, load=False)
+
+    async def _on_invalidate(self, payload: str):
+        version, email = payload.split(":", 1)
+        self.evict_local(email, float(version))
+
+
+principal_cache = PrincipalCache()
+_invalidations: set[asyncio.Task] = set()
+
+
+def _changed(session: Session, version: float, *emails: str):
+    changed = session.info.setdefault("changed_principals", dict())
+    for email in emails:
+        if email:
+            changed[email] = max(version, changed.get(email, version))
+
+
+def _customer_email(connection, target: Customer) -> str | None:
+    # User is usually loaded together with its customer
+    if "user" not in inspect(target).unloaded and target.user is not None:
+        return target.user.email
+    return connection.execute(select(User.email).where(User.id == target.user_id)).scalar()
+
+
+@event.listens_for(User.email, "set", active_history=True)
+def _email_set(target: User, value: str, oldvalue: str, initiator):
+    # Only makes the old email available in history of an update, see below
+    pass
+
+
+@event.listens_for(User, "after_update")
+def _user_updated(mapper, connection, target: User):
+    # Old email is evicted too when it changes
+    _changed(
+        inspect(target).session,
+        PrincipalCache.version(target),
+        target.email,
+        *inspect(target).attrs.email.history.deleted,
+    )
+
+
+@event.listens_for(User, "after_delete")
+def _user_deleted(mapper, connection, target: User):
+    # Deleted rows are never read again, any entry cached before now is stale
+    _changed(inspect(target).session, time.time(), target.email)
+
+
+@event.listens_for(Customer, "after_insert")
+@event.listens_for(Customer, "after_update")
+def _customer_changed(mapper, connection, target: Customer):
+    _changed(inspect(target).session, PrincipalCache.version(target), _customer_email(connection, target))
+
+
+@event.listens_for(Customer, "after_delete")
+def _customer_deleted(mapper, connection, target: Customer):
+    _changed(inspect(target).session, time.time(), _customer_email(connection, target))
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_changed(session: Session):
+    # Bulk updates through core statements are not seen here and must invalidate explicitly
+    for email, version in session.info.pop("changed_principals", dict()).items():
+        principal_cache.evict_local(email, version)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Sync session outside of the app, e.g. a script, has no other workers to notify
+            continue
+        task = loop.create_task(principal_cache.invalidate(email, version))
+        _invalidations.add(task)
+        task.add_done_callback(_invalidations.discard)
@@ -0,0 +1,190 @@
+import logging
+import math
+import time
+
+from collections import OrderedDict
+from typing import Callable
+
+from fastapi import Depends, Request
+from redis import exceptions as redis_exceptions
+
+from config.db import redis_manager
+from config.settings import settings
+from core.api.exceptions import TooManyRequestsError
+
+logger = logging.getLogger("ratelimit")
+
+# KEYS: bucket
+# ARGV: burst, rate in tokens per second, tokens requested
+# Returns tokens granted, up to the requested number, and if none are, milliseconds
+# until the next one is available. Redis clock is used, so all workers agree on it
+TAKE_TOKENS_SCRIPT = """
+local burst = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+
+local granted = math.min(requested, math.floor(tokens))
+tokens = tokens - granted
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+
+local retry_after = 0
+if granted == 0 then
+    retry_after = math.ceil((1 - tokens) / rate * 1000)
+end
+return {granted, retry_after}
+"""
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all workers through Redis
+
+    Up to `lease` tokens are taken from the bucket at once and spent by the worker
+    without touching Redis, unspent ones expire after the time they took to refill.
+    Denials are remembered until the bucket has a token again, so flooding clients are
+    rejected locally. Limits are configured by name in `settings.RATE_LIMITS`
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float | None = None,
+        burst: int | None = None,
+        lease: int | None = None,
+        max_size: int | None = None,
+    ):
+        config = settings.RATE_LIMITS.get(name, {})
+        self.name = name
+        self.rate = rate or config["rate"]
+        self.burst = int(burst or config["burst"])
+        self.lease = int(lease or config.get("lease", 1))
+        self.max_size = max_size or settings.RATE_LIMIT_LOCAL_SIZE
+
+        # Leased tokens and when they expire, time until which keys are denied
+        self._leases: OrderedDict[str, tuple[float, int]] = OrderedDict()
+        self._denied: OrderedDict[str, float] = OrderedDict()
+
+        self.local_hits = 0
+        self.redis_calls = 0
+        self.denied = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "leases": len(self._leases),
+            "denied_keys": len(self._denied),
+            "local_hits": self.local_hits,
+            "redis_calls": self.redis_calls,
+            "denied": self.denied,
+        }
+
+    def _redis_key(self, key: str) -> str:
+        return f"ratelimit_{self.name}_{key}"
+
+    async def acquire(self, key: str) -> float:
+        """
+        Take a token for `key`, return 0 if it is taken or seconds to wait for the next one
+        """
+        now = time.monotonic()
+
+        denied_until = self._denied.get(key)
+        if denied_until is not None:
+            if denied_until > now:
+                self.local_hits += 1
+                self.denied += 1
+                return denied_until - now
+            del self._denied[key]
+
+        lease = self._leases.get(key)
+        if lease is not None:
+            expires_at, tokens = lease
+            if expires_at > now and tokens > 0:
+                self._set_lease(key, expires_at, tokens - 1)
+                self.local_hits += 1
+                return 0
+            del self._leases[key]
+
+        self.redis_calls += 1
+        try:
+            granted, retry_after_ms = await redis_manager.run_script(
+                TAKE_TOKENS_SCRIPT,
+                keys=[self._redis_key(key)],
+                args=[self.burst, self.rate, self.lease],
+            )
+        except redis_exceptions.RedisError:
+            # Limits protect from abuse, they shouldn't take the service down with Redis
+            logger.exception(f"Rate limit {self.name} is not checked")
+            return 0
+
+        if granted == 0:
+            retry_after = retry_after_ms / 1000
+            self._set_denied(key, now + retry_after)
+            self.denied += 1
+            return retry_after
+
+        if granted > 1:
+            self._set_lease(key, now + granted / self.rate, granted - 1)
+        return 0
+
+    async def hit(self, key: str):
+        """
+        Take a token for `key` or raise TooManyRequestsError
+        """
+        retry_after = await self.acquire(key)
+        if retry_after:
+            raise TooManyRequestsError(headers={"Retry-After": str(math.ceil(retry_after))})
+
+    def clear(self):
+        self._leases.clear()
+        self._denied.clear()
+
+    def _set_lease(self, key: str, expires_at: float, tokens: int):
+        self._leases[key] = (expires_at, tokens)
+        self._leases.move_to_end(key)
+        while len(self._leases) > self.max_size:
+            self._leases.popitem(last=False)
+
+    def _set_denied(self, key: str, until: float):
+        self._denied[key] = until
+        self._denied.move_to_end(key)
+        while len(self._denied) > self.max_size:
+            self._denied.popitem(last=False)
+
+
+def client_ip(request: Request) -> str:
+    """
+    Address of the client, behind a load balancer uvicorn takes it from X-Forwarded-For
+    set by the addresses in `forwarded_allow_ips` of config/gunicorn.conf.py. Otherwise
+    it is the balancer's own and all clients share one bucket
+    """
+    return request.client.host if request.client else "unknown"
+
+
+def path_param(name: str) -> Callable[[Request], str]:
+    def key(request: Request) -> str:
+        return str(request.path_params[name])
+    return key
+
+
+def rate_limit(limiter: RateLimiter, key: Callable[[Request], str]):
+    """
+    FastAPI dependency taking a token for the key of the request, e.g.
+    `dependencies=[rate_limit(sms_phone_limiter, path_param("phone_number"))]`
+    """
+    async def dependency(request: Request):
+        await limiter.hit(key(request))
+    return Depends(dependency)
+
+
+sms_phone_limiter = RateLimiter("sms_phone")
+sms_ip_limiter = RateLimiter("sms_ip")
+code_check_phone_limiter = RateLimiter("code_check_phone")
+ws_message_limiter = RateLimiter("ws_message")
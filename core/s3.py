@@ -1,25 +1,39 @@
+import asyncio
 import contextlib
 import logging
-from typing import AsyncIterator
+import random
+import time
 
-from aiobotocore.session import get_session
+from collections import OrderedDict
+from typing import AsyncIterable, AsyncIterator, Iterable, Protocol
+
+from botocore.exceptions import ClientError
 from types_aiobotocore_s3.client import S3Client
 
 from config.settings import settings
+from core.aws import aws_clients
 
 logger = logging.getLogger("s3")
 
+# S3 rejects multipart parts smaller than this, except the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+# and more keys than this in one DeleteObjects request
+MAX_DELETE_KEYS = 1000
+# Errors of requests and of single keys worth another attempt
+RETRY_ERROR_CODES = {"SlowDown", "Throttling", "RequestLimitExceeded", "InternalError", "ServiceUnavailable"}
+
+
+class AsyncReadable(Protocol):
+    async def read(self, size: int = -1) -> bytes:
+        ...
+
 
 @contextlib.asynccontextmanager
 async def create_client() -> AsyncIterator[S3Client]:
-    session = get_session()
-
-    async with session.create_client(
-        "s3",
-        region_name=settings.AWS_S3_REGION_NAME,
-        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-    ) as client:
+    """
+    S3 client of the worker, see core.aws
+    """
+    async with aws_clients.client("s3") as client:
         yield client
 
 
@@ -34,13 +48,286 @@ async def upload_image_binary(
         logger.info(f"AWS response:\n{resp}")
 
 
-async def delete_objects(*, bucket: str, keys: list[str]) -> None:
+async def _read_parts(stream: AsyncIterable[bytes] | AsyncReadable, part_size: int) -> AsyncIterator[bytes]:
+    """
+    Regroup chunks of the stream into parts of `part_size`, the last one may be smaller
+    """
+    async def read_chunks(file: AsyncReadable) -> AsyncIterator[bytes]:
+        while chunk := await file.read(part_size):
+            yield chunk
+
+    chunks = read_chunks(stream) if hasattr(stream, "read") else stream
+
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= part_size:
+            yield bytes(buffer[:part_size])
+            del buffer[:part_size]
+    if buffer:
+        yield bytes(buffer)
+
+
+async def upload_stream(
+    *,
+    bucket: str,
+    key: str,
+    stream: AsyncIterable[bytes] | AsyncReadable,
+    content_type: str = "application/octet-stream",
+    part_size: int | None = None,
+    concurrency: int | None = None,
+) -> None:
+    """
+    Upload an async byte iterator or a file-like object with async `read`, e.g. an
+    UploadFile. Objects up to `part_size` go with one put_object, larger ones with a
+    multipart upload of up to `concurrency` parts at once, so at most
+    `part_size * (concurrency + 1)` bytes are kept in memory
+    """
+    part_size = max(part_size or settings.S3_MULTIPART_PART_SIZE, MIN_PART_SIZE)
+    concurrency = concurrency or settings.S3_MULTIPART_CONCURRENCY
+
+    parts = _read_parts(stream, part_size)
+    first = await anext(parts, b"")
+    second = await anext(parts, None)
+
     async with create_client() as client:
-        logger.info(f"Deleting {keys} from {bucket}")
-        resp = await client.delete_objects(
-            Bucket=bucket, Delete={"Objects": [{"Key": key} for key in keys]}
+        if second is None:
+            logger.info(f"Uploading {key} to {bucket}")
+            await client.put_object(Bucket=bucket, Key=key, Body=first, ContentType=content_type)
+            return
+
+        upload_id = (await client.create_multipart_upload(
+            Bucket=bucket, Key=key, ContentType=content_type
+        ))["UploadId"]
+        logger.info(f"Uploading {key} to {bucket} in parts, upload {upload_id}")
+
+        semaphore = asyncio.Semaphore(concurrency)
+        uploaded: list[dict] = list()
+
+        async def upload_part(number: int, body: bytes):
+            try:
+                resp = await client.upload_part(
+                    Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=body
+                )
+                uploaded.append({"PartNumber": number, "ETag": resp["ETag"]})
+            finally:
+                semaphore.release()
+
+        # Read parts are referenced only until they are handed to upload_part
+        head = [first, second]
+        del first, second
+
+        async def all_parts() -> AsyncIterator[bytes]:
+            while head:
+                yield head.pop(0)
+            async for part in parts:
+                yield part
+
+        tasks: list[asyncio.Task] = list()
+        try:
+            number = 0
+            async for part in all_parts():
+                number += 1
+                # Next part is read only when there is a free slot for it
+                await semaphore.acquire()
+                tasks.append(asyncio.create_task(upload_part(number, part)))
+                # Fail fast instead of reading the rest of the stream
+                for task in tasks:
+                    if task.done() and task.exception():
+                        raise task.exception()
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
+
+        await client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": sorted(uploaded, key=lambda part: part["PartNumber"])},
         )
-        logger.info(f"AWS response:\n{resp}")
+
+
+async def _key_batches(keys: Iterable[str] | AsyncIterable[str], size: int) -> AsyncIterator[list[str]]:
+    if not hasattr(keys, "__aiter__"):
+        keys = _aiter(keys)
+
+    batch = list()
+    async for key in keys:
+        batch.append(key)
+        if len(batch) == size:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
+
+
+async def _aiter(items: Iterable[str]) -> AsyncIterator[str]:
+    for item in items:
+        yield item
+
+
+async def _delete_batch(client: S3Client, bucket: str, keys: list[str]) -> list[dict]:
+    """
+    Delete up to 1000 keys, retrying throttled requests and keys, return errors of
+    the keys that couldn't be deleted
+    """
+    failed: list[dict] = list()
+    retry: list[dict] = list()
+    for attempt in range(1, settings.S3_DELETE_MAX_ATTEMPTS + 1):
+        try:
+            resp = await client.delete_objects(
+                Bucket=bucket, Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True}
+            )
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code not in RETRY_ERROR_CODES:
+                raise
+            retry = [{"Key": key, "Code": code, "Message": str(e)} for key in keys]
+        else:
+            retry = list()
+            for error in resp.get("Errors", []):
+                (retry if error["Code"] in RETRY_ERROR_CODES else failed).append(error)
+
+        if not retry:
+            return failed
+        keys = [error["Key"] for error in retry]
+        if attempt < settings.S3_DELETE_MAX_ATTEMPTS:
+            backoff = settings.S3_RETRY_BACKOFF.total_seconds() * 2 ** (attempt - 1)
+            await asyncio.sleep(backoff * random.uniform(0.5, 1.5))
+    return failed + retry
+
+
+async def delete_objects(
+    *,
+    bucket: str,
+    keys: Iterable[str] | AsyncIterable[str],
+    concurrency: int | None = None,
+) -> list[dict]:
+    """
+    Delete keys from a list or an async iterator in batches of 1000, up to
+    `concurrency` batches at once. Returns `{"Key", "Code", "Message"}` of every key
+    that couldn't be deleted
+    """
+    concurrency = concurrency or settings.S3_DELETE_CONCURRENCY
+    semaphore = asyncio.Semaphore(concurrency)
+    errors: list[dict] = list()
+    deleted = 0
+
+    async with create_client() as client:
+        async def delete(batch: list[str]):
+            nonlocal deleted
+            try:
+                batch_errors = await _delete_batch(client, bucket, batch)
+            except ClientError as e:
+                batch_errors = [
+                    {"Key": key, "Code": e.response["Error"]["Code"], "Message": str(e)} for key in batch
+                ]
+            finally:
+                semaphore.release()
+            errors.extend(batch_errors)
+            deleted += len(batch) - len(batch_errors)
+
+        tasks: list[asyncio.Task] = list()
+        try:
+            async for batch in _key_batches(keys, MAX_DELETE_KEYS):
+                await semaphore.acquire()
+                tasks.append(asyncio.create_task(delete(batch)))
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    logger.info(f"Deleted {deleted} objects from {bucket}, {len(errors)} failed")
+    return errors
+
+
+async def presign_put(*, bucket: str, key: str, content_type: str, expires_in: int | None = None) -> str:
+    """
+    URL a client can PUT the object to directly, the content type is part of the signature
+    """
+    async with create_client() as client:
+        return await client.generate_presigned_url(
+            "put_object",
+            Params={"Bucket": bucket, "Key": key, "ContentType": content_type},
+            ExpiresIn=expires_in or int(settings.S3_PRESIGNED_URL_TTL.total_seconds()),
+        )
+
+
+async def presign_post(
+    *, bucket: str, key: str, content_type: str, max_size: int, expires_in: int | None = None
+) -> dict:
+    """
+    URL and form fields a client can POST the object with, unlike PUT the policy
+    limits its size
+    """
+    async with create_client() as client:
+        return await client.generate_presigned_post(
+            bucket,
+            key,
+            Fields={"Content-Type": content_type},
+            Conditions=[{"Content-Type": content_type}, ["content-length-range", 1, max_size]],
+            ExpiresIn=expires_in or int(settings.S3_PRESIGNED_URL_TTL.total_seconds()),
+        )
+
+
+class PresignedURLCache():
+    """
+    Presigned GET URLs by bucket and key
+
+    URLs are signed for `ttl` seconds and served until `margin` seconds before they
+    expire, so clients always get at least `margin` seconds to use them. Same URL for
+    the same object also lets clients cache the object itself
+    """
+
+    def __init__(self, max_size: int | None = None, ttl: float | None = None, margin: float | None = None):
+        self.max_size = max_size or settings.S3_PRESIGNED_URL_CACHE_SIZE
+        self.ttl = ttl or settings.S3_PRESIGNED_URL_TTL.total_seconds()
+        self.margin = margin or settings.S3_PRESIGNED_URL_MARGIN.total_seconds()
+
+        self._urls: OrderedDict[tuple[str, str], tuple[float, str]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self._urls), "hits": self.hits, "misses": self.misses}
+
+    async def get(self, bucket: str, key: str) -> tuple[str, float]:
+        """
+        Return presigned URL of the object and unix time it expires at
+        """
+        entry = self._urls.get((bucket, key))
+        if entry is not None and entry[0] - self.margin > time.time():
+            self._urls.move_to_end((bucket, key))
+            self.hits += 1
+            return entry[1], entry[0]
+
+        self.misses += 1
+        expires_at = time.time() + self.ttl
+        async with create_client() as client:
+            url = await client.generate_presigned_url(
+                "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=int(self.ttl)
+            )
+
+        self._urls[(bucket, key)] = (expires_at, url)
+        self._urls.move_to_end((bucket, key))
+        while len(self._urls) > self.max_size:
+            self._urls.popitem(last=False)
+        return url, expires_at
+
+    def evict(self, bucket: str, key: str):
+        self._urls.pop((bucket, key), None)
+
+    def clear(self):
+        self._urls.clear()
+
+
+presigned_url_cache = PresignedURLCache()
 
 
 def get_url(bucket: str, key: str) -> str:
@@ -0,0 +1,205 @@
+import asyncio
+import contextlib
+import json
+import logging
+import random
+import time
+
+from botocore.exceptions import BotoCoreError, ClientError
+from typing import Any
+
+from config.db import redis_manager
+from config.settings import settings
+from core.aws import aws_clients
+
+logger = logging.getLogger("sms")
+
+QUEUE_KEY = "sms_queue"
+
+# Pinpoint delivery statuses worth another attempt, the rest are final
+RETRY_STATUSES = {"THROTTLED", "TEMPORARY_FAILURE", "UNKNOWN_FAILURE"}
+# Pinpoint accepts up to 100 addresses in one send_messages request
+MAX_ADDRESSES = 100
+
+
+class StubTransport():
+    """
+    Keeps sent messages in memory instead of sending them, for tests and development
+    """
+
+    def __init__(self):
+        self.sent: list[tuple[str, str]] = list()
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def send(self, messages: dict[str, str]) -> dict[str, str]:
+        for phone_number, body in messages.items():
+            logger.info(f"Stub SMS to {phone_number}: {body}")
+            self.sent.append((phone_number, body))
+        return {phone_number: "SUCCESSFUL" for phone_number in messages}
+
+
+class PinpointTransport():
+    """
+    Sends messages through the worker's Pinpoint client, all messages of a call
+    go in one request with a body per address
+    """
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def send(self, messages: dict[str, str]) -> dict[str, str]:
+        pinpoint_settings = settings.PINPOINT_SETTINGS
+        async with aws_clients.client("pinpoint") as client:
+            response = await client.send_messages(
+                ApplicationId=pinpoint_settings["project_id"],
+                MessageRequest={
+                    "Addresses": {
+                        phone_number: {"ChannelType": "SMS", "BodyOverride": body}
+                        for phone_number, body in messages.items()
+                    },
+                    "MessageConfiguration": {
+                        "SMSMessage": {
+                            "MessageType": pinpoint_settings["message_type"],
+                            "OriginationNumber": pinpoint_settings["origination_number"],
+                        }
+                    },
+                },
+            )
+        results = response["MessageResponse"]["Result"]
+        return {phone_number: results[phone_number]["DeliveryStatus"] for phone_number in messages}
+
+
+TRANSPORTS = {
+    "pinpoint": PinpointTransport,
+    "stub": StubTransport,
+}
+
+
+class SMSQueue():
+    """
+    Redis backed queue of text messages drained by a pool of workers
+
+    Messages are sent in batches of up to `batch_size`, failed ones are retried with
+    exponential backoff up to `max_attempts` times. A message taken by a worker that
+    dies before sending it is lost, which is fine for verification codes that can be
+    requested again
+    """
+
+    def __init__(
+        self,
+        transport: Any = None,
+        workers: int | None = None,
+        batch_size: int | None = None,
+        max_attempts: int | None = None,
+    ):
+        self.transport = transport or TRANSPORTS[settings.SMS_TRANSPORT]()
+        self.workers = workers or settings.SMS_WORKERS
+        self.batch_size = min(batch_size or settings.SMS_BATCH_SIZE, MAX_ADDRESSES)
+        self.max_attempts = max_attempts or settings.SMS_MAX_ATTEMPTS
+
+        self._tasks: list[asyncio.Task] = list()
+
+        self.batches = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "batches": self.batches,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "avg_latency": self.total_latency / self.sent if self.sent else 0.0,
+            "max_latency": self.max_latency,
+        }
+
+    async def depth(self) -> int:
+        return await redis_manager.queue_length(QUEUE_KEY)
+
+    async def enqueue(self, phone_number: str, body: str):
+        job = {"phone_number": phone_number, "body": body, "queued_at": time.time()}
+        await redis_manager.push_job(QUEUE_KEY, json.dumps(job))
+
+    async def start(self):
+        await self.transport.open()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self._tasks = list()
+        await self.transport.close()
+
+    async def _work(self):
+        while True:
+            try:
+                jobs = await redis_manager.pop_jobs(
+                    QUEUE_KEY, self.batch_size, timeout=settings.SMS_QUEUE_POLL_TIMEOUT
+                )
+            except Exception:
+                logger.exception("Failed to read SMS queue")
+                await asyncio.sleep(settings.REDIS_RECONNECT_DELAY)
+                continue
+
+            if not jobs:
+                continue
+            try:
+                await self._send([json.loads(job) for job in jobs])
+            except Exception:
+                logger.exception(f"Failed to send {len(jobs)} messages")
+
+    async def _send(self, jobs: list[dict]):
+        # Codes sent to one number in one batch, only the last one is valid
+        pending = {job["phone_number"]: job for job in jobs}
+
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                statuses = await self.transport.send(
+                    {phone_number: job["body"] for phone_number, job in pending.items()}
+                )
+            except (BotoCoreError, ClientError) as e:
+                logger.warning(f"Couldn't send {len(pending)} messages, attempt {attempt}: {e}")
+                statuses = {phone_number: "TEMPORARY_FAILURE" for phone_number in pending}
+
+            self.batches += 1
+            now = time.time()
+            for phone_number, status in statuses.items():
+                if status in RETRY_STATUSES:
+                    continue
+
+                job = pending.pop(phone_number)
+                if status == "SUCCESSFUL":
+                    latency = now - job["queued_at"]
+                    self.sent += 1
+                    self.total_latency += latency
+                    self.max_latency = max(self.max_latency, latency)
+                else:
+                    self.failed += 1
+                    logger.warning(f"Code to {phone_number} is not delivered: {status}")
+
+            if not pending:
+                return
+            if attempt < self.max_attempts:
+                self.retries += len(pending)
+                backoff = settings.SMS_RETRY_BACKOFF.total_seconds() * 2 ** (attempt - 1)
+                await asyncio.sleep(backoff * random.uniform(0.5, 1.5))
+
+        self.failed += len(pending)
+        logger.error(f"Gave up sending codes to {', '.join(pending)}")
+
+
+sms_queue = SMSQueue()
@@ -1,6 +1,10 @@
 from __future__ import annotations
 
+import hashlib
+import time
+
 from calendar import timegm
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Any, Sequence, Type, TypeVar
 
@@ -8,10 +12,11 @@ from jose import JWTError, jwt
 from jose.constants import ALGORITHMS
 from sqlalchemy.exc import NoResultFound
 from sqlalchemy.orm import joinedload
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlmodel.sql.expression import Select, SelectOfScalar, select
 
 from config.settings import settings
+from core.principals import principal_cache
 from models.user import User
 
 T = TypeVar("T", bound="Token")
@@ -23,6 +28,51 @@ class TokenError(Exception):
     pass
 
 
+class VerifiedTokenCache:
+    """
+    Claims of already verified tokens by digest of the token string
+
+    Entries are kept until the token's `exp`, least recently used ones are evicted
+    when the cache is full
+    """
+
+    def __init__(self, max_size: int | None = None):
+        self.max_size = max_size or settings.TOKEN_CACHE_SIZE
+        self._claims: OrderedDict[str, ClaimsDict] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self._claims), "hits": self.hits, "misses": self.misses}
+
+    def get(self, key: str) -> ClaimsDict | None:
+        claims = self._claims.get(key)
+        if claims is not None and claims["exp"] <= time.time():
+            del self._claims[key]
+            claims = None
+
+        if claims is None:
+            self.misses += 1
+            return None
+
+        self._claims.move_to_end(key)
+        self.hits += 1
+        return claims
+
+    def set(self, key: str, claims: ClaimsDict) -> None:
+        self._claims[key] = claims
+        self._claims.move_to_end(key)
+        while len(self._claims) > self.max_size:
+            self._claims.popitem(last=False)
+
+    def clear(self) -> None:
+        self._claims.clear()
+
+
+verified_token_cache = VerifiedTokenCache()
+
+
 class TokenMetaClass(type):
     def __new__(mcls, name: str, bases: Any, attrs: dict[str, Any]) -> object:
         is_abstract = attrs.pop("is_abstract", False)
@@ -49,6 +99,8 @@ class Token(metaclass=TokenMetaClass):
     algorithm_options: dict[str, bool | int] = {}
 
     required_claims: Sequence[str] = ("email",)
+    # Resolve users through principal_cache, get_user_query must load user.customer
+    cache_user: bool = False
 
     signing_key: str = settings.SECRET_KEY
     error_message = "Token is invalid or expired"
@@ -136,13 +188,35 @@ class Token(metaclass=TokenMetaClass):
         pass
 
     @classmethod
-    def _get_user(cls, claims: ClaimsDict, session: Session) -> User:
+    async def is_revoked(cls, claims: ClaimsDict) -> bool:
+        """
+        Implement your revocation check, it runs for cached tokens too
+        """
+        return False
+
+    @classmethod
+    def _cache_key(cls, token_string: str) -> str:
+        # Token type is part of the key, so claims verified for one token class
+        # are never served to another
+        return hashlib.sha256(f"{cls.token_type}:{token_string}".encode("utf-8")).hexdigest()
+
+    @classmethod
+    async def _get_user(cls, claims: ClaimsDict, session: AsyncSession) -> User:
+        if cls.cache_user:
+            user = await principal_cache.get(session, claims["email"])
+            if user is not None:
+                return user
+
         query = cls.get_user_query(claims)
         try:
-            return session.exec(query).one()
+            user = (await session.exec(query)).one()
         except NoResultFound:
             raise TokenError(cls.error_message)
 
+        if cls.cache_user:
+            await principal_cache.set(user)
+        return user
+
     @classmethod
     def _get_claims(cls, *, user: User, from_time: datetime) -> ClaimsDict:
         claims = {
@@ -160,16 +234,31 @@ class Token(metaclass=TokenMetaClass):
         return {"email": user.email}
 
     @classmethod
-    def from_string(cls: Type[T], token_string: str, session: Session) -> T:
+    async def from_string(cls: Type[T], token_string: str, session: AsyncSession) -> T:
         """
         Verify given token_string and return new token instance
         """
-        claims = cls._decode(token_string)
-        cls._verify_claims(claims)
-        user = cls._get_user(claims, session)
+        claims = await cls.verify(token_string)
+        user = await cls._get_user(claims, session)
 
         return cls(user=user, token_string=token_string, claims=claims)
 
+    @classmethod
+    async def verify(cls, token_string: str) -> ClaimsDict:
+        """
+        Verify given token_string and return its claims without loading the user
+        """
+        cache_key = cls._cache_key(token_string)
+        claims = verified_token_cache.get(cache_key)
+        if claims is None:
+            claims = cls._decode(token_string)
+            cls._verify_claims(claims)
+            verified_token_cache.set(cache_key, claims)
+
+        if await cls.is_revoked(claims):
+            raise TokenError(cls.error_message)
+        return claims
+
     @classmethod
     def get_user_query(cls, claims: ClaimsDict) -> UserSelect:
         """
@@ -179,13 +268,16 @@ class Token(metaclass=TokenMetaClass):
 
     @classmethod
     def for_user(
-        cls: Type[T], user: User, instantiation_time: datetime | None = None
+        cls: Type[T],
+        user: User,
+        instantiation_time: datetime | None = None,
+        extra_claims: ClaimsDict | None = None,
     ) -> T:
         """
-        Generate token for a given user
+        Generate token for a given user, `extra_claims` are added to the generated ones
         """
         instantiation_time = instantiation_time or datetime.utcnow()
-        claims = cls._get_claims(user=user, from_time=instantiation_time)
+        claims = cls._get_claims(user=user, from_time=instantiation_time) | (extra_claims or {})
         token_string = cls._encode(claims)
 
         return cls(user=user, token_string=token_string, claims=claims)
@@ -1,7 +1,14 @@
 #!/usr/bin/env python
+import asyncio
+
 import typer
 import uvicorn
 
+from chat.cache import wait_for_invalidations
+from chat.sequences import backfill_message_seq
+from chat.summaries import backfill_read_watermarks, merge_duplicate_chats, rebuild_chat_summaries
+from config.db import create_session, redis_manager
+
 cli = typer.Typer()
 
 
@@ -16,5 +23,71 @@ def _runserver(
     uvicorn.run("config.asgi:app", reload=True, host=host, port=port)
 
 
+@cli.command("rebuild_chat_summaries")
+def _rebuild_chat_summaries(batch_size: int = typer.Option(1000)) -> None:
+    """
+    Recompute inbox projection (chat_summaries) for all chats
+    """
+
+    async def _rebuild() -> int:
+        async with create_session() as session:
+            return await rebuild_chat_summaries(session, batch_size=batch_size)
+
+    rebuilt = asyncio.run(_rebuild())
+    typer.echo(f"Rebuilt summaries for {rebuilt} chats")
+
+
+@cli.command("backfill_read_watermarks")
+def _backfill_read_watermarks(batch_size: int = typer.Option(1000)) -> None:
+    """
+    Move legacy chat_messages.is_viewed flags into chat_summaries read watermarks
+    """
+
+    async def _backfill() -> int:
+        async with create_session() as session:
+            await rebuild_chat_summaries(session, batch_size=batch_size)
+            await backfill_read_watermarks(session)
+            return await rebuild_chat_summaries(session, batch_size=batch_size)
+
+    rebuilt = asyncio.run(_backfill())
+    typer.echo(f"Backfilled read watermarks for {rebuilt} chats")
+
+
+@cli.command("backfill_message_seq")
+def _backfill_message_seq(batch_size: int = typer.Option(1000)) -> None:
+    """
+    Number messages written before chat_messages.seq was introduced
+    """
+
+    async def _backfill() -> int:
+        async with create_session() as session:
+            await backfill_message_seq(session, batch_size=batch_size)
+            return await rebuild_chat_summaries(session, batch_size=batch_size)
+
+    rebuilt = asyncio.run(_backfill())
+    typer.echo(f"Backfilled message seqs for {rebuilt} chats")
+
+
+@cli.command("merge_duplicate_chats")
+def _merge_duplicate_chats(batch_size: int = typer.Option(1000)) -> None:
+    """
+    Merge chats of the same customer pair, required before adding ix_chats_customer_pair
+    """
+
+    async def _merge() -> int:
+        # Deleted duplicates are evicted from chat lookup caches of running workers
+        redis_manager.connect()
+        try:
+            async with create_session() as session:
+                await merge_duplicate_chats(session)
+                await wait_for_invalidations()
+                return await rebuild_chat_summaries(session, batch_size=batch_size)
+        finally:
+            await redis_manager.disconnect()
+
+    rebuilt = asyncio.run(_merge())
+    typer.echo(f"Merged duplicate chats, rebuilt summaries for {rebuilt} chats")
+
+
 if __name__ == "__main__":
     cli()
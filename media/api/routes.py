@@ -0,0 +1,121 @@
+import mimetypes
+import uuid
+from datetime import datetime
+
+from fastapi import APIRouter, Depends
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from config.db import get_session
+from config.settings import settings
+from core import s3
+from core.api import responses
+from core.api.deps import CustomerIdentity, get_customer_identity
+from core.api.exceptions import BadRequestError, PermissionDeniedError
+from media.api import schema
+from models import Chat
+
+router = APIRouter()
+
+MEDIA_PREFIX = "customers/"
+
+
+def _new_key(customer: CustomerIdentity, content_type: str) -> str:
+    if content_type not in settings.MEDIA_UPLOAD_CONTENT_TYPES:
+        raise BadRequestError("Content type is not allowed")
+    extension = mimetypes.guess_extension(content_type) or ""
+    return f"{MEDIA_PREFIX}{customer.id}/{uuid.uuid4().hex}{extension}"
+
+
+def _key_owner_id(key: str) -> int | None:
+    owner_id, _, name = key.removeprefix(MEDIA_PREFIX).partition("/")
+    if not key.startswith(MEDIA_PREFIX) or not owner_id.isdigit() or not name:
+        return None
+    return int(owner_id)
+
+
+async def _can_read(key: str, customer: CustomerIdentity, session: AsyncSession) -> bool:
+    owner_id = _key_owner_id(key)
+    if owner_id is None:
+        return False
+    if owner_id == customer.id:
+        return True
+
+    # Media of other customers is readable by those they have a chat with
+    chat_id = (await session.exec(
+        select(Chat.id).where(
+            Chat.low_customer_id == min(customer.id, owner_id),
+            Chat.high_customer_id == max(customer.id, owner_id),
+        )
+    )).first()
+    return chat_id is not None
+
+
+def _expires_at() -> datetime:
+    return datetime.utcnow() + settings.S3_PRESIGNED_URL_TTL
+
+
+@router.post(
+    "/upload_url/",
+    responses=responses.UNAUTHORIZED | responses.BAD_REQUEST,
+    response_model=schema.UploadURLSchema,
+    status_code=201,
+)
+async def get_upload_url(
+    data: schema.UploadRequestSchema,
+    customer: CustomerIdentity = Depends(get_customer_identity),
+):
+    """
+    Presigned URL to PUT a new object to directly, send it with the same Content-Type
+    """
+    key = _new_key(customer, data.content_type)
+    url = await s3.presign_put(
+        bucket=settings.AWS_S3_PHOTOS_BUCKET, key=key, content_type=data.content_type
+    )
+    return {"key": key, "url": url, "expires_at": _expires_at()}
+
+
+@router.post(
+    "/upload_policy/",
+    responses=responses.UNAUTHORIZED | responses.BAD_REQUEST,
+    response_model=schema.UploadPolicySchema,
+    status_code=201,
+)
+async def get_upload_policy(
+    data: schema.UploadRequestSchema,
+    customer: CustomerIdentity = Depends(get_customer_identity),
+):
+    """
+    Presigned form to POST a new object with, `fields` go before the file in the form.
+    Unlike upload_url it also limits size of the object
+    """
+    key = _new_key(customer, data.content_type)
+    policy = await s3.presign_post(
+        bucket=settings.AWS_S3_PHOTOS_BUCKET,
+        key=key,
+        content_type=data.content_type,
+        max_size=settings.MEDIA_UPLOAD_MAX_SIZE,
+    )
+    return {"key": key, "url": policy["url"], "fields": policy["fields"], "expires_at": _expires_at()}
+
+
+@router.get(
+    "/download_url/",
+    responses=responses.UNAUTHORIZED | responses.PERMISSION_DENIED,
+    response_model=schema.DownloadURLSchema,
+    status_code=200,
+)
+async def get_download_url(
+    key: str,
+    session: AsyncSession = Depends(get_session),
+    customer: CustomerIdentity = Depends(get_customer_identity),
+):
+    """
+    Presigned URL to GET a private object from, the same URL is returned until shortly
+    before it expires. Objects of the customer and of those it has a chat with are allowed
+    """
+    if not await _can_read(key, customer, session):
+        raise PermissionDeniedError
+
+    url, expires_at = await s3.presigned_url_cache.get(settings.AWS_S3_PHOTOS_BUCKET, key)
+    return {"url": url, "expires_at": datetime.utcfromtimestamp(expires_at)}
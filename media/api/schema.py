@@ -0,0 +1,24 @@
+from datetime import datetime
+from pydantic import BaseModel
+
+
+class UploadRequestSchema(BaseModel):
+    content_type: str
+
+
+class UploadURLSchema(BaseModel):
+    key: str
+    url: str
+    expires_at: datetime
+
+
+class UploadPolicySchema(BaseModel):
+    key: str
+    url: str
+    fields: dict[str, str]
+    expires_at: datetime
+
+
+class DownloadURLSchema(BaseModel):
+    url: str
+    expires_at: datetime
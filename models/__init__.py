@@ -1,10 +1,11 @@
 from models.user import User
 from models.customer import Customer
-from models.chat import Chat, ChatMessage
+from models.chat import Chat, ChatMessage, ChatSummary
 
 __all__ = [
     "User",
     "Customer",
     "Chat",
     "ChatMessage",
+    "ChatSummary",
 ]
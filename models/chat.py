@@ -1,5 +1,6 @@
 import sqlalchemy as sa
 
+from datetime import datetime
 from sqlmodel import Field, Relationship
 from typing import TYPE_CHECKING, Optional
 
@@ -10,6 +11,9 @@ from models.customer import Customer
 
 class Chat(BaseModel, table=True):
     __tablename__ = "chats"
+    __table_args__ = (
+        sa.Index("ix_chats_customer_pair", "low_customer_id", "high_customer_id", unique=True),
+    )
 
     id: int = Field(default=None, primary_key=True)
 
@@ -45,22 +49,122 @@ class Chat(BaseModel, table=True):
         },
     )
 
+    # Participants in canonical order, a pair of customers has at most one chat
+    low_customer_id: int = Field(
+        sa_column=sa.Column(
+            sa.Integer,
+            sa.Computed("LEAST(from_customer_id, to_customer_id)", persisted=True),
+            nullable=False,
+        )
+    )
+    high_customer_id: int = Field(
+        sa_column=sa.Column(
+            sa.Integer,
+            sa.Computed("GREATEST(from_customer_id, to_customer_id)", persisted=True),
+            nullable=False,
+        )
+    )
+
     messages: list["ChatMessage"] = Relationship(
         back_populates="chat",
         sa_relationship_kwargs={
             "cascade": "all, delete-orphan",
         },
     )
+    summaries: list["ChatSummary"] = Relationship(
+        sa_relationship_kwargs={
+            "cascade": "all, delete-orphan",
+        },
+    )
+
+    # Seq of the last message in the chat, see chat.sequences.reserve_seq
+    last_seq: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
 
 
 class ChatMessage(BaseModel, TimeStampedMixin, table=True):
     __tablename__ = "chat_messages"
+    __table_args__ = (
+        sa.Index("ix_chat_messages_chat_id_seq", "chat_id", "seq", unique=True),
+        sa.Index("ix_chat_messages_chat_id_id", "chat_id", "id"),
+        # Messages of changed chats created since a sync cursor
+        sa.Index("ix_chat_messages_chat_id_created_at", "chat_id", "created_at"),
+        sa.Index(
+            "ix_chat_messages_client_msg_id",
+            "chat_id",
+            "is_from_from_customer",
+            "client_msg_id",
+            unique=True,
+        ),
+    )
 
     id: int = Field(default=None, primary_key=True)
 
     message: str
     is_from_from_customer: bool
-    is_viewed: bool = Field(default=False)
+    # Legacy flag, viewed state comes from read watermarks in chat_summaries. Still mapped,
+    # so inserts fill the NOT NULL column until a migration drops it after
+    # backfill_read_watermarks has run
+    is_viewed: bool = Field(default=False, sa_column_kwargs={"server_default": sa.false()})
 
     chat_id: int = Field(foreign_key="chats.id")
     chat: Chat = Relationship(back_populates="messages")
+    # Dense position of the message in its chat, starting from 1, or lower for messages
+    # written before it was introduced and numbered by backfill_message_seq after newer ones.
+    # NULL for those until the backfill has run
+    seq: Optional[int]
+    # Sender generated id, retries of a send carry the same one
+    client_msg_id: Optional[str] = Field(max_length=64)
+
+
+class ChatSummary(BaseModel, TimeStampedMixin, table=True):
+    """
+    Inbox projection of a chat as seen by one of its participants
+    """
+
+    __tablename__ = "chat_summaries"
+    __table_args__ = (
+        sa.Index(
+            "ix_chat_summaries_customer_id_last_message_created_at",
+            "customer_id",
+            sa.text("last_message_created_at DESC NULLS LAST"),
+            sa.text("chat_id DESC"),
+        ),
+        # Sync reads rows of a customer and rows showing them changed since its cursor,
+        # the latter are also updated when the customer is renamed
+        sa.Index("ix_chat_summaries_customer_id_changed_at", "customer_id", "changed_at"),
+        sa.Index("ix_chat_summaries_with_customer_id_changed_at", "with_customer_id", "changed_at"),
+    )
+
+    chat_id: int = Field(foreign_key="chats.id", primary_key=True)
+    customer_id: int = Field(foreign_key="customers.id", primary_key=True)
+
+    with_customer_id: int = Field(foreign_key="customers.id")
+    with_customer_name: str = Field(max_length=100)
+
+    last_message: Optional[str]
+    last_message_sender_id: Optional[int]
+    last_message_created_at: Optional[datetime]
+    last_message_seq: Optional[int]
+
+    last_received_message_id: Optional[int]
+    # Read watermark, every received message with id up to this one is viewed
+    last_read_message_id: Optional[int]
+    unread_count: int = Field(default=0)
+
+    # Set by the database on every write, sync cursors don't depend on clocks of workers.
+    # Raw SQL updates have to set it themselves
+    changed_at: Optional[datetime] = Field(
+        default=None,
+        sa_column=sa.Column(
+            sa.DateTime,
+            nullable=False,
+            server_default=sa.text("timezone('utc', now())"),
+            onupdate=sa.func.timezone("utc", sa.func.now()),
+        ),
+    )
+
+    @property
+    def viewed_all_messages(self) -> bool | None:
+        if self.last_received_message_id is None:
+            return None
+        return (self.last_read_message_id or 0) >= self.last_received_message_id
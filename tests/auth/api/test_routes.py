@@ -3,15 +3,20 @@ from datetime import date
 from faker.proxy import Faker
 import json
 import pytest
+import time
+import uuid
 from typing import Any
-from unittest.mock import MagicMock, ANY
+from unittest.mock import MagicMock, ANY, patch
 from starlette.testclient import TestClient
 from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlalchemy.orm import joinedload
 from sqlalchemy.exc import InvalidRequestError
 
+from auth.revocation import refresh_token_revocations
 from auth.tokens import JWTToken
 from config.settings import settings
+from core.ratelimit import sms_phone_limiter
 from models import User
 from models.customer import Customer
 from models.chat import Chat
@@ -101,9 +106,11 @@ class TestCheckSignupCode():
             "email": str(user.email)
         }
 
-    def test_ok(
+    @pytest.mark.anyio
+    async def test_ok(
         self,
         session: Session,
+        async_session: AsyncSession,
         client: TestClient,
         mock_get_code: MagicMock,
         assert_num_queries
@@ -124,10 +131,12 @@ class TestCheckSignupCode():
 
         result = response.json()
 
-        assert UserAccessToken.from_string(result["access_token"], session).user == user
         assert (
-            UserRefreshToken.from_string(result["refresh_token"], session).user == user
-        )
+            await UserAccessToken.from_string(result["access_token"], async_session)
+        ).user == user
+        assert (
+            await UserRefreshToken.from_string(result["refresh_token"], async_session)
+        ).user == user
 
     def test_invalid_code(
         self,
@@ -195,6 +204,26 @@ class TestGetSigninCode():
 
         assert response.status_code == 404
 
+    def test_rate_limited(
+        self,
+        session: Session,
+        client: TestClient,
+        user: User,
+        mock_send_code: MagicMock,
+    ):
+        # Fresh bucket name, so buckets left in Redis by earlier runs don't count
+        with (
+            patch.object(sms_phone_limiter, "name", f"test_{uuid.uuid4().hex}"),
+            patch.object(sms_phone_limiter, "burst", 1),
+        ):
+            first = client.get(self.url.format(user.phone_number))
+            second = client.get(self.url.format(user.phone_number))
+
+        assert first.status_code == 200
+        assert second.status_code == 429
+        assert int(second.headers["Retry-After"]) > 0
+        mock_send_code.assert_called_once_with(user.phone_number)
+
 
 class TestCheckSigninCode():
     url = "/auth/signin/{}/"
@@ -205,9 +234,11 @@ class TestCheckSigninCode():
             "code": "some-code",
         }
 
-    def test_ok(
+    @pytest.mark.anyio
+    async def test_ok(
         self,
         session: Session,
+        async_session: AsyncSession,
         client: TestClient,
         user: User,
         post_data: dict,
@@ -224,10 +255,12 @@ class TestCheckSigninCode():
 
         result = response.json()
 
-        assert UserAccessToken.from_string(result["access_token"], session).user == user
         assert (
-            UserRefreshToken.from_string(result["refresh_token"], session).user == user
-        )
+            await UserAccessToken.from_string(result["access_token"], async_session)
+        ).user == user
+        assert (
+            await UserRefreshToken.from_string(result["refresh_token"], async_session)
+        ).user == user
 
     def test_invalid_code(
         self,
@@ -270,9 +303,11 @@ class TestRefreshToken:
     def refresh_token(self, user: User):
         return UserRefreshToken.for_user(user)
 
-    def test_ok(
+    @pytest.mark.anyio
+    async def test_ok(
         self,
         session: Session,
+        async_session: AsyncSession,
         client: TestClient,
         refresh_token: UserRefreshToken,
         user: User,
@@ -285,10 +320,53 @@ class TestRefreshToken:
 
         assert response.status_code == 200
         assert result["refresh_token"] != str(refresh_token)
-        assert UserAccessToken.from_string(result["access_token"], session).user == user
         assert (
-            UserRefreshToken.from_string(result["refresh_token"], session).user == user
-        )
+            await UserAccessToken.from_string(result["access_token"], async_session)
+        ).user == user
+        new_refresh_token = await UserRefreshToken.from_string(result["refresh_token"], async_session)
+        assert new_refresh_token.user == user
+        assert new_refresh_token["family"] == refresh_token["jti"]
+
+    @pytest.mark.anyio
+    async def test_retried_token(
+        self,
+        client: TestClient,
+        refresh_token: UserRefreshToken,
+    ):
+        response = client.post(self.url, json={"token": str(refresh_token)})
+        assert response.status_code == 200
+
+        # Within the grace period the family stays valid and the new refresh token gets
+        # the same jti, so only one of the two can be exchanged
+        retried = client.post(self.url, json={"token": str(refresh_token)})
+        assert retried.status_code == 200
+        first = await UserRefreshToken.verify(response.json()["refresh_token"])
+        second = await UserRefreshToken.verify(retried.json()["refresh_token"])
+        assert second["jti"] == first["jti"]
+        assert second["family"] == first["family"]
+
+        response = client.post(self.url, json={"token": retried.json()["refresh_token"]})
+        assert response.status_code == 200
+
+    def test_reused_token(
+        self,
+        client: TestClient,
+        refresh_token: UserRefreshToken,
+    ):
+        response = client.post(self.url, json={"token": str(refresh_token)})
+        assert response.status_code == 200
+        new_refresh_token = response.json()["refresh_token"]
+
+        # Grace period is over
+        with patch.object(refresh_token_revocations, "grace", datetime.timedelta(0)):
+            time.sleep(0.01)
+            response = client.post(self.url, json={"token": str(refresh_token)})
+        assert response.status_code == 400
+        assert response.json() == {"detail": "Token is invalid or expired"}
+
+        # Whole family is revoked, including the token issued for the first use
+        response = client.post(self.url, json={"token": new_refresh_token})
+        assert response.status_code == 400
 
     def test_invalid_token(
         self,
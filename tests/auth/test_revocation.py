@@ -0,0 +1,59 @@
+import datetime
+import pytest
+import time
+
+from unittest.mock import AsyncMock, patch
+
+from auth.revocation import FAMILY_REVOKED, FIRST_USE, IN_GRACE, USED, RefreshTokenRevocations
+
+
+class TestRefreshTokenRevocations():
+    @pytest.fixture
+    def revocations(self):
+        return RefreshTokenRevocations(
+            size=1024, hashes=5, lifetime=datetime.timedelta(days=1), grace=datetime.timedelta(seconds=1)
+        )
+
+    def test_offsets(self, revocations: RefreshTokenRevocations):
+        offsets = revocations._offsets("jti")
+
+        assert offsets == revocations._offsets("jti")
+        assert offsets != revocations._offsets("other")
+        assert len(offsets) == 5
+        assert all(0 <= offset < 1024 for offset in offsets)
+
+    def test_family(self):
+        assert RefreshTokenRevocations.family({"jti": "jti", "family": "family"}) == "family"
+        assert RefreshTokenRevocations.family({"jti": "jti"}) == "jti"
+
+    @pytest.mark.anyio
+    @pytest.mark.parametrize("result", [FIRST_USE, USED, FAMILY_REVOKED, IN_GRACE])
+    async def test_use(self, revocations: RefreshTokenRevocations, result: int):
+        claims = {"jti": "jti", "family": "family", "exp": time.time() + 60}
+        successor = b"successor" if result in (FIRST_USE, IN_GRACE) else b""
+        with patch("auth.revocation.redis_manager") as redis_manager:
+            redis_manager.run_script = AsyncMock(return_value=[result, successor])
+
+            assert await revocations.use(claims) == (result, successor.decode("utf-8") or None)
+
+        # One script call is the only Redis round trip
+        redis_manager.run_script.assert_called_once()
+        keys = redis_manager.run_script.call_args.kwargs["keys"]
+        args = redis_manager.run_script.call_args.kwargs["args"]
+        assert keys[2:] == ["refresh_family_revoked_family", "refresh_used_jti"]
+        assert args[0] == 86400000
+        # Used flag lives until the token expires
+        assert 59000 <= args[1] <= 60000
+        assert args[2] == 1000
+        assert args[4:] == revocations._offsets("jti")
+
+    @pytest.mark.anyio
+    async def test_use_reserves_new_successor(self, revocations: RefreshTokenRevocations):
+        claims = {"jti": "jti", "exp": time.time() + 60}
+        with patch("auth.revocation.redis_manager") as redis_manager:
+            redis_manager.run_script = AsyncMock(return_value=[FIRST_USE, b"successor"])
+            await revocations.use(claims)
+            await revocations.use(claims)
+
+        first, second = [call.kwargs["args"][3] for call in redis_manager.run_script.call_args_list]
+        assert first != second
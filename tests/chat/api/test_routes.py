@@ -1,13 +1,17 @@
+import base64
 import json
 import datetime
 import pytest
 
 from fastapi import WebSocketDisconnect
+from sqlalchemy import update
 from starlette.testclient import TestClient
-from sqlmodel import Session, select
+from sqlmodel import Session, col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from unittest.mock import MagicMock
 
-from models import User, Customer, ChatMessage, Chat
+from chat.summaries import backfill_read_watermarks, mark_viewed, rebuild_chat_summaries
+from models import User, Customer, ChatMessage, Chat, ChatSummary
 from tests import factories, asserts
 
 
@@ -32,11 +36,12 @@ class TestChatWS():
         setup: tuple,
         assert_num_queries
     ):
-        _, chat = setup
+        messages, chat = setup
         with as_user.websocket_connect(self.url) as websocket:
             message = {"to_customer_id": other_customer.id, "message": "some message"}
             websocket.send_json(json.dumps(message))
             data = json.loads(websocket.receive_json())
+            assert data["seq"] == messages[-1].seq + 1
             message["from_customer_id"] = customer.id
             for key in ('message', 'from_customer_id', 'to_customer_id'):
                 assert message[key] == data[key]
@@ -50,14 +55,82 @@ class TestChatWS():
                 other_message["created_at"] = db_message.created_at.isoformat()
                 other_message["from_customer_id"] = other_customer.id
                 other_message["id"] = db_message.id
+                other_message["seq"] = db_message.seq
+                other_message["client_msg_id"] = None
                 assert json.loads(data) == other_message
                 assert db_message.is_from_from_customer == False
                 assert db_message.chat_id == chat.id
+                assert db_message.seq == messages[-1].seq + 2
 
                 data_for_from_customer = websocket.receive_json()
                 data_for_from_customer = json.loads(data_for_from_customer)
+                assert data_for_from_customer.pop("delivery_id")
                 assert data_for_from_customer == other_message
 
+    @pytest.mark.anyio
+    async def test_resume_from_last_seen_id(
+        self,
+        session: Session,
+        as_user: TestClient,
+        other_customer: Customer,
+        as_other_customer: TestClient,
+        customer: Customer,
+        setup: tuple,
+    ):
+        with as_other_customer.websocket_connect(self.url) as other_websocket:
+            with as_user.websocket_connect(self.url) as websocket:
+                other_websocket.send_json(json.dumps({"to_customer_id": customer.id, "message": "first"}))
+                other_websocket.receive_json()
+                first = json.loads(websocket.receive_json())
+
+            # Sent while customer is offline
+            other_websocket.send_json(json.dumps({"to_customer_id": customer.id, "message": "second"}))
+            other_websocket.receive_json()
+
+        with as_user.websocket_connect(f"{self.url}?last_seen_id={first['delivery_id']}") as websocket:
+            missed = json.loads(websocket.receive_json())
+
+        assert first["message"] == "first"
+        assert missed["message"] == "second"
+
+    @pytest.mark.anyio
+    async def test_new_chat(self, session: Session, as_user: TestClient, customer: Customer):
+        with_customer = factories.CustomerFactory()
+        with as_user.websocket_connect(self.url) as websocket:
+            for text in ("first", "second"):
+                websocket.send_json(json.dumps({"to_customer_id": with_customer.id, "message": text}))
+                websocket.receive_json()
+
+        chat = session.exec(select(Chat).where(Chat.from_customer_id == customer.id)).one()
+        assert (chat.low_customer_id, chat.high_customer_id) == tuple(sorted((customer.id, with_customer.id)))
+        assert chat.last_seq == 2
+        assert len(session.exec(select(ChatSummary).where(ChatSummary.chat_id == chat.id)).all()) == 2
+
+    @pytest.mark.anyio
+    async def test_retry_with_client_msg_id(
+        self,
+        session: Session,
+        as_user: TestClient,
+        other_customer: Customer,
+        setup: tuple,
+    ):
+        _, chat = setup
+        message = {"to_customer_id": other_customer.id, "message": "retried", "client_msg_id": "abc"}
+        with as_user.websocket_connect(self.url) as websocket:
+            websocket.send_json(json.dumps(message))
+            ack = json.loads(websocket.receive_json())
+            websocket.send_json(json.dumps(message))
+            retry_ack = json.loads(websocket.receive_json())
+
+        assert retry_ack == ack
+        assert ack["client_msg_id"] == "abc"
+        assert len(session.exec(select(ChatMessage).where(ChatMessage.message == "retried")).all()) == 1
+
+    @pytest.mark.anyio
+    async def test_invalid_last_seen_id(self, as_user: TestClient):
+        with as_user.websocket_connect(f"{self.url}?last_seen_id=qqq") as websocket:
+            assert websocket.receive_text() == "Invalid last_seen_id"
+
 
     @pytest.mark.anyio
     async def test_invalid_cases(
@@ -81,11 +154,21 @@ class TestChatWS():
             data = websocket.receive_text()
             assert data == "No to_customer_id in data"
 
+            message = {"to_customer_id": "abc", "message": "some"}
+            websocket.send_json(json.dumps(message))
+            data = websocket.receive_text()
+            assert data == "Invalid to_customer_id"
+
             message = {"to_customer_id": other_customer.id}
             websocket.send_json(json.dumps(message))
             data = websocket.receive_text()
             assert data == "No message in data"
 
+            message = {"to_customer_id": other_customer.id, "message": "some", "client_msg_id": 1}
+            websocket.send_json(json.dumps(message))
+            data = websocket.receive_text()
+            assert data == "Invalid client_msg_id"
+
             message = {"to_customer_id": 999, "message": "some"}
             websocket.send_json(json.dumps(message))
             data = websocket.receive_text()
@@ -109,6 +192,7 @@ class TestGetChat():
         messages.reverse()
         return [{
             "id": message.id,
+            "seq": message.seq,
             "message": message.message,
             "from_customer_id": customer.id,
             "to_customer_id": other_customer.id,
@@ -132,13 +216,149 @@ class TestGetChat():
 
         assert response.status_code == 200
         assert response.json()["items"] == expect_response
+        assert response.json()["next_cursor"] is None
+        assert response.json()["prev_cursor"] is None
+
+    @pytest.mark.anyio
+    async def test_cursor_pagination(
+        self,
+        session: Session,
+        as_user: TestClient,
+        customer: Customer,
+        setup: tuple,
+        expect_response
+    ):
+        other_customer, messages = setup
+        response = as_user.get(self.url.format(other_customer.id), params={"limit": 2})
+
+        assert response.status_code == 200
+        first_page = response.json()
+        assert first_page["items"] == expect_response[:2]
+        assert first_page["prev_cursor"] is None
+
+        response = as_user.get(
+            self.url.format(other_customer.id),
+            params={"limit": 2, "cursor": first_page["next_cursor"]},
+        )
+
+        assert response.status_code == 200
+        second_page = response.json()
+        assert second_page["items"] == expect_response[2:]
+        assert second_page["next_cursor"] is None
+
+        response = as_user.get(
+            self.url.format(other_customer.id),
+            params={"limit": 2, "cursor": second_page["prev_cursor"]},
+        )
+
+        assert response.status_code == 200
+        assert response.json()["items"] == expect_response[:2]
+        assert response.json()["prev_cursor"] is None
+
+    @pytest.mark.anyio
+    async def test_legacy_cursor(
+        self,
+        session: Session,
+        as_user: TestClient,
+        setup: tuple,
+        expect_response
+    ):
+        other_customer, messages = setup
+        # Cursors issued before seq point at a message by created_at and id
+        newest = messages[0]
+        cursor = base64.urlsafe_b64encode(json.dumps({
+            "created_at": newest.created_at.isoformat(),
+            "id": newest.id,
+            "direction": "before",
+        }).encode("utf-8")).decode("utf-8")
+
+        response = as_user.get(self.url.format(other_customer.id), params={"cursor": cursor})
+
+        assert response.status_code == 200
+        assert response.json()["items"] == expect_response[1:]
+
+    @pytest.mark.anyio
+    async def test_unnumbered_messages(
+        self,
+        session: Session,
+        as_user: TestClient,
+        setup: tuple,
+        expect_response
+    ):
+        other_customer, messages = setup
+        # Written before seq was introduced and not backfilled yet
+        unnumbered_ids = [message.id for message in messages[1:]]
+        session.execute(
+            update(ChatMessage).where(col(ChatMessage.id).in_(unnumbered_ids)).values(seq=None)
+        )
+        session.commit()
+        expect_response = [
+            {**message, "seq": None} if message["id"] in unnumbered_ids else message
+            for message in expect_response
+        ]
+
+        response = as_user.get(self.url.format(other_customer.id), params={"limit": 2})
+
+        assert response.status_code == 200
+        first_page = response.json()
+        assert first_page["items"] == expect_response[:2]
+
+        response = as_user.get(
+            self.url.format(other_customer.id),
+            params={"limit": 2, "cursor": first_page["next_cursor"]},
+        )
+
+        assert response.status_code == 200
+        second_page = response.json()
+        assert second_page["items"] == expect_response[2:]
+        assert second_page["next_cursor"] is None
+
+        response = as_user.get(
+            self.url.format(other_customer.id),
+            params={"limit": 2, "cursor": second_page["prev_cursor"]},
+        )
+
+        assert response.status_code == 200
+        assert response.json()["items"] == expect_response[:2]
+
+    @pytest.mark.anyio
+    async def test_viewed_by_other_customer(
+        self,
+        async_session: AsyncSession,
+        as_user: TestClient,
+        setup: tuple,
+        expect_response
+    ):
+        other_customer, messages = setup
+        await rebuild_chat_summaries(async_session)
+        await mark_viewed(async_session, messages[0].chat_id, other_customer.id)
+        await async_session.commit()
+
+        response = as_user.get(self.url.format(other_customer.id))
+
+        assert response.status_code == 200
+        assert response.json()["items"] == [
+            {**message, "is_viewed": True} for message in expect_response
+        ]
+
+    @pytest.mark.anyio
+    async def test_invalid_cursor(
+        self,
+        session: Session,
+        as_user: TestClient,
+        setup: tuple,
+    ):
+        other_customer, _ = setup
+        response = as_user.get(self.url.format(other_customer.id), params={"cursor": "qqq"})
+
+        asserts.response_error_with_detail(response, 400, "Cursor is invalid")
 
 
 class TestViewChatMessages():
     url = "/chat/{}/view/"
 
     @pytest.fixture
-    def setup(self, customer: Customer):
+    async def setup(self, async_session: AsyncSession, customer: Customer):
         other_customer = factories.CustomerFactory()
         chat = factories.ChatFactory(from_customer_id=customer.id, to_customer_id=other_customer.id)
         
@@ -149,6 +369,7 @@ class TestViewChatMessages():
             {"is_from_from_customer": False, "created_at": datetime.datetime(2028, 5, 3)},
         ]
         messages = [factories.ChatMessageFactory(chat=chat, **data) for data in messages_data]
+        await rebuild_chat_summaries(async_session)
 
         return (other_customer, messages)
 
@@ -162,28 +383,49 @@ class TestViewChatMessages():
         assert_num_queries,
     ):
         other_customer, messages = setup
-        with assert_num_queries(3):
+        with assert_num_queries(2):
             response = as_user.put(self.url.format(other_customer.id))
 
         assert response.status_code == 200
-        
-        viewed_messages = session.exec(select(ChatMessage).where(ChatMessage.is_viewed)).all()
-        assert len(viewed_messages) == 2
-        for message in viewed_messages:
-            assert message.is_from_from_customer == False
-            assert message.created_at == datetime.datetime(2018, 5, 3)
+
+        summaries = {
+            summary.customer_id: summary
+            for summary in session.exec(select(ChatSummary)).all()
+        }
+        for summary in summaries.values():
+            session.refresh(summary)
+
+        assert summaries[customer.id].last_read_message_id == messages[3].id
+        assert summaries[customer.id].unread_count == 0
+        assert summaries[other_customer.id].last_read_message_id is None
+        assert summaries[other_customer.id].unread_count == 1
+
+        # Viewed state comes from the watermark, a message dated ahead is viewed as well
+        response = as_user.get(f"/chat/{other_customer.id}/")
+        is_viewed = {item["id"]: item["is_viewed"] for item in response.json()["items"]}
+        assert is_viewed == {
+            messages[0].id: False,
+            messages[1].id: True,
+            messages[2].id: True,
+            messages[3].id: True,
+        }
 
 
 class TestGetChats():
     url = "/chat/"
 
     @staticmethod
-    def _setup(
-        customer: Customer, is_viewed: bool = True, have_to_messages: bool = True, have_messages: bool = True
+    async def _setup(
+        session: AsyncSession,
+        customer: Customer,
+        is_viewed: bool = True,
+        have_to_messages: bool = True,
+        have_messages: bool = True,
     ):
         other_customer = factories.CustomerFactory()
         chat = factories.ChatFactory(from_customer_id=customer.id, to_customer_id=other_customer.id)
         if not have_messages:
+            await rebuild_chat_summaries(session)
             return (other_customer, [], chat)
 
         messages_data = [
@@ -192,9 +434,13 @@ class TestGetChats():
         if have_to_messages:
             messages_data.extend([
                 {"is_from_from_customer": False, "created_at": datetime.datetime(2018, 5, 3)},
-                {"is_from_from_customer": False, "created_at": datetime.datetime(2019, 5, 3), "is_viewed": is_viewed},
+                {"is_from_from_customer": False, "created_at": datetime.datetime(2019, 5, 3)},
             ])
         messages = [factories.ChatMessageFactory(chat=chat, **data) for data in messages_data]
+        await rebuild_chat_summaries(session)
+        if is_viewed:
+            await mark_viewed(session, chat.id, customer.id)
+            await session.commit()
 
         return (other_customer, messages, chat)
 
@@ -212,13 +458,17 @@ class TestGetChats():
                 "last_message_sender_id": None,
                 "viewed_all_messages": None,
                 "last_message_created_at": None,
+                "last_message_seq": None,
+                "unread_count": 0,
             }]
 
         last_message = messages[-1]
         last_message_sender_id = other_customer.id
+        unread_count = 0 if is_viewed else 2
         if not have_to_messages:
             is_viewed = None
             last_message_sender_id = customer.id
+            unread_count = 0
         return [{
             "id": chat.id,
             "name": other_customer.name,
@@ -227,17 +477,19 @@ class TestGetChats():
             "last_message_sender_id": last_message_sender_id,
             "viewed_all_messages": is_viewed,
             "last_message_created_at": last_message.created_at.isoformat(),
+            "last_message_seq": last_message.seq,
+            "unread_count": unread_count,
         }]
         
     @pytest.mark.anyio
     async def test_ok_viewed(
         self,
-        session: Session,
+        async_session: AsyncSession,
         as_user: TestClient,
         customer: Customer,
         assert_num_queries,
     ):
-        setup = self._setup(customer)
+        setup = await self._setup(async_session, customer)
         other_customer, messages, chat = setup
         with assert_num_queries(2):
             response = as_user.get(self.url)
@@ -248,12 +500,12 @@ class TestGetChats():
     @pytest.mark.anyio
     async def test_ok_not_viewed(
         self,
-        session: Session,
+        async_session: AsyncSession,
         as_user: TestClient,
         customer: Customer,
         assert_num_queries,
     ):
-        setup = self._setup(customer, is_viewed=False)
+        setup = await self._setup(async_session, customer, is_viewed=False)
         other_customer, messages, chat = setup
         with assert_num_queries(2):
             response = as_user.get(self.url)
@@ -266,12 +518,12 @@ class TestGetChats():
     @pytest.mark.anyio
     async def test_no_to_message(
         self,
-        session: Session,
+        async_session: AsyncSession,
         as_user: TestClient,
         customer: Customer,
         assert_num_queries,
     ):
-        setup = self._setup(customer, have_to_messages=False)
+        setup = await self._setup(async_session, customer, have_to_messages=False)
         other_customer, messages, chat = setup
         with assert_num_queries(2):
             response = as_user.get(self.url)
@@ -284,12 +536,12 @@ class TestGetChats():
     @pytest.mark.anyio
     async def test_no_messages(
         self,
-        session: Session,
+        async_session: AsyncSession,
         as_user: TestClient,
         customer: Customer,
         assert_num_queries,
     ):
-        setup = self._setup(customer, have_messages=False)
+        setup = await self._setup(async_session, customer, have_messages=False)
         other_customer, messages, chat = setup
         with assert_num_queries(2):
             response = as_user.get(self.url)
@@ -298,4 +550,221 @@ class TestGetChats():
         assert response.json()["items"] == self.expect_response(
             customer, other_customer, chat, messages, have_to_messages=False
         )
-        
\ No newline at end of file
+
+    @pytest.mark.anyio
+    async def test_partially_viewed(
+        self,
+        async_session: AsyncSession,
+        as_user: TestClient,
+        customer: Customer,
+    ):
+        other_customer, messages, chat = await self._setup(async_session, customer, is_viewed=False)
+        await async_session.execute(
+            update(ChatMessage).where(ChatMessage.id == messages[1].id).values(is_viewed=True)
+        )
+        await async_session.commit()
+        await backfill_read_watermarks(async_session)
+        await rebuild_chat_summaries(async_session)
+
+        response = as_user.get(self.url)
+
+        assert response.status_code == 200
+        item = response.json()["items"][0]
+        assert item["viewed_all_messages"] is False
+        assert item["unread_count"] == 1
+
+    @pytest.mark.anyio
+    async def test_new_message_after_view(
+        self,
+        async_session: AsyncSession,
+        as_user: TestClient,
+        customer: Customer,
+    ):
+        other_customer, messages, chat = await self._setup(async_session, customer)
+        await mark_viewed(async_session, chat.id, customer.id)
+        await async_session.commit()
+        new_message = factories.ChatMessageFactory(chat=chat, is_from_from_customer=False)
+        await rebuild_chat_summaries(async_session)
+
+        response = as_user.get(self.url)
+
+        assert response.status_code == 200
+        item = response.json()["items"][0]
+        assert item["last_message"] == new_message.message
+        assert item["viewed_all_messages"] is False
+        assert item["unread_count"] == 1
+
+    @pytest.mark.anyio
+    async def test_customer_renamed(
+        self,
+        async_session: AsyncSession,
+        as_user: TestClient,
+        customer: Customer,
+    ):
+        other_customer, messages, chat = await self._setup(async_session, customer)
+        other_customer = await async_session.get(Customer, other_customer.id)
+        other_customer.name = "Renamed"
+        async_session.add(other_customer)
+        await async_session.commit()
+
+        response = as_user.get(self.url)
+
+        assert response.status_code == 200
+        assert response.json()["items"][0]["name"] == "Renamed"
+
+
+class TestSync():
+    url = "/chat/sync/"
+
+    @staticmethod
+    def _sync_all(client: TestClient, cursor: str, limit: int) -> tuple[list, str]:
+        messages = list()
+        for _ in range(20):
+            data = client.get(TestSync.url, params={"since": cursor, "limit": limit}).json()
+            messages.extend(message["id"] for message in data["messages"])
+            cursor = data["cursor"]
+            if not data["has_more"]:
+                return messages, cursor
+        raise AssertionError("Sync doesn't finish")
+
+    @pytest.mark.anyio
+    async def test_ok(
+        self,
+        async_session: AsyncSession,
+        as_user: TestClient,
+        customer: Customer,
+        other_customer: Customer,
+        assert_num_queries,
+    ):
+        chat = factories.ChatFactory(from_customer_id=customer.id, to_customer_id=other_customer.id)
+        old_message = factories.ChatMessageFactory(chat=chat, created_at=datetime.datetime(2018, 5, 3))
+        await rebuild_chat_summaries(async_session)
+
+        response = as_user.get(self.url)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["messages"] == data["chats"] == data["read_states"] == []
+        assert not data["has_more"]
+
+        new_message = factories.ChatMessageFactory(chat=chat, is_from_from_customer=False)
+        await rebuild_chat_summaries(async_session)
+        await mark_viewed(async_session, chat.id, other_customer.id)
+        await async_session.commit()
+
+        # Customer comes from token claims, the database clock is read, then messages
+        # and summaries at once
+        with assert_num_queries(2):
+            response = as_user.get(self.url, params={"since": data["cursor"]})
+
+        assert response.status_code == 200
+        data = response.json()
+        assert [message["id"] for message in data["messages"]] == [new_message.id]
+        assert data["messages"][0]["from_customer_id"] == other_customer.id
+        assert [chat_data["id"] for chat_data in data["chats"]] == [chat.id]
+        assert data["chats"][0]["unread_count"] == 1
+        assert data["read_states"] == [
+            {"chat_id": chat.id, "customer_id": other_customer.id, "last_read_message_id": old_message.id}
+        ]
+        assert not data["has_more"]
+
+    @pytest.mark.anyio
+    async def test_late_commit(
+        self,
+        session: Session,
+        async_session: AsyncSession,
+        as_user: TestClient,
+        customer: Customer,
+        other_customer: Customer,
+    ):
+        chat = factories.ChatFactory(from_customer_id=customer.id, to_customer_id=other_customer.id)
+        await rebuild_chat_summaries(async_session)
+        cursor = as_user.get(self.url).json()["cursor"]
+
+        # The first message is not committed yet when the second one is synced
+        late_message, message = factories.ChatMessageFactory.create_batch(2, chat=chat)
+        late_data, message_id = late_message.dict(), message.id
+        session.delete(late_message)
+        session.commit()
+        await rebuild_chat_summaries(async_session)
+        data = as_user.get(self.url, params={"since": cursor}).json()
+        assert [message_data["id"] for message_data in data["messages"]] == [message_id]
+
+        session.add(ChatMessage(**late_data))
+        session.commit()
+        await rebuild_chat_summaries(async_session)
+        data = as_user.get(self.url, params={"since": data["cursor"]}).json()
+
+        assert late_data["id"] in [message_data["id"] for message_data in data["messages"]]
+
+    @pytest.mark.anyio
+    async def test_has_more(
+        self,
+        async_session: AsyncSession,
+        as_user: TestClient,
+        customer: Customer,
+        other_customer: Customer,
+    ):
+        chat = factories.ChatFactory(from_customer_id=customer.id, to_customer_id=other_customer.id)
+        await rebuild_chat_summaries(async_session)
+        cursor = as_user.get(self.url).json()["cursor"]
+        messages = factories.ChatMessageFactory.create_batch(3, chat=chat)
+        await rebuild_chat_summaries(async_session)
+
+        response = as_user.get(self.url, params={"since": cursor, "limit": 2})
+        assert response.status_code == 200
+        data = response.json()
+        assert len(data["messages"]) <= 2
+        assert data["has_more"]
+
+        synced, _ = self._sync_all(as_user, cursor, limit=2)
+        assert sorted(set(synced)) == [message.id for message in messages]
+
+    @pytest.mark.anyio
+    async def test_same_timestamp(
+        self,
+        async_session: AsyncSession,
+        as_user: TestClient,
+        customer: Customer,
+    ):
+        cursor = as_user.get(self.url).json()["cursor"]
+        chats = [
+            factories.ChatFactory(from_customer_id=customer.id, to_customer_id=factories.CustomerFactory().id)
+            for _ in range(3)
+        ]
+        messages = [factories.ChatMessageFactory(chat=chat) for chat in chats]
+        await rebuild_chat_summaries(async_session)
+        await async_session.execute(update(ChatSummary).values(changed_at=datetime.datetime.utcnow()))
+        await async_session.commit()
+
+        synced, _ = self._sync_all(as_user, cursor, limit=1)
+
+        assert sorted(set(synced)) == [message.id for message in messages]
+
+    @pytest.mark.anyio
+    async def test_changed_at_set_by_database(
+        self,
+        async_session: AsyncSession,
+        as_user: TestClient,
+        customer: Customer,
+        other_customer: Customer,
+    ):
+        chat = factories.ChatFactory(from_customer_id=customer.id, to_customer_id=other_customer.id)
+        await rebuild_chat_summaries(async_session)
+        cursor = as_user.get(self.url).json()["cursor"]
+
+        # Written by a worker whose clock is behind, the change is still after the cursor
+        await async_session.execute(
+            update(ChatSummary)
+            .where(ChatSummary.chat_id == chat.id, ChatSummary.customer_id == other_customer.id)
+            .values(last_read_message_id=1, updated_at=datetime.datetime(2018, 5, 3))
+        )
+        await async_session.commit()
+
+        data = as_user.get(self.url, params={"since": cursor}).json()
+
+        assert [state["customer_id"] for state in data["read_states"]] == [other_customer.id]
+
+    def test_invalid_cursor(self, as_user: TestClient):
+        response = as_user.get(self.url, params={"since": "qqq"})
+
+        asserts.response_error_with_detail(response, 400, "Cursor is invalid")
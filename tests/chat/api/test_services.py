@@ -0,0 +1,479 @@
+import asyncio
+import json
+import pytest
+
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from chat.api.services import (
+    WORKER_ID, ChatWorker, OverflowPolicy, WSConnection, WSManager, stream_id_key
+)
+
+
+class FakeWebSocket():
+    def __init__(self):
+        self.sent = list()
+        self.closed_with = None
+        self.can_send = asyncio.Event()
+        self.can_send.set()
+
+    async def send_json(self, data):
+        await self.can_send.wait()
+        self.sent.append(data)
+
+    async def send_text(self, data):
+        await self.can_send.wait()
+        self.sent.append(f"text:{data}")
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+class TestChatWorker():
+    @pytest.mark.anyio
+    async def test_retry_acked_from_redis(self):
+        ack = {"id": 1, "seq": 1, "client_msg_id": "abc"}
+        customer = MagicMock(id=1)
+        data = {"chat_id": 1, "to_customer_id": 2, "client_msg_id": "abc"}
+
+        with patch("chat.api.services.redis_manager") as redis_manager:
+            redis_manager.set_cache_value = AsyncMock(return_value=None)
+            redis_manager.get_cache_value = AsyncMock(return_value=json.dumps(ack).encode("utf-8"))
+
+            # No session, the database must not be touched
+            assert await ChatWorker.process_and_enhance_message(None, customer, data) == (ack, False)
+
+        redis_manager.get_cache_value.assert_called_once_with("ws_sent_1_1_abc")
+
+    @pytest.mark.anyio
+    async def test_unknown_recipient(self):
+        customer = MagicMock(id=1)
+        result = MagicMock()
+        result.one_or_none.return_value = None
+        result.first.return_value = None
+        session = MagicMock(exec=AsyncMock(return_value=result))
+        message_str = json.dumps({"to_customer_id": 999, "message": "some"})
+
+        with (
+            patch("chat.api.services.chat_lookup_cache") as chat_lookup_cache,
+            patch("chat.api.services.summaries") as summaries,
+        ):
+            chat_lookup_cache.get = AsyncMock(return_value=None)
+
+            assert await ChatWorker.validate_message(session, None, customer, message_str) == (
+                None, "No chat found"
+            )
+
+        summaries.create_chat.assert_not_called()
+
+    @pytest.mark.anyio
+    async def test_new_chat_not_cached(self):
+        customer = MagicMock(id=1)
+        result = MagicMock()
+        result.one_or_none.return_value = None
+        result.first.return_value = 2
+        session = MagicMock(exec=AsyncMock(return_value=result), commit=AsyncMock())
+        message_str = json.dumps({"to_customer_id": 2, "message": "some"})
+
+        with (
+            patch("chat.api.services.chat_lookup_cache") as chat_lookup_cache,
+            patch("chat.api.services.summaries") as summaries,
+        ):
+            chat_lookup_cache.get = AsyncMock(return_value=None)
+            chat_lookup_cache.set = AsyncMock()
+            summaries.create_chat = AsyncMock(return_value=MagicMock(id=7, from_customer_id=1))
+
+            data, err = await ChatWorker.validate_message(session, None, customer, message_str)
+
+        assert err is None
+        assert data["chat_id"] == 7
+        # Chat is committed with the message, it can't be cached before that
+        chat_lookup_cache.set.assert_not_called()
+        session.commit.assert_not_called()
+
+
+class TestWSConnection():
+    @pytest.fixture
+    def websocket(self):
+        return FakeWebSocket()
+
+    @staticmethod
+    async def _drain():
+        for _ in range(50):
+            await asyncio.sleep(0)
+
+    @pytest.mark.anyio
+    async def test_sends_in_order(self, websocket: FakeWebSocket):
+        connection = WSConnection(websocket, 1, max_size=10)
+        connection.start()
+
+        for i in range(5):
+            await connection.send(json.dumps({"id": i}))
+        await self._drain()
+
+        assert [json.loads(message)["id"] for message in websocket.sent] == list(range(5))
+        assert connection.stats()["queue_depth"] == 0
+        assert connection.stats()["sent"] == 5
+
+        await connection.close()
+
+    @pytest.mark.anyio
+    async def test_error_queued(self, websocket: FakeWebSocket):
+        websocket.can_send.clear()
+        connection = WSConnection(websocket, 1, max_size=10)
+        connection.start()
+        await self._drain()
+
+        await connection.send(json.dumps({"id": 1}))
+        await connection.send_error("Too many messages")
+        # Nothing is written while the writer is blocked on the first send
+        assert websocket.sent == []
+
+        websocket.can_send.set()
+        await self._drain()
+
+        assert websocket.sent == [json.dumps({"id": 1}), "text:Too many messages"]
+
+        await connection.close()
+
+    @pytest.mark.anyio
+    async def test_drop_oldest(self, websocket: FakeWebSocket):
+        websocket.can_send.clear()
+        connection = WSConnection(websocket, 1, max_size=2, overflow_policy=OverflowPolicy.DROP_OLDEST)
+        connection.start()
+        await self._drain()
+
+        for i in range(5):
+            await connection.send(str(i))
+
+        assert connection.stats()["queue_depth"] == 2
+        assert connection.stats()["dropped"] == 3
+
+        websocket.can_send.set()
+        await self._drain()
+
+        assert websocket.sent == ["3", "4"]
+
+        await connection.close()
+
+    @pytest.mark.anyio
+    async def test_close_slow_consumer(self, websocket: FakeWebSocket):
+        websocket.can_send.clear()
+        connection = WSConnection(websocket, 1, max_size=1, overflow_policy=OverflowPolicy.CLOSE)
+        connection.start()
+        await self._drain()
+
+        for i in range(3):
+            await connection.send(str(i))
+
+        # Close is scheduled, the sender doesn't wait for the client
+        assert connection.closed
+        assert websocket.closed_with is None
+
+        await self._drain()
+        assert websocket.closed_with == 1013
+
+    @pytest.mark.anyio
+    async def test_spill(self, websocket: FakeWebSocket):
+        backlog = list()
+
+        async def push_backlog(key, message, limit, ttl):
+            backlog.append(message)
+
+        async def pop_backlog(key, count):
+            messages = backlog[:count]
+            del backlog[:count]
+            return messages
+
+        websocket.can_send.clear()
+        with patch("chat.api.services.redis_manager") as redis_manager:
+            redis_manager.push_backlog = AsyncMock(side_effect=push_backlog)
+            redis_manager.pop_backlog = AsyncMock(side_effect=pop_backlog)
+
+            connection = WSConnection(websocket, 1, max_size=1, overflow_policy=OverflowPolicy.SPILL)
+            connection.start()
+            await self._drain()
+
+            for i in range(4):
+                await connection.send(str(i))
+
+            assert backlog == ["1", "2", "3"]
+
+            websocket.can_send.set()
+            await self._drain()
+
+            assert websocket.sent == ["0", "1", "2", "3"]
+            assert connection.stats()["spill_pending"] == 0
+
+            await connection.close()
+
+    def test_spill_key_per_connection(self, websocket: FakeWebSocket):
+        first, second = WSConnection(websocket, 1), WSConnection(FakeWebSocket(), 1)
+
+        assert first.spill_key != second.spill_key
+        assert first.spill_key.startswith("ws_spill_1_")
+
+    @pytest.mark.anyio
+    async def test_writer_error_closes(self, websocket: FakeWebSocket):
+        websocket.can_send.clear()
+        with patch("chat.api.services.redis_manager") as redis_manager:
+            redis_manager.push_backlog = AsyncMock()
+            redis_manager.pop_backlog = AsyncMock(side_effect=ConnectionError("Redis is down"))
+            redis_manager.delete_cache_value = AsyncMock()
+
+            connection = WSConnection(websocket, 1, max_size=1, overflow_policy=OverflowPolicy.SPILL)
+            connection.start()
+            await self._drain()
+
+            for i in range(2):
+                await connection.send(str(i))
+
+            websocket.can_send.set()
+            await self._drain()
+
+        assert connection.closed
+        assert websocket.closed_with == 1011
+        redis_manager.delete_cache_value.assert_called_once_with(connection.spill_key)
+
+
+class TestWSManagerLocalDelivery():
+    @pytest.fixture
+    def connection(self):
+        connection = WSConnection(FakeWebSocket(), 1)
+        WSManager.register(connection)
+        yield connection
+        WSManager.unregister(connection)
+
+    @pytest.mark.anyio
+    async def test_local_recipient(self, connection: WSConnection):
+        assert await WSManager.deliver_local(1, "message")
+        assert connection.stats()["queue_depth"] == 1
+
+    @pytest.mark.anyio
+    async def test_remote_recipient(self, connection: WSConnection):
+        assert not await WSManager.deliver_local(2, "message")
+        assert connection.stats()["queue_depth"] == 0
+
+    @pytest.mark.anyio
+    async def test_unregister(self, connection: WSConnection):
+        WSManager.unregister(connection)
+
+        assert 1 not in WSManager.connections
+        assert not await WSManager.deliver_local(1, "message")
+
+
+class TestWSManagerReceiver():
+    @pytest.mark.anyio
+    async def test_store_error_keeps_connection(self):
+        websocket = FakeWebSocket()
+
+        async def iter_json():
+            for message_str in ("first", "second"):
+                yield message_str
+
+        websocket.iter_json = iter_json
+        connection = WSConnection(websocket, 1)
+        worker = MagicMock()
+        worker.validate_message = AsyncMock(side_effect=[({"to_customer_id": 2}, None)] * 2)
+        worker.process_and_enhance_message = AsyncMock(
+            side_effect=[RuntimeError("bad row"), ({"id": 2}, False)]
+        )
+        session = MagicMock(rollback=AsyncMock())
+
+        with (
+            patch("chat.api.services.ws_message_limiter") as limiter,
+            patch("chat.api.services.ws_error", new_callable=AsyncMock) as ws_error,
+        ):
+            limiter.acquire = AsyncMock(return_value=0)
+            await WSManager.ws_receiver(worker, session, connection, MagicMock(id=1))
+
+        ws_error.assert_awaited_once_with(connection, "Message is not stored", close_ws=False)
+        session.rollback.assert_awaited_once()
+        # The next message is still processed and acked
+        assert worker.process_and_enhance_message.await_count == 2
+        assert connection.stats()["queue_depth"] == 1
+
+
+class TestWSManagerSubscriptions():
+    @pytest.mark.anyio
+    async def test_shared_subscription(self):
+        first, second = WSConnection(FakeWebSocket(), 1), WSConnection(FakeWebSocket(), 1)
+
+        with patch("chat.api.services.redis_manager") as redis_manager:
+            redis_manager.subscribe = AsyncMock()
+            redis_manager.unsubscribe = AsyncMock()
+            redis_manager.add_to_set = AsyncMock()
+            redis_manager.remove_from_set = AsyncMock()
+
+            await WSManager.subscribe(ChatWorker, first)
+            await WSManager.subscribe(ChatWorker, second)
+
+            redis_manager.subscribe.assert_called_once()
+            channel, callback = redis_manager.subscribe.call_args.args
+            assert channel == "ws_chat_1"
+
+            await callback("other-worker:message")
+            await callback(f"{WORKER_ID}:own message")
+            assert first.stats()["queue_depth"] == 1
+            assert second.stats()["queue_depth"] == 1
+
+            await WSManager.unsubscribe(ChatWorker, first)
+            redis_manager.unsubscribe.assert_not_called()
+
+            await WSManager.unsubscribe(ChatWorker, second)
+            redis_manager.unsubscribe.assert_called_once_with("ws_chat_1")
+            assert 1 not in WSManager.connections
+
+        redis_manager.add_to_set.assert_called_once_with("ws_presence_chat_1", WORKER_ID)
+        redis_manager.remove_from_set.assert_called_once_with("ws_presence_chat_1", WORKER_ID)
+
+    @pytest.mark.anyio
+    async def test_publish_to_other_workers(self):
+        with patch("chat.api.services.redis_manager") as redis_manager:
+            redis_manager.run_script = AsyncMock(return_value=-1)
+
+            await WSManager.publish(ChatWorker, 1, "message")
+
+        _, kwargs = redis_manager.run_script.call_args
+        assert kwargs["keys"] == ["ws_presence_chat_1"]
+        assert kwargs["args"] == [WORKER_ID, "ws_chat_1", f"{WORKER_ID}:message", "ws_worker_alive_"]
+
+    @pytest.mark.anyio
+    async def test_resubscribe_while_unsubscribing(self):
+        first, second = WSConnection(FakeWebSocket(), 1), WSConnection(FakeWebSocket(), 1)
+        unsubscribing = asyncio.Event()
+
+        async def unsubscribe(channel):
+            await unsubscribing.wait()
+
+        with patch("chat.api.services.redis_manager") as redis_manager:
+            redis_manager.subscribe = AsyncMock()
+            redis_manager.unsubscribe = AsyncMock(side_effect=unsubscribe)
+            redis_manager.add_to_set = AsyncMock()
+            redis_manager.remove_from_set = AsyncMock()
+
+            await WSManager.subscribe(ChatWorker, first)
+            leaving = asyncio.create_task(WSManager.unsubscribe(ChatWorker, first))
+            await asyncio.sleep(0)
+            joining = asyncio.create_task(WSManager.subscribe(ChatWorker, second))
+            await asyncio.sleep(0)
+
+            unsubscribing.set()
+            await asyncio.gather(leaving, joining)
+
+            # Second connection subscribed again after the first one left presence
+            assert redis_manager.subscribe.call_count == 2
+            assert [call.args[0] for call in redis_manager.method_calls if call[0] in (
+                "add_to_set", "remove_from_set"
+            )] == ["ws_presence_chat_1"] * 3
+            assert redis_manager.method_calls[-1][0] == "subscribe"
+            assert "ws_presence_chat_1" in WSManager.presence
+
+            await WSManager.unsubscribe(ChatWorker, second)
+
+        assert "ws_presence_chat_1" not in WSManager.presence
+        assert not WSManager._subscription_locks
+
+    @pytest.mark.anyio
+    async def test_heartbeat_lapsed(self):
+        WSManager.presence.add("ws_presence_chat_1")
+
+        with patch("chat.api.services.redis_manager") as redis_manager:
+            redis_manager.run_script = AsyncMock(return_value=1)
+            redis_manager.add_to_set = AsyncMock()
+
+            assert await WSManager.heartbeat()
+            redis_manager.add_to_set.assert_not_called()
+
+            # Publishers may have dropped this worker from presence sets meanwhile
+            redis_manager.run_script.return_value = 0
+            assert not await WSManager.heartbeat()
+            redis_manager.add_to_set.assert_called_once_with("ws_presence_chat_1", WORKER_ID)
+
+        WSManager.presence.discard("ws_presence_chat_1")
+        _, kwargs = redis_manager.run_script.call_args
+        assert kwargs["keys"] == [f"ws_worker_alive_{WORKER_ID}"]
+        assert kwargs["args"] == [30000]
+
+
+class TestWSManagerReplay():
+    @pytest.mark.anyio
+    async def test_live_buffer_overflow(self):
+        websocket = FakeWebSocket()
+        connection = WSConnection(websocket, 1, max_size=10, live_buffer_size=2)
+        connection.start()
+
+        connection.pause()
+        for message_id in range(1, 5):
+            await connection.send(json.dumps({"id": message_id}))
+        await connection.resume(None)
+
+        for _ in range(50):
+            await asyncio.sleep(0)
+
+        assert [json.loads(message) for message in websocket.sent] == [
+            {"type": "resync"},
+            {"id": 3},
+            {"id": 4},
+        ]
+        assert connection.stats()["dropped"] == 2
+
+        await connection.close()
+
+    @pytest.mark.anyio
+    async def test_replay_then_live(self):
+        websocket = FakeWebSocket()
+        connection = WSConnection(websocket, 1, max_size=10)
+        connection.start()
+
+        log = [("1-0", '{"id": 1}'), ("2-0", '{"id": 2}'), ("3-0", '{"id": 3}')]
+
+        async def read_log(key, after_id, count):
+            return [entry for entry in log if stream_id_key(entry[0]) > stream_id_key(after_id)][:count]
+
+        with patch("chat.api.services.redis_manager") as redis_manager:
+            redis_manager.read_log = AsyncMock(side_effect=read_log)
+            redis_manager.first_log_id = AsyncMock(return_value="1-0")
+
+            connection.pause()
+            # Published while the log was being read, so it is both live and logged
+            await connection.send(json.dumps({"id": 3, "delivery_id": "3-0"}))
+            await connection.send(json.dumps({"id": 4, "delivery_id": "4-0"}))
+
+            last_id = await WSManager.replay(ChatWorker, connection, "1-0")
+            await connection.resume(last_id)
+
+        for _ in range(50):
+            await asyncio.sleep(0)
+
+        assert last_id == "3-0"
+        assert [json.loads(message) for message in websocket.sent] == [
+            {"id": 2, "delivery_id": "2-0"},
+            {"id": 3, "delivery_id": "3-0"},
+            {"id": 4, "delivery_id": "4-0"},
+        ]
+
+        await connection.close()
+
+    @pytest.mark.anyio
+    async def test_resync_when_trimmed(self):
+        websocket = FakeWebSocket()
+        connection = WSConnection(websocket, 1, max_size=10)
+        connection.start()
+
+        with patch("chat.api.services.redis_manager") as redis_manager:
+            # Entries up to 2-0 were trimmed
+            redis_manager.first_log_id = AsyncMock(return_value="3-0")
+            redis_manager.read_log = AsyncMock(return_value=[("3-0", '{"id": 3}')])
+
+            last_id = await WSManager.replay(ChatWorker, connection, "1-0")
+
+        for _ in range(50):
+            await asyncio.sleep(0)
+
+        assert last_id == "3-0"
+        assert [json.loads(message) for message in websocket.sent] == [
+            {"type": "resync"},
+            {"id": 3, "delivery_id": "3-0"},
+        ]
+
+        await connection.close()
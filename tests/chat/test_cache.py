@@ -0,0 +1,93 @@
+import pytest
+
+import asyncio
+
+from sqlalchemy.orm import Session
+from unittest.mock import AsyncMock, patch
+
+from chat.cache import INVALIDATE_CHANNEL, ChatLookupCache, chat_lookup_cache, invalidate_on_commit
+
+
+class TestChatLookupCache():
+    @pytest.mark.anyio
+    async def test_unordered_pair(self):
+        cache = ChatLookupCache(max_size=10, use_redis=False)
+        await cache.set(1, from_customer_id=5, to_customer_id=3)
+
+        assert await cache.get(5, 3) == (1, 5)
+        assert await cache.get(3, 5) == (1, 5)
+        assert await cache.get(3, 4) is None
+        assert cache.stats() == {"size": 1, "hits": 2, "redis_hits": 0, "misses": 1}
+
+    @pytest.mark.anyio
+    async def test_lru_eviction(self):
+        cache = ChatLookupCache(max_size=2, use_redis=False)
+        await cache.set(1, 1, 2)
+        await cache.set(2, 1, 3)
+        await cache.get(1, 2)
+        await cache.set(3, 1, 4)
+
+        assert await cache.get(1, 2) == (1, 1)
+        assert await cache.get(1, 3) is None
+        assert await cache.get(1, 4) == (3, 1)
+
+    @pytest.mark.anyio
+    async def test_redis_tier(self):
+        cache = ChatLookupCache(max_size=10, use_redis=True)
+
+        with patch("chat.cache.redis_manager") as redis_manager:
+            redis_manager.get_cache_value = AsyncMock(return_value=b"7:4")
+
+            assert await cache.get(2, 4) == (7, 4)
+            redis_manager.get_cache_value.assert_called_once_with("chat_pair_2_4")
+
+            # Second lookup is served by the local tier
+            assert await cache.get(4, 2) == (7, 4)
+            redis_manager.get_cache_value.assert_called_once()
+
+        assert cache.stats()["redis_hits"] == 1
+
+    @pytest.mark.anyio
+    async def test_invalidate(self):
+        cache = ChatLookupCache(max_size=10, use_redis=True)
+
+        with patch("chat.cache.redis_manager") as redis_manager:
+            redis_manager.set_cache_value = AsyncMock()
+            redis_manager.delete_cache_value = AsyncMock()
+            redis_manager.publish = AsyncMock()
+            redis_manager.get_cache_value = AsyncMock(return_value=None)
+
+            await cache.set(1, 2, 1)
+            await cache.invalidate(2, 1)
+
+            assert await cache.get(1, 2) is None
+            redis_manager.delete_cache_value.assert_called_once_with("chat_pair_1_2")
+            redis_manager.publish.assert_called_once_with(INVALIDATE_CHANNEL, "1:2")
+
+    @pytest.mark.anyio
+    async def test_invalidated_by_other_worker(self):
+        cache = ChatLookupCache(max_size=10, use_redis=False)
+        await cache.set(1, 2, 1)
+
+        await cache._on_invalidate("1:2")
+
+        assert await cache.get(1, 2) is None
+
+    @pytest.mark.anyio
+    async def test_invalidate_on_commit(self):
+        await chat_lookup_cache.set(1, 5, 3)
+        session = Session()
+
+        with patch("chat.cache.redis_manager") as redis_manager:
+            redis_manager.publish = AsyncMock()
+            redis_manager.delete_cache_value = AsyncMock()
+
+            # Chats deleted with raw statements stay cached until the session commits
+            invalidate_on_commit(session, [(3, 5)])
+            assert await chat_lookup_cache.get(5, 3) == (1, 5)
+
+            session.commit()
+            assert await chat_lookup_cache.get(5, 3) is None
+            await asyncio.sleep(0)
+
+        redis_manager.publish.assert_called_once_with(INVALIDATE_CHANNEL, "3:5")
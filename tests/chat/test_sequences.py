@@ -0,0 +1,62 @@
+import pytest
+
+from sqlalchemy import update
+from sqlmodel import Session, col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from chat.sequences import backfill_message_seq
+from models import Chat, ChatMessage, Customer
+from tests import factories
+
+
+class TestBackfillMessageSeq():
+    @staticmethod
+    def _unnumber(session: Session, messages: list[ChatMessage]):
+        session.execute(
+            update(ChatMessage)
+            .where(col(ChatMessage.id).in_([message.id for message in messages]))
+            .values(seq=None)
+        )
+        session.commit()
+
+    @staticmethod
+    def _seqs(session: Session, chat: Chat) -> list[int]:
+        return list(session.exec(
+            select(ChatMessage.seq).where(ChatMessage.chat_id == chat.id).order_by(ChatMessage.id)
+        ).all())
+
+    @pytest.mark.anyio
+    async def test_legacy_only(
+        self, session: Session, async_session: AsyncSession, customer: Customer, other_customer: Customer
+    ):
+        chat = factories.ChatFactory(from_customer_id=customer.id, to_customer_id=other_customer.id)
+        messages = factories.ChatMessageFactory.create_batch(3, chat=chat)
+        self._unnumber(session, messages)
+        session.execute(update(Chat).where(Chat.id == chat.id).values(last_seq=0))
+        session.commit()
+
+        assert await backfill_message_seq(async_session) == 1
+
+        assert self._seqs(session, chat) == [1, 2, 3]
+        session.refresh(chat)
+        assert chat.last_seq == 3
+
+    @pytest.mark.anyio
+    async def test_new_messages_written_first(
+        self, session: Session, async_session: AsyncSession, customer: Customer, other_customer: Customer
+    ):
+        chat = factories.ChatFactory(from_customer_id=customer.id, to_customer_id=other_customer.id)
+        legacy = factories.ChatMessageFactory.create_batch(2, chat=chat)
+        self._unnumber(session, legacy)
+        # Written after the deploy, before the backfill
+        session.execute(update(Chat).where(Chat.id == chat.id).values(last_seq=0))
+        session.commit()
+        session.refresh(chat)
+        factories.ChatMessageFactory(chat=chat)
+
+        await backfill_message_seq(async_session)
+
+        # Legacy messages stay older, seq of the new one doesn't change
+        assert self._seqs(session, chat) == [-1, 0, 1]
+        session.refresh(chat)
+        assert chat.last_seq == 1
@@ -0,0 +1,147 @@
+import asyncio
+import contextlib
+import pytest
+
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from unittest.mock import MagicMock, patch
+
+from chat.summaries import rebuild_chat_summaries
+from chat.writer import MessageWriter
+from models import Chat, ChatSummary, Customer
+from tests import factories
+
+
+@contextlib.asynccontextmanager
+async def fake_session():
+    yield MagicMock()
+
+
+class TestMessageWriter():
+    @pytest.fixture
+    def batches(self):
+        batches = list()
+
+        async def store(session, batch):
+            batches.append(batch)
+            return [(f"message {data['message']}", True) for _, data in batch]
+
+        with patch("chat.writer.create_session", fake_session), \
+                patch.object(MessageWriter, "_store", side_effect=store):
+            yield batches
+
+    @pytest.mark.anyio
+    async def test_flush_on_batch_size(self, batches: list):
+        writer = MessageWriter(interval=60, batch_size=3)
+
+        results = await asyncio.gather(*[writer.write(1, {"message": i}) for i in range(3)])
+
+        assert results == [("message 0", True), ("message 1", True), ("message 2", True)]
+        assert len(batches) == 1
+        assert writer.stats()["max_batch"] == 3
+
+    @pytest.mark.anyio
+    async def test_flush_on_interval(self, batches: list):
+        writer = MessageWriter(interval=0.01, batch_size=100)
+
+        results = await asyncio.gather(writer.write(1, {"message": 0}), writer.write(2, {"message": 1}))
+
+        assert results == [("message 0", True), ("message 1", True)]
+        assert batches == [[(1, {"message": 0}), (2, {"message": 1})]]
+        assert writer.stats()["pending"] == 0
+
+    @pytest.mark.anyio
+    async def test_failed_batch(self):
+        writer = MessageWriter(interval=0, batch_size=100)
+
+        with patch("chat.writer.create_session", fake_session), \
+                patch.object(MessageWriter, "_store", side_effect=RuntimeError("db is down")):
+            with pytest.raises(RuntimeError):
+                await writer.write(1, {"message": 0})
+
+        assert writer.stats()["batches"] == 0
+
+    @pytest.mark.anyio
+    async def test_failed_batch_split(self):
+        writer = MessageWriter(interval=60, batch_size=3)
+        batches = list()
+
+        async def store(session, batch):
+            batches.append(batch)
+            if any(data["message"] == "bad" for _, data in batch):
+                raise RuntimeError("bad row")
+            return [(f"message {data['message']}", True) for _, data in batch]
+
+        with patch("chat.writer.create_session", fake_session), \
+                patch.object(MessageWriter, "_store", side_effect=store):
+            results = await asyncio.gather(
+                writer.write(1, {"message": 0}),
+                writer.write(2, {"message": "bad"}),
+                writer.write(3, {"message": 2}),
+                return_exceptions=True,
+            )
+
+        # Messages of other connections are stored one by one, only the bad one fails
+        assert results[0] == ("message 0", True)
+        assert isinstance(results[1], RuntimeError)
+        assert results[2] == ("message 2", True)
+        assert len(batches) == 4
+        assert writer.stats()["split_batches"] == 1
+        assert writer.stats()["failed"] == 1
+
+
+class TestStore():
+    @pytest.fixture
+    async def chat(self, async_session: AsyncSession, customer: Customer, other_customer: Customer):
+        chat = factories.ChatFactory(from_customer_id=customer.id, to_customer_id=other_customer.id)
+        await rebuild_chat_summaries(async_session)
+        return chat
+
+    @staticmethod
+    def _data(chat: Chat, message: str, client_msg_id: str | None = None) -> dict:
+        return {
+            "to_customer_id": chat.to_customer_id,
+            "message": message,
+            "is_from_from_customer": True,
+            "chat_id": chat.id,
+            "client_msg_id": client_msg_id,
+        }
+
+    @pytest.mark.anyio
+    async def test_insert(self, async_session: AsyncSession, customer: Customer, chat: Chat):
+        batch = [
+            (customer.id, self._data(chat, "first", "a")),
+            (customer.id, self._data(chat, "second")),
+            (customer.id, self._data(chat, "first", "a")),
+        ]
+
+        (first, first_created), (second, second_created), (copy, copy_created) = (
+            await MessageWriter._store(async_session, batch)
+        )
+
+        assert first_created and second_created and not copy_created
+        assert copy.id == first.id
+        assert [first.seq, second.seq] == [1, 2]
+        summary = (await async_session.exec(
+            select(ChatSummary).where(
+                ChatSummary.chat_id == chat.id, ChatSummary.customer_id == chat.to_customer_id
+            )
+        )).one()
+        assert summary.unread_count == 2
+        assert summary.last_received_message_id == second.id
+
+    @pytest.mark.anyio
+    async def test_conflict(self, async_session: AsyncSession, customer: Customer, chat: Chat):
+        [(stored, _)] = await MessageWriter._store(async_session, [(customer.id, self._data(chat, "first", "a"))])
+
+        # Retried message conflicts, the batch is written again without it
+        (retried, retried_created), (second, second_created) = await MessageWriter._store(
+            async_session,
+            [(customer.id, self._data(chat, "first", "a")), (customer.id, self._data(chat, "second", "b"))],
+        )
+
+        assert (retried.id, retried_created) == (stored.id, False)
+        assert second_created
+        # Seqs reserved for the first attempt are rolled back, so there is no gap
+        assert second.seq == 2
+        assert (await async_session.get(Chat, chat.id, populate_existing=True)).last_seq == 2
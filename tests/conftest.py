@@ -16,6 +16,14 @@ random.seed(0)
 def anyio_backend():
     return 'asyncio'
 
+@pytest.fixture
+async def async_session():
+    from config.db import engine
+    from sqlmodel.ext.asyncio.session import AsyncSession
+
+    async with AsyncSession(engine, expire_on_commit=False) as _session:
+        yield _session
+
 @pytest.fixture(scope="session")
 def event_loop():
     loop = asyncio.get_event_loop_policy().new_event_loop()
@@ -0,0 +1,47 @@
+import contextlib
+import pytest
+
+from unittest.mock import MagicMock, patch
+
+from core.aws import AWSClients
+
+
+class TestAWSClients():
+    @pytest.fixture
+    def created(self):
+        created = list()
+
+        @contextlib.asynccontextmanager
+        async def create_client(service):
+            client = MagicMock(service=service, closed=False)
+            created.append(client)
+            yield client
+            client.closed = True
+
+        with patch.object(AWSClients, "_create_client", side_effect=create_client):
+            yield created
+
+    @pytest.mark.anyio
+    async def test_shared_while_open(self, created: list[MagicMock]):
+        clients = AWSClients(services=("s3", "pinpoint"))
+        await clients.open()
+
+        for _ in range(3):
+            async with clients.client("s3") as client:
+                assert client is clients.get("s3")
+        assert [client.service for client in created] == ["s3", "pinpoint"]
+
+        await clients.close()
+        assert all(client.closed for client in created)
+        with pytest.raises(RuntimeError):
+            clients.get("s3")
+
+    @pytest.mark.anyio
+    async def test_temporary_when_closed(self, created: list[MagicMock]):
+        clients = AWSClients(services=("s3",))
+
+        async with clients.client("s3") as client:
+            assert not client.closed
+
+        assert client.closed
+        assert len(created) == 1
@@ -0,0 +1,90 @@
+import datetime
+import pytest
+
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from core.principals import INVALIDATE_CHANNEL, PrincipalCache
+from models import Customer, User
+
+
+@pytest.fixture
+def user():
+    user = User(id=1, email="principal@test.com", phone_number="+79150000000", created_at=datetime.datetime(2020, 1, 1))
+    user.customer = Customer(id=2, name="Name", zip_code="12345", user_id=1)
+    return user
+
+
+@pytest.fixture
+def session():
+    session = MagicMock()
+    session.merge = AsyncMock(side_effect=lambda user, load: user)
+    return session
+
+
+class TestPrincipalCache():
+    @pytest.mark.anyio
+    async def test_hit(self, user: User, session: MagicMock):
+        cache = PrincipalCache(max_size=10, ttl=60, use_redis=False)
+        assert await cache.get(session, user.email) is None
+
+        await cache.set(user)
+        cached = await cache.get(session, user.email)
+
+        assert cached is not user
+        assert (cached.id, cached.email, cached.created_at) == (user.id, user.email, user.created_at)
+        assert (cached.customer.id, cached.customer.name) == (user.customer.id, user.customer.name)
+        session.merge.assert_called_once_with(cached, load=False)
+        assert cache.stats() == {"size": 1, "hits": 1, "redis_hits": 0, "misses": 1}
+
+    @pytest.mark.anyio
+    async def test_expired(self, user: User, session: MagicMock):
+        cache = PrincipalCache(max_size=10, ttl=60, use_redis=False)
+        await cache.set(user)
+
+        with patch("core.principals.time.monotonic", return_value=float("inf")):
+            assert await cache.get(session, user.email) is None
+
+    @pytest.mark.anyio
+    async def test_redis_tier(self, user: User, session: MagicMock):
+        writer, reader = PrincipalCache(use_redis=True), PrincipalCache(use_redis=True)
+        stored = dict()
+
+        async def run_script(script, keys, args):
+            stored[keys[0]] = args[0]
+
+        with patch("core.principals.redis_manager") as redis_manager:
+            redis_manager.run_script = AsyncMock(side_effect=run_script)
+            redis_manager.get_cache_value = AsyncMock(side_effect=lambda key: stored.get(key))
+
+            await writer.set(user)
+            cached = await reader.get(session, user.email)
+
+        assert cached.customer.name == user.customer.name
+        assert reader.stats()["redis_hits"] == 1
+
+    @pytest.mark.anyio
+    async def test_invalidate(self, user: User, session: MagicMock):
+        cache = PrincipalCache(max_size=10, ttl=60, use_redis=False)
+        await cache.set(user)
+
+        version = PrincipalCache.version(user, user.customer) + 1
+        with patch("core.principals.redis_manager") as redis_manager:
+            redis_manager.publish = AsyncMock()
+            await cache.invalidate(user.email, version)
+
+        assert await cache.get(session, user.email) is None
+        redis_manager.publish.assert_called_once_with(INVALIDATE_CHANNEL, f"{version}:{user.email}")
+
+    @pytest.mark.anyio
+    async def test_stale_set_after_invalidate(self, user: User, session: MagicMock):
+        cache = PrincipalCache(max_size=10, ttl=60, use_redis=False)
+        stale_version = PrincipalCache.version(user, user.customer)
+
+        # User is changed by another request while this one was reading it
+        cache.evict_local(user.email, stale_version + 1)
+        await cache.set(user)
+        assert await cache.get(session, user.email) is None
+
+        user.updated_at = datetime.datetime.utcfromtimestamp(stale_version + 1)
+        await cache.set(user)
+        assert await cache.get(session, user.email) is not None
@@ -0,0 +1,95 @@
+import pytest
+
+from fastapi import Request
+from redis import exceptions as redis_exceptions
+from unittest.mock import AsyncMock, patch
+from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
+
+from core.api.exceptions import TooManyRequestsError
+from core.ratelimit import RateLimiter, client_ip
+
+
+class TestRateLimiter():
+    @pytest.mark.anyio
+    async def test_lease_spent_locally(self):
+        limiter = RateLimiter("test", rate=10, burst=10, lease=5)
+
+        with patch("core.ratelimit.redis_manager") as redis_manager:
+            redis_manager.run_script = AsyncMock(return_value=[5, 0])
+
+            for _ in range(5):
+                assert await limiter.acquire("key") == 0
+
+        redis_manager.run_script.assert_called_once()
+        assert limiter.stats()["local_hits"] == 4
+
+    @pytest.mark.anyio
+    async def test_denial_cached(self):
+        limiter = RateLimiter("test", rate=1, burst=1)
+
+        with patch("core.ratelimit.redis_manager") as redis_manager:
+            redis_manager.run_script = AsyncMock(return_value=[0, 30000])
+
+            for _ in range(3):
+                with pytest.raises(TooManyRequestsError) as e:
+                    await limiter.hit("key")
+
+        redis_manager.run_script.assert_called_once()
+        assert e.value.status_code == 429
+        assert int(e.value.headers["Retry-After"]) == 30
+        assert limiter.stats()["denied"] == 3
+
+    @pytest.mark.anyio
+    async def test_keys_limited_separately(self):
+        limiter = RateLimiter("test", rate=1, burst=1)
+
+        with patch("core.ratelimit.redis_manager") as redis_manager:
+            redis_manager.run_script = AsyncMock(side_effect=[[0, 1000], [1, 0]])
+
+            assert await limiter.acquire("first") == 1
+            assert await limiter.acquire("second") == 0
+
+        keys = [call.kwargs["keys"] for call in redis_manager.run_script.call_args_list]
+        assert keys == [["ratelimit_test_first"], ["ratelimit_test_second"]]
+
+    @pytest.mark.anyio
+    async def test_redis_error_allows(self):
+        limiter = RateLimiter("test", rate=1, burst=1)
+
+        with patch("core.ratelimit.redis_manager") as redis_manager:
+            redis_manager.run_script = AsyncMock(side_effect=redis_exceptions.ConnectionError)
+
+            assert await limiter.acquire("key") == 0
+
+
+class TestClientIp():
+    async def _client_ip(self, trusted_hosts: str, peer: str, forwarded_for: str) -> str:
+        result = []
+
+        async def app(scope, receive, send):
+            result.append(client_ip(Request(scope)))
+
+        scope = {
+            "type": "http",
+            "scheme": "http",
+            "client": (peer, 50000),
+            "headers": [(b"x-forwarded-for", forwarded_for.encode("latin-1"))],
+        }
+        await ProxyHeadersMiddleware(app, trusted_hosts=trusted_hosts)(scope, None, None)
+        return result[0]
+
+    @pytest.mark.anyio
+    async def test_trusted_proxy(self):
+        # Only the address added by the balancer counts, the client can prepend anything
+        assert await self._client_ip("10.0.0.1", "10.0.0.1", "1.1.1.1, 2.2.2.2") == "2.2.2.2"
+
+    @pytest.mark.anyio
+    async def test_proxy_chain(self):
+        # Trusted hops are skipped from the right, the first untrusted entry is the client
+        assert await self._client_ip(
+            "10.0.0.1,10.0.0.2", "10.0.0.1", "1.1.1.1, 2.2.2.2, 10.0.0.2"
+        ) == "2.2.2.2"
+
+    @pytest.mark.anyio
+    async def test_untrusted_peer(self):
+        assert await self._client_ip("10.0.0.1", "3.3.3.3", "1.1.1.1") == "3.3.3.3"
@@ -0,0 +1,168 @@
+import asyncio
+import contextlib
+import pytest
+import time
+
+from botocore.exceptions import ClientError
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from core.s3 import PresignedURLCache, delete_objects, upload_stream
+
+MB = 1024 * 1024
+# Backoff sleeps are patched out, simulated requests still need a real one
+sleep = asyncio.sleep
+
+
+async def _stream(size: int, chunk_size: int = 64 * 1024):
+    for offset in range(0, size, chunk_size):
+        yield b"x" * min(chunk_size, size - offset)
+
+
+class FakeUploadFile():
+    def __init__(self, data: bytes):
+        self.data = data
+
+    async def read(self, size: int = -1) -> bytes:
+        chunk, self.data = self.data[:size], self.data[size:]
+        return chunk
+
+
+@pytest.fixture
+def client():
+    client = MagicMock()
+    client.put_object = AsyncMock()
+    client.create_multipart_upload = AsyncMock(return_value={"UploadId": "upload"})
+    client.complete_multipart_upload = AsyncMock()
+    client.abort_multipart_upload = AsyncMock()
+
+    @contextlib.asynccontextmanager
+    async def create_client():
+        yield client
+
+    with patch("core.s3.create_client", create_client):
+        yield client
+
+
+class TestUploadStream():
+    @pytest.mark.anyio
+    async def test_small(self, client: MagicMock):
+        await upload_stream(bucket="bucket", key="key", stream=FakeUploadFile(b"data"), part_size=5 * MB)
+
+        client.put_object.assert_called_once_with(
+            Bucket="bucket", Key="key", Body=b"data", ContentType="application/octet-stream"
+        )
+        client.create_multipart_upload.assert_not_called()
+
+    @pytest.mark.anyio
+    async def test_multipart(self, client: MagicMock):
+        in_flight, max_in_flight = 0, 0
+        sizes = dict()
+
+        async def upload_part(PartNumber, Body, **kwargs):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            sizes[PartNumber] = len(Body)
+            return {"ETag": f"etag{PartNumber}"}
+
+        client.upload_part = AsyncMock(side_effect=upload_part)
+
+        await upload_stream(bucket="bucket", key="key", stream=_stream(23 * MB), part_size=5 * MB, concurrency=2)
+
+        assert sizes == {1: 5 * MB, 2: 5 * MB, 3: 5 * MB, 4: 5 * MB, 5: 3 * MB}
+        assert max_in_flight == 2
+        client.put_object.assert_not_called()
+        parts = client.complete_multipart_upload.call_args.kwargs["MultipartUpload"]["Parts"]
+        assert parts == [{"PartNumber": i, "ETag": f"etag{i}"} for i in range(1, 6)]
+
+    @pytest.mark.anyio
+    async def test_abort_on_error(self, client: MagicMock):
+        client.upload_part = AsyncMock(side_effect=RuntimeError)
+
+        with pytest.raises(RuntimeError):
+            await upload_stream(bucket="bucket", key="key", stream=_stream(50 * MB), part_size=5 * MB)
+
+        client.abort_multipart_upload.assert_called_once_with(Bucket="bucket", Key="key", UploadId="upload")
+        client.complete_multipart_upload.assert_not_called()
+
+
+class TestDeleteObjects():
+    @pytest.fixture(autouse=True)
+    def no_backoff(self):
+        with patch("core.s3.asyncio.sleep", AsyncMock()) as sleep:
+            yield sleep
+
+    @staticmethod
+    async def _keys(count: int):
+        for i in range(count):
+            yield f"key{i}"
+
+    @pytest.mark.anyio
+    async def test_batches(self, client: MagicMock):
+        in_flight, max_in_flight = 0, 0
+        batches = list()
+
+        async def delete(Bucket, Delete):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await sleep(0.01)
+            in_flight -= 1
+            batches.append(len(Delete["Objects"]))
+            return {}
+
+        client.delete_objects = AsyncMock(side_effect=delete)
+
+        assert await delete_objects(bucket="bucket", keys=self._keys(2500), concurrency=2) == []
+
+        assert sorted(batches) == [500, 1000, 1000]
+        assert max_in_flight == 2
+
+    @pytest.mark.anyio
+    async def test_retry_throttled(self, client: MagicMock, no_backoff: AsyncMock):
+        throttled = ClientError({"Error": {"Code": "SlowDown"}}, "DeleteObjects")
+        client.delete_objects = AsyncMock(side_effect=[
+            throttled,
+            {"Errors": [
+                {"Key": "key0", "Code": "InternalError", "Message": "Retry"},
+                {"Key": "key1", "Code": "AccessDenied", "Message": "Access Denied"},
+            ]},
+            {},
+        ])
+
+        errors = await delete_objects(bucket="bucket", keys=["key0", "key1", "key2"])
+
+        assert errors == [{"Key": "key1", "Code": "AccessDenied", "Message": "Access Denied"}]
+        objects = [call.kwargs["Delete"]["Objects"] for call in client.delete_objects.call_args_list]
+        assert objects[2] == [{"Key": "key0"}]
+        assert no_backoff.call_count == 2
+
+    @pytest.mark.anyio
+    async def test_failed_batch(self, client: MagicMock):
+        denied = ClientError({"Error": {"Code": "AccessDenied"}}, "DeleteObjects")
+        client.delete_objects = AsyncMock(side_effect=denied)
+
+        errors = await delete_objects(bucket="bucket", keys=["key0", "key1"])
+
+        assert [(error["Key"], error["Code"]) for error in errors] == [("key0", "AccessDenied"), ("key1", "AccessDenied")]
+        client.delete_objects.assert_called_once()
+
+
+class TestPresignedURLCache():
+    @pytest.mark.anyio
+    async def test_cached_until_margin(self, client: MagicMock):
+        client.generate_presigned_url = AsyncMock(side_effect=["first", "second"])
+        cache = PresignedURLCache(max_size=10, ttl=3600, margin=300)
+
+        assert (await cache.get("bucket", "key"))[0] == "first"
+        assert (await cache.get("bucket", "key"))[0] == "first"
+
+        with patch("core.s3.time.time", return_value=time.time() + 3301):
+            assert (await cache.get("bucket", "key"))[0] == "second"
+
+        assert cache.stats() == {"size": 1, "hits": 1, "misses": 2}
+        client.generate_presigned_url.assert_called_with(
+            "get_object", Params={"Bucket": "bucket", "Key": "key"}, ExpiresIn=3600
+        )
@@ -0,0 +1,83 @@
+import json
+import pytest
+
+from botocore.exceptions import ClientError
+from unittest.mock import AsyncMock, patch
+
+from core.sms import SMSQueue, StubTransport
+
+
+class FlakyTransport(StubTransport):
+    def __init__(self, statuses: list[dict[str, str] | Exception]):
+        super().__init__()
+        self.statuses = statuses
+        self.calls: list[dict[str, str]] = list()
+
+    async def send(self, messages: dict[str, str]) -> dict[str, str]:
+        self.calls.append(messages)
+        statuses = self.statuses.pop(0)
+        if isinstance(statuses, Exception):
+            raise statuses
+        return {phone_number: statuses.get(phone_number, "SUCCESSFUL") for phone_number in messages}
+
+
+class TestSMSQueue():
+    @pytest.fixture(autouse=True)
+    def no_backoff(self):
+        with patch("core.sms.asyncio.sleep", AsyncMock()) as sleep:
+            yield sleep
+
+    @staticmethod
+    def _jobs(*messages: tuple[str, str]) -> list[dict]:
+        return [{"phone_number": phone_number, "body": body, "queued_at": 0} for phone_number, body in messages]
+
+    @pytest.mark.anyio
+    async def test_enqueue(self):
+        with patch("core.sms.redis_manager") as redis_manager:
+            redis_manager.push_job = AsyncMock()
+
+            await SMSQueue(transport=StubTransport()).enqueue("+1", "Your code")
+
+        key, job = redis_manager.push_job.call_args.args
+        assert key == "sms_queue"
+        assert json.loads(job)["body"] == "Your code"
+
+    @pytest.mark.anyio
+    async def test_batch(self):
+        transport = StubTransport()
+        queue = SMSQueue(transport=transport)
+
+        await queue._send(self._jobs(("+1", "first"), ("+2", "second"), ("+1", "third")))
+
+        # Only the latest code of a number is sent
+        assert transport.sent == [("+1", "third"), ("+2", "second")]
+        assert queue.stats()["batches"] == 1
+        assert queue.stats()["sent"] == 2
+
+    @pytest.mark.anyio
+    async def test_retry_failed(self, no_backoff: AsyncMock):
+        error = ClientError({"Error": {"Code": "TooManyRequestsException"}}, "SendMessages")
+        transport = FlakyTransport([error, {"+1": "THROTTLED", "+2": "PERMANENT_FAILURE"}, {}])
+        queue = SMSQueue(transport=transport, max_attempts=3)
+
+        await queue._send(self._jobs(("+1", "first"), ("+2", "second")))
+
+        assert transport.calls == [
+            {"+1": "first", "+2": "second"},
+            {"+1": "first", "+2": "second"},
+            {"+1": "first"},
+        ]
+        assert no_backoff.call_count == 2
+        assert queue.stats()["sent"] == 1
+        assert queue.stats()["failed"] == 1
+        assert queue.stats()["retries"] == 3
+
+    @pytest.mark.anyio
+    async def test_give_up(self):
+        transport = FlakyTransport([{"+1": "TEMPORARY_FAILURE"}] * 2)
+        queue = SMSQueue(transport=transport, max_attempts=2)
+
+        await queue._send(self._jobs(("+1", "first")))
+
+        assert len(transport.calls) == 2
+        assert queue.stats()["failed"] == 1
@@ -0,0 +1,95 @@
+import datetime
+import pytest
+import time
+
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from auth.tokens import JWTToken
+from core.api.deps import CustomerIdentity, _get_customer_identity
+from core.token import TokenError, VerifiedTokenCache, verified_token_cache
+from models import Customer, User
+from user.tokens import UserAccessToken
+
+
+class CachedDummyToken(JWTToken):
+    token_type = "cached_dummy"
+    lifetime = datetime.timedelta(days=1)
+
+
+class OtherDummyToken(JWTToken):
+    token_type = "other_dummy"
+    lifetime = datetime.timedelta(days=1)
+
+
+class TestVerifiedTokenCache():
+    def test_expired(self):
+        cache = VerifiedTokenCache(max_size=10)
+        cache.set("valid", {"exp": time.time() + 60})
+        cache.set("expired", {"exp": time.time() - 1})
+
+        assert cache.get("valid")
+        assert cache.get("expired") is None
+        assert cache.stats() == {"size": 1, "hits": 1, "misses": 1}
+
+    def test_lru_eviction(self):
+        cache = VerifiedTokenCache(max_size=2)
+        exp = time.time() + 60
+        cache.set("first", {"exp": exp})
+        cache.set("second", {"exp": exp})
+        cache.get("first")
+        cache.set("third", {"exp": exp})
+
+        assert cache.get("first")
+        assert cache.get("second") is None
+        assert cache.get("third")
+
+
+class TestFromString():
+    @pytest.fixture(autouse=True)
+    def user(self):
+        verified_token_cache.clear()
+        user = MagicMock(email="cached@test.com")
+        with patch.object(JWTToken, "_get_user", AsyncMock(return_value=user)):
+            yield user
+
+    @pytest.mark.anyio
+    async def test_decoded_once(self, user):
+        token_string = str(CachedDummyToken.for_user(user))
+
+        with patch.object(CachedDummyToken, "_decode", wraps=CachedDummyToken._decode) as decode:
+            for _ in range(3):
+                token = await CachedDummyToken.from_string(token_string, None)
+                assert token.user is user
+                assert token["email"] == user.email
+
+        decode.assert_called_once()
+
+    @pytest.mark.anyio
+    async def test_other_token_type(self, user):
+        token_string = str(CachedDummyToken.for_user(user))
+        await CachedDummyToken.from_string(token_string, None)
+
+        with pytest.raises(TokenError):
+            await OtherDummyToken.from_string(token_string, None)
+
+    @pytest.mark.anyio
+    async def test_revoked(self, user):
+        token_string = str(CachedDummyToken.for_user(user))
+        await CachedDummyToken.from_string(token_string, None)
+
+        with patch.object(CachedDummyToken, "is_revoked", AsyncMock(return_value=True)):
+            with pytest.raises(TokenError):
+                await CachedDummyToken.from_string(token_string, None)
+
+
+class TestCustomerIdentity():
+    @pytest.mark.anyio
+    async def test_from_claims(self):
+        user = User(id=1, email="identity@test.com", phone_number="+79150000001")
+        user.customer = Customer(id=2, name="Name", zip_code="12345", user_id=1)
+        token_string = str(UserAccessToken.for_user(user))
+
+        with patch.object(UserAccessToken, "_get_user", AsyncMock()) as get_user:
+            assert await _get_customer_identity(token_string, None) == CustomerIdentity(id=2, user_id=1)
+
+        get_user.assert_not_called()
@@ -52,8 +52,17 @@ class ChatFactory(BaseFactory):
 class ChatMessageFactory(BaseFactory):
     message = factory.Faker("sentence")
     is_from_from_customer = True
+    seq = None
 
     chat = factory.SubFactory(ChatFactory)
 
     class Meta:
         model = ChatMessage
+
+    @classmethod
+    def _create(cls, model_class, *args, **kwargs):
+        chat = kwargs["chat"]
+        if kwargs["seq"] is None:
+            chat.last_seq += 1
+            kwargs["seq"] = chat.last_seq
+        return super()._create(model_class, *args, **kwargs)
@@ -0,0 +1,96 @@
+import pytest
+
+from starlette.testclient import TestClient
+from urllib.parse import parse_qs, urlparse
+
+from config.settings import settings
+from core.s3 import presigned_url_cache
+from models import Customer
+from tests import factories
+
+
+class TestGetUploadURL():
+    url = "/media/upload_url/"
+
+    def test_ok(self, as_user: TestClient, customer: Customer):
+        response = as_user.post(self.url, json={"content_type": "image/png"})
+
+        result = response.json()
+        assert response.status_code == 201
+        assert result["key"].startswith(f"customers/{customer.id}/")
+        assert result["key"].endswith(".png")
+
+        url = urlparse(result["url"])
+        assert result["key"] in url.path
+        assert "X-Amz-Signature" in parse_qs(url.query)
+
+    def test_content_type_not_allowed(self, as_user: TestClient):
+        response = as_user.post(self.url, json={"content_type": "text/html"})
+
+        assert response.status_code == 400
+        assert response.json() == {"detail": "Content type is not allowed"}
+
+    def test_unauthorized(self, client: TestClient):
+        response = client.post(self.url, json={"content_type": "image/png"})
+
+        assert response.status_code == 401
+
+
+class TestGetUploadPolicy():
+    url = "/media/upload_policy/"
+
+    def test_ok(self, as_user: TestClient, customer: Customer):
+        response = as_user.post(self.url, json={"content_type": "image/jpeg"})
+
+        result = response.json()
+        assert response.status_code == 201
+        assert result["key"].startswith(f"customers/{customer.id}/")
+        assert result["fields"]["key"] == result["key"]
+        assert result["fields"]["Content-Type"] == "image/jpeg"
+        assert "policy" in result["fields"]
+
+
+class TestGetDownloadURL():
+    url = "/media/download_url/"
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        presigned_url_cache.clear()
+
+    def test_ok(self, as_user: TestClient, customer: Customer):
+        key = f"customers/{customer.id}/photo.jpg"
+
+        first = as_user.get(self.url, params={"key": key})
+        second = as_user.get(self.url, params={"key": key})
+
+        assert first.status_code == 200
+        assert key in first.json()["url"]
+        # Signature is cached, so the same URL is returned
+        assert second.json() == first.json()
+        assert presigned_url_cache.stats()["hits"] == 1
+
+    def test_chat_participant(self, as_user: TestClient, customer: Customer, other_customer: Customer):
+        factories.ChatFactory(from_customer_id=other_customer.id, to_customer_id=customer.id)
+        key = f"customers/{other_customer.id}/photo.jpg"
+
+        response = as_user.get(self.url, params={"key": key})
+
+        assert response.status_code == 200
+        assert key in response.json()["url"]
+
+    def test_other_customer(self, as_user: TestClient, other_customer: Customer):
+        response = as_user.get(self.url, params={"key": f"customers/{other_customer.id}/photo.jpg"})
+
+        assert response.status_code == 403
+        assert presigned_url_cache.stats()["misses"] == 0
+
+    @pytest.mark.parametrize("key", ["customers/photo.jpg", "customers/1x/photo.jpg", "customers//photo.jpg"])
+    def test_malformed_key(self, as_user: TestClient, key: str):
+        response = as_user.get(self.url, params={"key": key})
+
+        assert response.status_code == 403
+
+    def test_other_prefix(self, as_user: TestClient):
+        response = as_user.get(self.url, params={"key": f"private/{settings.SECRET_KEY}"})
+
+        assert response.status_code == 403
@@ -1,4 +1,7 @@
+from datetime import datetime
+from sqlalchemy import inspect
 from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.base import NO_VALUE
 from sqlmodel import select
 
 from auth.tokens import JWTToken
@@ -10,15 +13,33 @@ from models import User
 class UserAccessToken(JWTToken):
     token_type = "user_access"
     lifetime = settings.USER_ACCESS_TOKEN_LIFETIME
+    cache_user = True
+
+    @classmethod
+    def get_claims(cls, user: User, from_time: datetime) -> ClaimsDict:
+        """
+        Ids let routes that only need them authorize without loading the user,
+        customer_id is added only if user.customer is already loaded
+        """
+        claims = super().get_claims(user, from_time) | {"user_id": user.id}
+        customer = inspect(user).attrs.customer.loaded_value
+        if customer is not NO_VALUE and customer is not None:
+            claims["customer_id"] = customer.id
+        return claims
 
     @classmethod
     def get_user_query(cls, claims: ClaimsDict) -> UserSelect:
         return (
             select(User)
+            .options(joinedload(User.customer))
             .where(User.email == claims["email"])
         )
 
 
-class UserRefreshToken(JWTToken):  # TODO: Blacklist
+class UserRefreshToken(JWTToken):
+    """
+    Single use, exchanged through auth.api.services.refresh_token_pair
+    """
+
     token_type = "user_refresh"
     lifetime = settings.USER_REFRESH_TOKEN_LIFETIME